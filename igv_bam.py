@@ -0,0 +1,570 @@
+# BAM and BAI reading, region slicing and coverage precomputation for igv_web.py.
+
+import os
+import struct
+import tempfile
+from bisect import bisect_right
+from collections import defaultdict
+
+from igv_bgzf import (BGZF_BLOCK_SIZE, BGZF_EOF, BgzfReader, BgzfWriter, BinningIndex, bgzf_blocks,
+                      compress_block, merge_regions, query_start, read_binning_index, read_block)
+# reads with these flags do not count towards coverage: unmapped, secondary, QC fail, duplicate
+COVERAGE_SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+# CIGAR operations that consume the reference; M, = and X also count as coverage
+CIGAR_REF_OPS = frozenset((0, 2, 3, 7, 8))
+CIGAR_MATCH_OPS = frozenset((0, 7, 8))
+
+
+def read_bam_header(reader):
+    '''Reads the header at the start of a BAM file.
+
+    Returns (header text, [(reference name, length), ...]) and leaves reader
+    positioned at the first alignment record.
+    '''
+    if reader.read(4) != b'BAM\1':
+        raise ValueError('Not a BAM file')
+    l_text, = struct.unpack('<i', reader.read(4))
+    text = reader.read(l_text).rstrip(b'\0').decode('utf-8', 'replace')
+    n_ref, = struct.unpack('<i', reader.read(4))
+    refs = []
+    for _ in range(n_ref):
+        l_name, = struct.unpack('<i', reader.read(4))
+        name = reader.read(l_name).rstrip(b'\0').decode()
+        l_ref, = struct.unpack('<i', reader.read(4))
+        refs.append((name, l_ref))
+    return text, refs
+
+
+def iter_records(reader):
+    '''Yields (begin voffset, end voffset, record) for every alignment from
+    the current position of reader, record being the bytes after block_size.
+    '''
+    data = reader.block[reader.pos:]
+    # buffer offset and compressed address of each block held in data
+    starts, addresses = [-reader.pos], [reader.block_start]
+    pos = 0
+
+    def voffset(p):
+        if p == len(data):
+            return reader.block_end << 16
+        i = bisect_right(starts, p) - 1
+        return (addresses[i] << 16) | (p - starts[i])
+
+    while True:
+        if len(data) - pos >= 4:
+            size, = struct.unpack_from('<i', data, pos)
+            if len(data) - pos - 4 >= size:
+                begin = voffset(pos)
+                record = data[pos + 4:pos + 4 + size]
+                pos += 4 + size
+                yield begin, voffset(pos), record
+                continue
+        # compact the consumed part before pulling in the next block
+        if pos:
+            data = data[pos:]
+            starts = [start - pos for start in starts]
+            pos = 0
+            keep = bisect_right(starts, 0) - 1
+            starts, addresses = starts[keep:], addresses[keep:]
+        if not reader.next_block():
+            return
+        starts.append(len(data))
+        addresses.append(reader.block_start)
+        data += reader.block
+        reader.pos = len(reader.block)
+
+
+def parse_record(record):
+    '''Returns (refID, pos, flag, cigar operations) of an alignment record.'''
+    ref_id, pos, l_read_name, mapq, bin_, n_cigar, flag, l_seq = struct.unpack_from('<iiBBHHHi', record)
+    cigar = struct.unpack_from('<%dI' % n_cigar, record, 32 + l_read_name)
+    return ref_id, pos, flag, cigar
+
+
+def reference_end(pos, cigar):
+    end = pos
+    for op in cigar:
+        if op & 0xf in CIGAR_REF_OPS:
+            end += op >> 4
+    return end
+
+
+def read_bai(path):
+    '''Reads a BAI index into a list with one dict per reference, as
+    igv_bgzf.read_binning_index describes.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'BAI\1':
+        raise ValueError('{} is not a BAI index'.format(path))
+    n_ref, = struct.unpack_from('<i', data, 4)
+    return read_binning_index(data, 8, n_ref)[0]
+
+
+def block_offsets(bai):
+    '''Sorted file offsets of the BGZF blocks a read_bai() index points at:
+    where its chunks begin and end and its linear index entries.
+    '''
+    offsets = set()
+    for ref in bai:
+        # the pseudo-bin's second pair holds read counts, not offsets
+        for chunks in list(ref['bins'].values()) + [ref['meta'][:1] if ref['meta'] else []]:
+            for begin, end in chunks:
+                offsets.add(begin >> 16)
+                offsets.add(end >> 16)
+        offsets.update(offset >> 16 for offset in ref['linear'])
+    return sorted(offsets)
+
+
+def reference_offset(bai_ref):
+    '''Virtual offset of the first alignment on a reference, or None when the
+    index records no alignments for it.
+    '''
+    if bai_ref['meta']:
+        return bai_ref['meta'][0][0]
+    begins = [chunk[0] for chunks in bai_ref['bins'].values() for chunk in chunks]
+    return min(begins) if begins else None
+
+
+def coverage_bins(bam, offset, ref_id, ref_len, bin_size, out_path):
+    '''Computes the mean read depth of one reference of a BAM, whose first
+    alignment is at virtual offset (None when it has none), in bins of
+    bin_size bases and writes them to out_path as packed (start, end, value)
+    items, merging runs of equal bins and leaving out empty ones.
+
+    Depth changes are tracked as +1/-1 deltas keyed by position, so memory
+    follows the pileup depth rather than the reference length. Returns the
+    number of items written.
+    '''
+    items = 0
+    with open(out_path, 'wb') as out:
+        if offset is None:
+            return 0
+        pending = []  # [start, end, value] of the item not yet written
+        bin_start, bin_sum = 0, 0
+
+        def add_bin(start, value):
+            nonlocal items
+            end = min(start + bin_size, ref_len)
+            if pending and pending[1] == start and pending[2] == value:
+                pending[1] = end
+                return
+            if pending and pending[2] > 0:
+                out.write(struct.pack('<IIf', *pending))
+                items += 1
+            pending[:] = [start, end, value]
+
+        def add_segment(start, end, depth):
+            # spread a run of constant depth over the bins it touches
+            nonlocal bin_start, bin_sum
+            # reads may hang over the end of the reference
+            end = min(end, ref_len)
+            while start < end:
+                if start >= bin_start + bin_size:
+                    if bin_sum:
+                        add_bin(bin_start, bin_sum / float(min(bin_size, ref_len - bin_start)))
+                    bin_start, bin_sum = start - start % bin_size, 0
+                stop = min(end, bin_start + bin_size)
+                bin_sum += depth * (stop - start)
+                start = stop
+
+        deltas = defaultdict(int)
+        depth, last = 0, 0
+
+        def flush(upto):
+            nonlocal depth, last
+            for position in sorted(p for p in deltas if p < upto):
+                if depth:
+                    add_segment(last, position, depth)
+                depth += deltas.pop(position)
+                last = position
+
+        with BgzfReader(bam) as reader:
+            reader.seek(offset)
+            flushed = 0
+            for begin, end, record in iter_records(reader):
+                rid, pos, flag, cigar = parse_record(record)
+                if rid != ref_id:
+                    break
+                if flag & COVERAGE_SKIP_FLAGS:
+                    continue
+                if pos - flushed > 65536:
+                    flush(pos)
+                    flushed = pos
+                for op in cigar:
+                    length, kind = op >> 4, op & 0xf
+                    if kind in CIGAR_MATCH_OPS:
+                        deltas[pos] += 1
+                        deltas[pos + length] -= 1
+                    if kind in CIGAR_REF_OPS:
+                        pos += length
+        flush(float('inf'))
+        if bin_sum:
+            add_bin(bin_start, bin_sum / float(min(bin_size, ref_len - bin_start)))
+        if pending and pending[2] > 0:
+            out.write(struct.pack('<IIf', *pending))
+            items += 1
+    return items
+
+
+def bam_coverage(bam, out, bin_size=25, executor=None):
+    '''Writes a multi-resolution bigWig of the read depth of bam to out.
+
+    Each reference is binned by its own coverage_bins task; with a process
+    pool as executor they run in parallel, and several BAMs can share the
+    pool by calling this from separate threads. The BAI is read once here.
+    '''
+    import igv_bigwig
+    with BgzfReader(bam) as reader:
+        text, refs = read_bam_header(reader)
+    bai = read_bai(bam + '.bai')
+    tmp = tempfile.mkdtemp(prefix='igv_cov_')
+    try:
+        tasks = []
+        for ref_id, (name, length) in enumerate(refs):
+            offset = reference_offset(bai[ref_id]) if ref_id < len(bai) else None
+            args = (bam, offset, ref_id, length, bin_size, os.path.join(tmp, '%d.cov' % ref_id))
+            tasks.append(executor.submit(coverage_bins, *args) if executor else coverage_bins(*args))
+        if executor:
+            for task in tasks:
+                task.result()
+        chroms = [(name, length, os.path.join(tmp, '%d.cov' % ref_id))
+                  for ref_id, (name, length) in enumerate(refs)]
+        igv_bigwig.write_bigwig(out + '.tmp', chroms, bin_size)
+        os.replace(out + '.tmp', out)
+    finally:
+        for name in os.listdir(tmp):
+            os.remove(os.path.join(tmp, name))
+        os.rmdir(tmp)
+    return out
+
+
+# uncompressed bytes of alignments indexed per task
+INDEX_CHUNK_SIZE = 32 * 1024 * 1024
+# block_size and the fixed fields of an alignment record up to the flag
+RECORD_FIELDS = struct.Struct('<iiiBBHHH')
+# largest record accepted when looking for the first record of a chunk
+MAX_RECORD_SIZE = 64 * 1024 * 1024
+
+
+def looks_like_record(data, pos, ref_lengths):
+    # plausibility of an alignment record at data[pos:], from its fixed fields
+    if len(data) - pos < 36:
+        return False
+    size, ref_id, start, l_read_name, mapq, bin_, n_cigar, flag, l_seq, next_ref, next_pos = \
+        struct.unpack_from('<iiiBBHHHiii', data, pos)
+    n_ref = len(ref_lengths)
+    return (32 + l_read_name + 4 * n_cigar + (l_seq + 1) // 2 + l_seq <= size <= MAX_RECORD_SIZE
+            and l_read_name > 0 and l_seq >= 0
+            and -1 <= ref_id < n_ref and -1 <= next_ref < n_ref
+            and -1 <= start <= (ref_lengths[ref_id] if ref_id >= 0 else -1)
+            and (len(data) < pos + 36 + l_read_name or data[pos + 35 + l_read_name] == 0))
+
+
+def find_record(data, stop, ref_lengths, chain=4):
+    '''First position before stop where a run of chain plausible records (or
+    plausible records up to the end of data) starts, or None.
+    '''
+    for pos in range(stop):
+        p = pos
+        for _ in range(chain):
+            if not looks_like_record(data, p, ref_lengths):
+                break
+            p += 4 + struct.unpack_from('<i', data, p)[0]
+            if p >= len(data) - 36:
+                return pos
+        else:
+            return pos
+    return None
+
+
+def index_chunk(bam, coffset, n_blocks, uoffset, ref_lengths, start=None):
+    '''Indexes the alignments that start within n_blocks non-empty BGZF
+    blocks from coffset, whose first byte is at uncompressed offset uoffset.
+
+    start is the uncompressed offset of the first record when it is known;
+    otherwise it is guessed from the record layout, and the caller checks the
+    guess against where the previous chunk ended. Returns (first record
+    offset or None, offset after the last record, first and last (ref, pos),
+    {ref: BinningIndex}, {ref: [begin, end, mapped, unmapped]}, unplaced).
+    '''
+    data = bytearray()
+    starts, addresses = [], []
+    with open(bam, 'rb') as f:
+        f.seek(coffset)
+        next_address = coffset
+
+        def load():
+            nonlocal next_address
+            while True:
+                block, size = read_block(f)
+                if not size:
+                    return False
+                address, next_address = next_address, next_address + size
+                if block:
+                    starts.append(len(data))
+                    addresses.append(address)
+                    data.extend(block)
+                    return True
+
+        while len(starts) < n_blocks and load():
+            pass
+        own = len(data)
+
+        block = 0
+
+        def voffset(p):
+            # positions only move forward, so the block is found by stepping
+            nonlocal block
+            if p == len(data):
+                return next_address << 16
+            while block + 1 < len(starts) and starts[block + 1] <= p:
+                block += 1
+            return (addresses[block] << 16) | (p - starts[block])
+
+        pos = start - uoffset if start is not None else find_record(data, own, ref_lengths)
+        if pos is None or pos >= own:
+            return None, start, None, None, {}, {}, 0
+        first = uoffset + pos
+        indexes, meta, unplaced = {}, {}, 0
+        first_key = last_key = None
+        current = index = counts = None
+        cigars = {}
+        vbeg = voffset(pos)
+        while pos < own:
+            while len(data) < pos + 4 or len(data) < pos + 4 + struct.unpack_from('<i', data, pos)[0]:
+                if not load():
+                    raise ValueError('{} is truncated'.format(bam))
+            size, ref_id, beg, l_read_name, mapq, bin_, n_cigar, flag = RECORD_FIELDS.unpack_from(data, pos)
+            cigar_at = pos + 36 + l_read_name
+            pos += 4 + size
+            vend = voffset(pos)
+            key = (ref_id if ref_id >= 0 else len(ref_lengths), beg)
+            if last_key is not None and key < last_key:
+                raise ValueError('{} is not sorted by coordinate'.format(bam))
+            first_key = first_key or key
+            last_key = key
+            if ref_id < 0:
+                unplaced += 1
+            else:
+                unmapped = flag & 0x4
+                if unmapped or not n_cigar:
+                    end = beg + 1
+                else:
+                    cigar = cigars.get(n_cigar) or cigars.setdefault(n_cigar, struct.Struct('<%dI' % n_cigar))
+                    end = reference_end(beg, cigar.unpack_from(data, cigar_at))
+                if ref_id != current:
+                    current = ref_id
+                    index = indexes.setdefault(ref_id, BinningIndex())
+                    counts = meta.setdefault(ref_id, [vbeg, vend, 0, 0])
+                index.add(beg, end, vbeg, vend)
+                counts[1] = vend
+                counts[3 if unmapped else 2] += 1
+            vbeg = vend
+    return first, uoffset + pos, first_key, last_key, indexes, meta, unplaced
+
+
+def guess_chunk(args):
+    # index_chunk, with a wrong guess of the first record returned rather than raised
+    try:
+        return index_chunk(*args)
+    except (ValueError, struct.error) as e:
+        if args[5] is not None:
+            raise
+        return e
+
+
+def write_bai(bam, out=None, executor=None, chunk_size=INDEX_CHUNK_SIZE):
+    '''Writes a BAI index of a coordinate-sorted bam to out (bam + '.bai').
+
+    The BGZF block stream is cut into chunks of about chunk_size bytes that
+    executor, if given, indexes in parallel. Each chunk finds its first
+    record from the record layout; a guess that disagrees with where the
+    previous chunk ended is redone from the right offset, so the result is
+    exact. The index is written under a temporary name and renamed.
+    '''
+    out = out or bam + '.bai'
+    with BgzfReader(bam) as reader:
+        text, refs = read_bam_header(reader)
+        header_end = reader.tell()
+    ref_lengths = [length for name, length in refs]
+    blocks = bgzf_blocks(bam)
+    per_chunk = max(1, chunk_size // 0xff00)
+    # (compressed offset, uncompressed start, uncompressed end) of each chunk with alignments
+    start = dict(blocks).get(header_end >> 16)
+    # no block after the header: there are no alignments
+    start = float('inf') if start is None else start + (header_end & 0xffff)
+    chunks = []
+    for i in range(0, len(blocks), per_chunk):
+        end = blocks[i + per_chunk][1] if i + per_chunk < len(blocks) else float('inf')
+        if end > start:
+            chunks.append((blocks[i][0], blocks[i][1], end))
+    args = [(bam, coffset, per_chunk, uoffset, ref_lengths, start if i == 0 else None)
+            for i, (coffset, uoffset, end) in enumerate(chunks)]
+    if executor and len(args) > 1:
+        results = list(executor.map(guess_chunk, args))
+    else:
+        results = [guess_chunk(arg) for arg in args]
+
+    indexes, meta, unplaced = {}, {}, 0
+    expected, last_key = start, None
+    for arg, (coffset, uoffset, end), result in zip(args, chunks, results):
+        # a chunk is right when it starts where the previous one stopped,
+        # or finds nothing when the previous chunk's last record runs past it
+        right = (not isinstance(result, Exception)
+                 and result[0] == (expected if expected < end else None))
+        if not right:
+            result = index_chunk(*arg[:5], start=expected)
+        first, stop, first_key, key, part_indexes, part_meta, part_unplaced = result
+        if first is None:
+            continue
+        if last_key is not None and first_key < last_key:
+            raise ValueError('{} is not sorted by coordinate'.format(bam))
+        last_key, expected = key, stop
+        for ref_id, index in part_indexes.items():
+            if ref_id in indexes:
+                indexes[ref_id].merge(index)
+            else:
+                indexes[ref_id] = index
+        for ref_id, counts in part_meta.items():
+            if ref_id in meta:
+                meta[ref_id][1] = counts[1]
+                meta[ref_id][2] += counts[2]
+                meta[ref_id][3] += counts[3]
+            else:
+                meta[ref_id] = counts
+        unplaced += part_unplaced
+
+    parts = [b'BAI\1', struct.pack('<i', len(refs))]
+    for ref_id in range(len(refs)):
+        if ref_id in indexes:
+            begin, end, mapped, unmapped = meta[ref_id]
+            parts.append(indexes[ref_id].pack([(begin, end), (mapped, unmapped)]))
+        else:
+            parts.append(struct.pack('<ii', 0, 0))
+    parts.append(struct.pack('<Q', unplaced))
+    with open(out + '.tmp', 'wb') as f:
+        f.write(b''.join(parts))
+    os.replace(out + '.tmp', out)
+    return out
+
+
+def pack_header(text, refs):
+    text = text.encode('utf-8')
+    parts = [b'BAM\1', struct.pack('<i', len(text)), text, struct.pack('<i', len(refs))]
+    for name, length in refs:
+        name = name.encode() + b'\0'
+        parts.append(struct.pack('<i', len(name)) + name + struct.pack('<i', length))
+    return b''.join(parts)
+
+
+def downsample_bam(bam, ref_name, beg=0, end=None, depth=100, window=100, seed=0):
+    '''Checks a downsampling query of bam, a sorted BAM with a .bai, and
+    returns the generator of its BGZF blocks (see downsample_blocks). end
+    defaults to the end of the reference; unknown references and empty or
+    inverted intervals raise ValueError.
+    '''
+    if depth < 1 or window < 1:
+        raise ValueError('depth and window must be positive')
+    with BgzfReader(bam) as reader:
+        text, refs = read_bam_header(reader)
+    names = [name for name, length in refs]
+    if ref_name not in names:
+        raise ValueError('unknown reference {}'.format(ref_name))
+    ref_id = names.index(ref_name)
+    end = refs[ref_id][1] if end is None else min(end, refs[ref_id][1])
+    if not 0 <= beg < end:
+        raise ValueError('empty interval {}:{}-{}'.format(ref_name, beg + 1, end))
+    bai = read_bai(bam + '.bai')
+    start = query_start(bai[ref_id], beg, end) if ref_id < len(bai) else None
+    text += '@CO\tdownsampled to {} alignments per {} bp in {}:{}-{}, seed {}\n'.format(
+        depth, window, ref_name, beg + 1, end, seed)
+    return downsample_blocks(bam, pack_header(text, refs), ref_id, start, beg, end, depth, window, seed)
+
+
+def downsample_blocks(bam, header, ref_id, start, beg, end, depth, window, seed):
+    '''Yields the BGZF blocks of a BAM with header and at most depth of the
+    alignments overlapping [beg, end) that start in each window of window
+    bases; alignments starting before beg count to the first window.
+
+    Every window has its own Algorithm L reservoir seeded by seed and the
+    window position, so a query returns the same reads each time and any
+    window the same reads in every query that covers it. A window is written
+    out as soon as the alignments move past it, so memory and output stay
+    bounded by depth per window however deep the pileup is.
+    '''
+    # igv_sample needs numpy, which indexing and coverage do not
+    from igv_sample import ReservoirL
+    out = bytearray(header)
+
+    def flush(sampler):
+        for order, record in sorted(sampler.sample()):
+            out.extend(struct.pack('<i', len(record)))
+            out.extend(record)
+
+    if start is not None:
+        current, sampler = None, None
+        with BgzfReader(bam) as reader:
+            reader.seek(start)
+            for order, (vbeg, vend, record) in enumerate(iter_records(reader)):
+                rid, pos = struct.unpack_from('<ii', record)
+                if rid != ref_id or pos >= end:
+                    break
+                if pos < beg:
+                    rid, pos, flag, cigar = parse_record(record)
+                    if max(reference_end(pos, cigar), pos + 1) <= beg:
+                        continue
+                    pos = beg
+                if pos // window != current:
+                    if sampler is not None:
+                        flush(sampler)
+                        while len(out) >= BGZF_BLOCK_SIZE:
+                            yield compress_block(bytes(out[:BGZF_BLOCK_SIZE]))
+                            del out[:BGZF_BLOCK_SIZE]
+                    current = pos // window
+                    sampler = ReservoirL(depth, '{}:{}:{}'.format(seed, ref_id, current))
+                sampler.add((order, record))
+        if sampler is not None:
+            flush(sampler)
+    for i in range(0, len(out), BGZF_BLOCK_SIZE):
+        yield compress_block(bytes(out[i:i + BGZF_BLOCK_SIZE]))
+    yield BGZF_EOF
+
+
+def slice_bam(bam, out, regions):
+    '''Writes the alignments of bam, a sorted BAM with a .bai, that overlap
+    the (reference name, beg, end) regions to out, with the same header and
+    its own out + '.bai'. An alignment overlapping several regions is written
+    once; regions on references the BAM lacks are ignored. Returns the number
+    of alignments written.
+    '''
+    with BgzfReader(bam) as reader:
+        text, refs = read_bam_header(reader)
+    names = [name for name, length in refs]
+    bai = read_bai(bam + '.bai')
+    written = 0
+    with BgzfReader(bam) as reader, BgzfWriter(out + '.tmp') as writer:
+        writer.write(pack_header(text, refs))
+        last = -1
+        for name, beg, end in merge_regions(regions, names):
+            ref_id = names.index(name)
+            start = query_start(bai[ref_id], beg, end) if ref_id < len(bai) else None
+            if start is None:
+                continue
+            reader.seek(start)
+            for vbeg, vend, record in iter_records(reader):
+                rid, pos = struct.unpack_from('<ii', record)
+                if rid != ref_id or pos >= end:
+                    break
+                if vbeg <= last:
+                    continue
+                if pos < beg:
+                    rid, pos, flag, cigar = parse_record(record)
+                    if max(reference_end(pos, cigar), pos + 1) <= beg:
+                        continue
+                last = vbeg
+                writer.write(struct.pack('<i', len(record)) + record)
+                written += 1
+    os.replace(out + '.tmp', out)
+    write_bai(out)
+    return written
@@ -0,0 +1,236 @@
+# Load test for the igv_web.py server: replays igv.js-like range request
+# traces from concurrent clients against synthetic track files.
+
+import sys
+import argparse
+import datetime
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MB = 1024 * 1024
+
+
+def get_opt():
+    # get all arguments
+    arguments = argparse.ArgumentParser(description="Replay igv.js range request patterns against igv_web.py "
+        "and report latency percentiles and throughput")
+    arguments.add_argument("-c", "--clients", default=16, type=int, help="concurrent clients [default: 16]")
+    arguments.add_argument("-d", "--duration", default=20, type=float, help="seconds to run [default: 20]")
+    arguments.add_argument("-e", "--engine", default="thread", choices=["thread", "asyncio"], help="server \
+        engine to start [default: thread]")
+    arguments.add_argument("-a", "--server-args", default="", help="extra igv_web.py server options, \
+        given with an equals sign, e.g. -a=\"-cs 0 -ns\"")
+    arguments.add_argument("-u", "--url", help="benchmark a server that is already running at this URL \
+        instead of starting one; the track files must be served from its root")
+    arguments.add_argument("-D", "--dir", help="directory of the synthetic track files, created if needed \
+        and reused between runs [default: a temporary directory]")
+    arguments.add_argument("-t", "--tracks", default=4, type=int, help="number of BAM and bigWig files \
+        [default: 4]")
+    arguments.add_argument("-bs", "--bam-size", default=256, type=int, help="size of each BAM in MB \
+        [default: 256]")
+    arguments.add_argument("-ws", "--bigwig-size", default=64, type=int, help="size of each bigWig in MB \
+        [default: 64]")
+    arguments.add_argument("-s", "--seed", default=1, type=int, help="random seed of the traces [default: 1]")
+    arguments.add_argument("-p", "--port", default=8899, type=int, help="port of the started server \
+        [default: 8899]")
+    arguments.add_argument("-o", "--output", help="append the results as one JSON line to this file")
+    arguments.add_argument("-j", "--json", action="store_true", help="print the results as JSON only")
+    return arguments.parse_args()
+
+
+def make_tracks(directory, tracks, bam_size, bigwig_size):
+    # synthetic files of realistic sizes; the server never parses them, only the sizes matter
+    os.makedirs(directory, exist_ok=True)
+    block = os.urandom(MB)
+    files = []
+    for i in range(tracks):
+        for name, size in (("sample%d.bam" % i, bam_size * MB), ("sample%d.bam.bai" % i, max(MB, bam_size * MB // 128)),
+                           ("sample%d.bw" % i, bigwig_size * MB)):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path) or os.path.getsize(path) != size:
+                with open(path, "wb") as f:
+                    for offset in range(0, size, MB):
+                        f.write(block[:min(MB, size - offset)])
+            files.append((name, size))
+    return dict(files)
+
+
+def start_server(directory, port, engine, extra):
+    # igv_web.py in its own process, serving directory with its own command line
+    command = [sys.executable, os.path.join(HERE, "igv_web.py"), "-p", str(port), "-e", engine] + extra.split()
+    server = subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("HEAD", "/")
+            conn.getresponse().read()
+            conn.close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("igv_web.py did not start on port {}".format(port))
+
+
+def session(rng, files):
+    '''Yields (kind, path, first, last) requests of one igv.js session: the
+    index and header of a BAM and a bigWig, then clustered data ranges while
+    the user pans and zooms, with now and then a jump to another locus.
+    '''
+    bams = sorted(name for name in files if name.endswith(".bam"))
+    bam = rng.choice(bams)
+    bigwig = bam[:-4] + ".bw"
+    yield "index", bam + ".bai", 0, files[bam + ".bai"] - 1
+    yield "header", bam, 0, 65535
+    yield "header", bigwig, 0, 65535
+    position = rng.randrange(files[bam])
+    while True:
+        if rng.random() < 0.1:
+            position = rng.randrange(files[bam])
+        else:
+            position = min(files[bam] - 1, max(0, position + int(rng.gauss(0, 256 * 1024))))
+        # chunk sizes of a BAM query: mostly a few hundred kB, sometimes several MB
+        size = int(min(8 * MB, rng.lognormvariate(12.5, 1.0)))
+        yield "chunk", bam, position, min(files[bam] - 1, position + size)
+        zoom = rng.randrange(files[bigwig] - 65536)
+        yield "bigwig", bigwig, zoom, zoom + int(rng.uniform(4096, 65536))
+
+
+def client(host, port, files, seed, deadline, results):
+    # one keep-alive connection replaying sessions until the deadline
+    rng = random.Random(seed)
+    conn = http.client.HTTPConnection(host, port, timeout=60)
+    samples = []
+    try:
+        while time.time() < deadline:
+            for step, (kind, path, first, last) in enumerate(session(rng, files)):
+                if time.time() >= deadline or step > rng.randrange(20, 200):
+                    break
+                started = time.perf_counter()
+                try:
+                    conn.request("GET", "/" + path, headers={"Range": "bytes=%d-%d" % (first, last)})
+                    response = conn.getresponse()
+                    size = 0
+                    while True:
+                        data = response.read(256 * 1024)
+                        if not data:
+                            break
+                        size += len(data)
+                    ok = response.status == 206 and size == last - first + 1
+                except (OSError, http.client.HTTPException):
+                    conn.close()
+                    ok, size = False, 0
+                samples.append((kind, time.perf_counter() - started, size, ok))
+    finally:
+        conn.close()
+        results.extend(samples)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(samples, elapsed):
+    # latency percentiles in ms and throughput, overall and per request kind
+    def stats(subset):
+        latencies = [latency for kind, latency, size, ok in subset if ok]
+        sent = sum(size for kind, latency, size, ok in subset)
+        return {
+            "requests": len(subset),
+            "errors": sum(1 for sample in subset if not sample[3]),
+            "p50_ms": round(1000 * percentile(latencies, 0.50), 3),
+            "p95_ms": round(1000 * percentile(latencies, 0.95), 3),
+            "p99_ms": round(1000 * percentile(latencies, 0.99), 3),
+            "requests_per_s": round(len(subset) / elapsed, 1),
+            "mb_per_s": round(sent / MB / elapsed, 2),
+        }
+    result = stats(samples)
+    result["by_kind"] = {kind: stats([sample for sample in samples if sample[0] == kind])
+                         for kind in sorted(set(sample[0] for sample in samples))}
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    opts = get_opt()
+    directory = opts.dir or tempfile.mkdtemp(prefix="igv_bench_")
+    files = make_tracks(directory, opts.tracks, opts.bam_size, opts.bigwig_size)
+    server = None
+    if opts.url:
+        parts = urllib.parse.urlsplit(opts.url)
+        host, port = parts.hostname, parts.port or 80
+    else:
+        host, port = "127.0.0.1", opts.port
+        server = start_server(directory, port, opts.engine, opts.server_args)
+    try:
+        results = []
+        started = time.time()
+        deadline = started + opts.duration
+        threads = [threading.Thread(target=client, args=(host, port, files, opts.seed * 1000 + i, deadline, results))
+                   for i in range(opts.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "engine": None if opts.url else opts.engine,
+        "server_args": opts.server_args,
+        "url": opts.url,
+        "clients": opts.clients,
+        "duration_s": round(elapsed, 2),
+        "tracks": opts.tracks,
+        "bam_mb": opts.bam_size,
+        "bigwig_mb": opts.bigwig_size,
+        "seed": opts.seed,
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+    }
+    report.update(summarize(results, elapsed))
+    if opts.output:
+        with open(opts.output, "a") as out:
+            out.write(json.dumps(report, sort_keys=True) + "\n")
+    if opts.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+        return
+    print("{} clients, {:.1f}s, engine {}{}".format(opts.clients, elapsed, report["engine"] or opts.url,
+                                                     " " + opts.server_args if opts.server_args else ""))
+    print("{:<8} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+        "kind", "requests", "errors", "p50 ms", "p95 ms", "p99 ms", "req/s", "MB/s"))
+    for kind, stats in [("all", report)] + sorted(report["by_kind"].items()):
+        print("{:<8} {:>9} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f} {:>9.2f}".format(
+            kind, stats["requests"], stats["errors"], stats["p50_ms"], stats["p95_ms"], stats["p99_ms"],
+            stats["requests_per_s"], stats["mb_per_s"]))
+
+
+if __name__ == "__main__":
+    main()
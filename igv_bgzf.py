@@ -0,0 +1,517 @@
+# BGZF compression, tabix indexing and slicing for the annotation tracks of igv_web.py.
+
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from itertools import chain, count, islice
+
+# BGZF blocks hold at most 64 KiB; 0xff00 leaves room for incompressible data
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_HEADER = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# tabix presets: (format, col_seq, col_beg, col_end, meta char, skip)
+# format 0 is generic 1-based closed, 0x10000 marks UCSC 0-based half-open
+TABIX_PRESETS = {
+    'gff': (0, 1, 4, 5, '#', 0),
+    'bed': (0x10000, 1, 2, 3, '#', 0),
+}
+
+# the binning scheme shared by tabix and BAI: 16 kb windows, 5 levels
+LINEAR_SHIFT = 14
+# pseudo-bin holding the (begin, end) offsets and mapped/unmapped counts of a reference
+PSEUDO_BIN = 37450
+
+
+class BgzfWriter(object):
+    """Writes a BGZF file and reports virtual offsets for the index builders.
+
+    tell() returns the virtual offset (compressed block start << 16 | offset
+    in the uncompressed block) at which the next write will start.
+    """
+    def __init__(self, path, level=6):
+        self.file = open(path, 'wb')
+        self.level = level
+        self.buf = bytearray()
+        self.coffset = 0
+
+    def write(self, data):
+        while data:
+            space = BGZF_BLOCK_SIZE - len(self.buf)
+            self.buf += data[:space]
+            data = data[space:]
+            if len(self.buf) >= BGZF_BLOCK_SIZE:
+                self.flush()
+
+    def tell(self):
+        return (self.coffset << 16) | len(self.buf)
+
+    def flush(self):
+        if not self.buf:
+            return
+        block = compress_block(bytes(self.buf), self.level)
+        self.file.write(block)
+        self.coffset += len(block)
+        self.buf = bytearray()
+
+    def close(self):
+        self.flush()
+        self.file.write(BGZF_EOF)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BgzfReader(object):
+    """Random access to a BGZF file through virtual offsets.
+
+    Keeps only the current block in memory, so whole files can be streamed
+    with read() or scanned line by line with readline().
+    """
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.block_start = 0
+        self.block_end = 0
+        self.block = b''
+        self.pos = 0
+
+    def load_block(self, coffset):
+        self.file.seek(coffset)
+        self.block_start = coffset
+        self.block, size = read_block(self.file)
+        self.block_end = coffset + size
+        self.pos = 0
+
+    def seek(self, voffset):
+        coffset, within = voffset >> 16, voffset & 0xffff
+        if coffset != self.block_start or not self.block_end:
+            self.load_block(coffset)
+        self.pos = within
+
+    def tell(self):
+        if self.pos >= len(self.block) and self.block_end:
+            return self.block_end << 16
+        return (self.block_start << 16) | self.pos
+
+    def read(self, size):
+        out = bytearray()
+        while len(out) < size:
+            if self.pos >= len(self.block):
+                if not self.next_block():
+                    break
+                continue
+            chunk = self.block[self.pos:self.pos + size - len(out)]
+            self.pos += len(chunk)
+            out += chunk
+        return bytes(out)
+
+    def readline(self):
+        out = bytearray()
+        while True:
+            if self.pos >= len(self.block):
+                if not self.next_block():
+                    break
+                continue
+            end = self.block.find(b'\n', self.pos)
+            if end >= 0:
+                out += self.block[self.pos:end + 1]
+                self.pos = end + 1
+                break
+            out += self.block[self.pos:]
+            self.pos = len(self.block)
+        return bytes(out)
+
+    def next_block(self):
+        # skips empty blocks, such as the EOF marker; False at end of file
+        while True:
+            self.file.seek(self.block_end)
+            block, size = read_block(self.file)
+            if size == 0:
+                return False
+            self.block_start, self.block_end = self.block_end, self.block_end + size
+            self.block, self.pos = block, 0
+            if block:
+                return True
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def compress_block(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    bsize = len(BGZF_HEADER) + 2 + len(cdata) + 8
+    return (BGZF_HEADER + struct.pack('<H', bsize - 1) + cdata
+            + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+def read_block(f):
+    '''Returns (uncompressed data, compressed size) of the block at the
+    current position of f, or (b'', 0) at end of file.
+    '''
+    header = f.read(18)
+    if len(header) < 18:
+        return b'', 0
+    if header[:4] != b'\x1f\x8b\x08\x04' or header[12:14] != b'BC':
+        raise ValueError('Not a BGZF block at offset %d' % (f.tell() - len(header)))
+    bsize = struct.unpack('<H', header[16:18])[0] + 1
+    rest = f.read(bsize - 18)
+    return zlib.decompress(rest[:-8], -15), bsize
+
+
+def is_bgzf(path):
+    with open(path, 'rb') as f:
+        header = f.read(18)
+    return len(header) == 18 and header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
+
+def bgzf_blocks(path):
+    '''(compressed offset, uncompressed offset) of every non-empty block,
+    read from the block headers and size footers without decompressing.
+    '''
+    blocks = []
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        coffset, uoffset = 0, 0
+        while coffset + 18 <= len(mm):
+            if mm[coffset:coffset + 4] != b'\x1f\x8b\x08\x04' or mm[coffset + 12:coffset + 14] != b'BC':
+                raise ValueError('Not a BGZF block at offset %d' % coffset)
+            bsize, = struct.unpack_from('<H', mm, coffset + 16)
+            isize, = struct.unpack_from('<I', mm, coffset + bsize - 3)
+            if isize:
+                blocks.append((coffset, uoffset))
+            coffset += bsize + 1
+            uoffset += isize
+    return blocks
+
+
+def reg2bin(beg, end):
+    '''Bin of the 0-based half-open interval [beg, end) in the BAI/tabix scheme.'''
+    end -= 1
+    if beg >> 14 == end >> 14: return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17: return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20: return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23: return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26: return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+def reg2bins(beg, end):
+    '''All bins that may hold records overlapping [beg, end).'''
+    end -= 1
+    bins = [0]
+    for offset, shift in ((1, 26), (9, 23), (73, 20), (585, 17), (4681, 14)):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+class BinningIndex(object):
+    """Bins, chunks and the 16 kb linear index of one reference sequence,
+    filled record by record in coordinate order.
+    """
+    def __init__(self):
+        self.bins = {}
+        self.linear = []
+
+    def add(self, beg, end, vbeg, vend):
+        end = max(end, beg + 1)
+        chunks = self.bins.setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == vbeg:
+            chunks[-1][1] = vend
+        else:
+            chunks.append([vbeg, vend])
+        first, last = beg >> LINEAR_SHIFT, (end - 1) >> LINEAR_SHIFT
+        if len(self.linear) <= last:
+            self.linear.extend([None] * (last + 1 - len(self.linear)))
+        for window in range(first, last + 1):
+            if self.linear[window] is None:
+                self.linear[window] = vbeg
+
+    def merge(self, other):
+        # append the index of the records that follow, from a later part of the file
+        for bin_id, chunks in other.bins.items():
+            mine = self.bins.setdefault(bin_id, [])
+            if mine and chunks and mine[-1][1] == chunks[0][0]:
+                mine[-1][1] = chunks[0][1]
+                chunks = chunks[1:]
+            mine.extend(chunks)
+        if len(self.linear) < len(other.linear):
+            self.linear.extend([None] * (len(other.linear) - len(self.linear)))
+        for window, voffset in enumerate(other.linear):
+            if self.linear[window] is None:
+                self.linear[window] = voffset
+
+    def pack(self, meta=None):
+        # meta: BAI pseudo-bin chunks [(begin, end), (mapped, unmapped)]
+        out = [struct.pack('<i', len(self.bins) + (meta is not None))]
+        for bin_id in sorted(self.bins):
+            chunks = self.bins[bin_id]
+            out.append(struct.pack('<Ii', bin_id, len(chunks)))
+            out.extend(struct.pack('<QQ', vbeg, vend) for vbeg, vend in chunks)
+        if meta is not None:
+            out.append(struct.pack('<Ii', PSEUDO_BIN, len(meta)))
+            out.extend(struct.pack('<QQ', *chunk) for chunk in meta)
+        # empty windows point at the closest record before them
+        linear, previous = [], 0
+        for voffset in self.linear:
+            previous = previous if voffset is None else voffset
+            linear.append(previous)
+        out.append(struct.pack('<i', len(linear)))
+        out.append(struct.pack('<%dQ' % len(linear), *linear))
+        return b''.join(out)
+
+
+def read_binning_index(data, offset, n_ref):
+    '''Parses n_ref per-reference indexes of a BAI or tabix file from data at
+    offset. Returns ([{'bins', 'linear', 'meta'}, ...], offset after them):
+    'bins' maps bin -> [(begin, end), ...] chunk voffsets, 'linear' is the
+    16 kb linear index and 'meta' holds the pseudo-bin chunks, if any.
+    '''
+    refs = []
+    for _ in range(n_ref):
+        n_bin, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        bins, meta = {}, None
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, offset)
+            offset += 8
+            chunks = list(zip(*[iter(struct.unpack_from('<%dQ' % (2 * n_chunk), data, offset))] * 2))
+            offset += 16 * n_chunk
+            if bin_id == PSEUDO_BIN:
+                meta = chunks
+            else:
+                bins[bin_id] = chunks
+        n_intv, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        linear = list(struct.unpack_from('<%dQ' % n_intv, data, offset))
+        offset += 8 * n_intv
+        refs.append({'bins': bins, 'linear': linear, 'meta': meta})
+    return refs, offset
+
+
+def query_start(index_ref, beg, end):
+    '''Virtual offset from which a sorted, indexed file holds every record of
+    one reference overlapping [beg, end), or None when the index has none.
+    '''
+    linear = index_ref['linear']
+    window = beg >> LINEAR_SHIFT
+    if window >= len(linear):
+        return None
+    floor = linear[window]
+    begins = [begin for bin_id in reg2bins(beg, end) for begin, stop in index_ref['bins'].get(bin_id, ())
+              if stop > floor]
+    return max(floor, min(begins)) if begins else None
+
+
+def merge_regions(regions, order=None):
+    '''Sorts (name, beg, end) regions and merges those that overlap or touch.
+    Names are ordered by order, a list of names, when given (regions on other
+    names are dropped), else alphabetically.
+    '''
+    rank = {name: i for i, name in enumerate(order)} if order is not None else None
+    merged = []
+    for name, beg, end in sorted((region for region in regions if rank is None or region[0] in rank),
+                                 key=lambda region: (rank[region[0]] if rank else region[0], region[1])):
+        if merged and merged[-1][0] == name and beg <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], end)
+        else:
+            merged.append([name, beg, end])
+    return [tuple(region) for region in merged]
+
+
+def write_tabix(path, names, indexes, preset):
+    fmt, col_seq, col_beg, col_end, meta, skip = preset
+    names_blob = b''.join(name.encode() + b'\0' for name in names)
+    with BgzfWriter(path) as out:
+        out.write(b'TBI\1' + struct.pack('<i', len(names)))
+        out.write(struct.pack('<7i', fmt, col_seq, col_beg, col_end, ord(meta), skip, len(names_blob)))
+        out.write(names_blob)
+        for name in names:
+            out.write(indexes[name].pack())
+
+
+def sorted_lines(lines, key, run_bytes=64 * 1024 * 1024):
+    '''Sort an iterable of lines with bounded memory: runs of about run_bytes
+    are sorted in memory and spilled to temporary files, then merged.
+    '''
+    with tempfile.TemporaryDirectory(prefix='igv_sort_') as tmp:
+        runs, run, size = [], [], 0
+        for line in lines:
+            run.append(line)
+            size += len(line)
+            if size >= run_bytes:
+                runs.append(spill_run(tmp, len(runs), sorted(run, key=key)))
+                run, size = [], 0
+        if not runs:
+            yield from sorted(run, key=key)
+            return
+        runs.append(spill_run(tmp, len(runs), sorted(run, key=key)))
+        files = [open(run_path, 'rb') for run_path in runs]
+        try:
+            yield from heapq.merge(*files, key=key)
+        finally:
+            for f in files:
+                f.close()
+
+
+def spill_run(tmp, n, lines):
+    path = os.path.join(tmp, 'run%d' % n)
+    with open(path, 'wb') as f:
+        f.writelines(lines)
+    return path
+
+
+def open_text(path):
+    # plain or (b)gzip-compressed input, read as bytes lines
+    import gzip
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    return gzip.open(path, 'rb') if magic == b'\x1f\x8b' else open(path, 'rb')
+
+
+def bgzip_tabix(src, dst, preset='gff', run_bytes=64 * 1024 * 1024):
+    '''Sort src by position, write it BGZF-compressed to dst and index it as
+    dst + '.tbi', all in one streaming pass with bounded memory.
+
+    Header lines (meta lines, and BED 'track'/'browser' lines which become
+    the tabix skip count) are kept at the top in their original order.
+    '''
+    fmt, col_seq, col_beg, col_end, meta, skip = TABIX_PRESETS[preset]
+    zero_based = bool(fmt & 0x10000)
+    meta_prefix = meta.encode()
+    seq_i, beg_i, end_i = col_seq - 1, col_beg - 1, col_end - 1
+    split_n = max(seq_i, beg_i, end_i) + 1
+
+    def coords(line):
+        fields = line.rstrip(b'\r\n').split(b'\t', split_n)
+        try:
+            beg = int(fields[beg_i]) - (0 if zero_based else 1)
+            end = int(fields[end_i]) if len(fields) > end_i else beg + 1
+        except (IndexError, ValueError):
+            raise ValueError('%s: cannot parse position in line %r' % (src, line[:200]))
+        return fields[seq_i], beg, end
+
+    header, skip_lines = [], []
+    def records(f):
+        for line in f:
+            if not line.strip():
+                continue
+            if line.startswith(meta_prefix):
+                header.append(line)
+            elif line.startswith((b'track', b'browser')) and zero_based:
+                skip_lines.append(line)
+            else:
+                yield line if line.endswith(b'\n') else line + b'\n'
+
+    tmp = dst + '.tmp'
+    names, indexes = [], {}
+    try:
+        with open_text(src) as f:
+            lines = sorted_lines(records(f), key=lambda line: coords(line)[:2], run_bytes=run_bytes)
+            # sorting drains the input, so the header is complete once the first record is out
+            first = list(islice(lines, 1))
+            with BgzfWriter(tmp) as out:
+                out.write(b''.join(skip_lines + header))
+                for line in chain(first, lines):
+                    seq, beg, end = coords(line)
+                    name = seq.decode()
+                    if name not in indexes:
+                        names.append(name)
+                        indexes[name] = BinningIndex()
+                    vbeg = out.tell()
+                    out.write(line)
+                    indexes[name].add(beg, end, vbeg, out.tell())
+        preset_fields = (fmt, col_seq, col_beg, col_end, meta, len(skip_lines))
+        write_tabix(dst + '.tbi.tmp', names, indexes, preset_fields)
+        os.replace(tmp, dst)
+        os.replace(dst + '.tbi.tmp', dst + '.tbi')
+    finally:
+        # left only when writing failed
+        for path in (tmp, dst + '.tbi.tmp'):
+            if os.path.exists(path):
+                os.remove(path)
+    return dst
+
+
+
+def read_tabix(path):
+    '''Reads a .tbi index into (preset fields as in TABIX_PRESETS, sequence
+    names, {name: index as from read_binning_index}).
+    '''
+    import gzip
+    with open(path, 'rb') as f:
+        data = gzip.decompress(f.read())
+    if data[:4] != b'TBI\1':
+        raise ValueError('{} is not a tabix index'.format(path))
+    n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm = struct.unpack_from('<8i', data, 4)
+    names = [name.decode() for name in data[36:36 + l_nm].split(b'\0')[:n_ref]]
+    refs, offset = read_binning_index(data, 36 + l_nm, n_ref)
+    return (fmt, col_seq, col_beg, col_end, chr(meta), skip), names, dict(zip(names, refs))
+
+
+def slice_tabix(src, dst, regions):
+    '''Writes the header lines of src, a bgzipped file with a .tbi, and its
+    records overlapping the (name, beg, end) regions to dst, indexed as
+    dst + '.tbi'. A record overlapping several regions is written once.
+    Returns the number of records written.
+    '''
+    preset, names, refs = read_tabix(src + '.tbi')
+    fmt, col_seq, col_beg, col_end, meta, skip = preset
+    zero_based = bool(fmt & 0x10000)
+    meta_prefix = meta.encode()
+    seq_i, beg_i, end_i = col_seq - 1, col_beg - 1, col_end - 1
+
+    tmp = dst + '.tmp'
+    out_names, indexes, records = [], {}, 0
+    with BgzfReader(src) as reader, BgzfWriter(tmp) as out:
+        for n in count():
+            line = reader.readline()
+            if not line or not (n < skip or line.startswith(meta_prefix)):
+                break
+            out.write(line)
+        last = -1
+        for name, beg, end in merge_regions(regions, names):
+            start = query_start(refs[name], beg, end)
+            if start is None:
+                continue
+            reader.seek(start)
+            while True:
+                vbeg = reader.tell()
+                line = reader.readline()
+                if not line:
+                    break
+                if not line.strip() or line.startswith(meta_prefix):
+                    continue
+                fields = line.rstrip(b'\r\n').split(b'\t')
+                if fields[seq_i].decode() != name:
+                    break
+                rbeg = int(fields[beg_i]) - (0 if zero_based else 1)
+                rend = int(fields[end_i]) if col_end and len(fields) > end_i else rbeg + 1
+                if rbeg >= end:
+                    break
+                if rend <= beg or vbeg <= last:
+                    continue
+                last = vbeg
+                if name not in indexes:
+                    out_names.append(name)
+                    indexes[name] = BinningIndex()
+                voffset = out.tell()
+                out.write(line if line.endswith(b'\n') else line + b'\n')
+                indexes[name].add(rbeg, rend, voffset, out.tell())
+                records += 1
+    write_tabix(dst + '.tbi.tmp', out_names, indexes, preset)
+    os.replace(tmp, dst)
+    os.replace(dst + '.tbi.tmp', dst + '.tbi')
+    return records
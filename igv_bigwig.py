@@ -0,0 +1,393 @@
+# A streaming bigWig writer for the coverage tracks of igv_web.py, and a
+# reader for cutting regions out of bigWigs.
+
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+from igv_bgzf import merge_regions
+
+BIGWIG_MAGIC = 0x888FFC26
+BPT_MAGIC = 0x78CA8C91
+CIR_TREE_MAGIC = 0x2468ACE0
+ITEMS_PER_SLOT = 1024
+BLOCK_SIZE = 256
+MAX_ZOOM_LEVELS = 10
+ZOOM_FACTOR = 4
+
+ITEM = struct.Struct('<IIf')
+SECTION_HEADER = struct.Struct('<IIIIIBBH')
+ZOOM_RECORD = struct.Struct('<IIIIffff')
+
+
+class ZoomLevel(object):
+    """Summary records (count, min, max, sum, sum of squares) of one zoom
+    level, spooled to a temporary file as they are completed.
+
+    Levels are chained: each finished record is handed to the next, coarser
+    level, so every level costs a quarter of the one below it.
+    """
+    def __init__(self, reduction, coarser=None):
+        self.reduction = reduction
+        self.coarser = coarser
+        self.spool = tempfile.TemporaryFile()
+        self.count = 0
+        self.current = None
+        self.chrom_size = 0
+
+    def add_item(self, chrom_id, chrom_size, start, end, value):
+        # split a constant-value item over the bins it covers
+        self.chrom_size = chrom_size
+        while start < end:
+            current = self.current
+            if current is None or current[0] != chrom_id or start >= current[2]:
+                self.finish()
+                bin_start = start - start % self.reduction
+                current = self.current = [chrom_id, bin_start, min(bin_start + self.reduction, chrom_size),
+                                          0, value, value, 0.0, 0.0]
+            stop = min(end, current[2])
+            bases = stop - start
+            current[3] += bases
+            current[4] = min(current[4], value)
+            current[5] = max(current[5], value)
+            current[6] += value * bases
+            current[7] += value * value * bases
+            start = stop
+
+    def add_record(self, chrom_id, chrom_size, start, end, count, low, high, total, squares):
+        self.chrom_size = chrom_size
+        current = self.current
+        if current is None or current[0] != chrom_id or start >= current[2]:
+            self.finish()
+            bin_start = start - start % self.reduction
+            current = self.current = [chrom_id, bin_start, min(bin_start + self.reduction, chrom_size),
+                                      0, low, high, 0.0, 0.0]
+        current[3] += count
+        current[4] = min(current[4], low)
+        current[5] = max(current[5], high)
+        current[6] += total
+        current[7] += squares
+
+    def finish(self):
+        if self.current is None:
+            return
+        self.spool.write(ZOOM_RECORD.pack(*self.current))
+        self.count += 1
+        if self.coarser:
+            self.coarser.add_record(self.current[0], self.chrom_size, *self.current[1:])
+        self.current = None
+
+
+def write_bigwig(path, chroms, resolution):
+    '''Writes a bigWig from chroms, a list of (name, size, item file) where
+    each item file holds packed (start, end, value) bedGraph items sorted by
+    start. Zoom levels start at ZOOM_FACTOR * resolution and grow by
+    ZOOM_FACTOR until they cover the largest chromosome.
+    '''
+    chroms = sorted(chroms)
+    largest = max([size for name, size, items in chroms] or [1])
+    reductions = []
+    reduction = resolution * ZOOM_FACTOR
+    while len(reductions) < MAX_ZOOM_LEVELS and reduction < largest * ZOOM_FACTOR:
+        reductions.append(reduction)
+        reduction *= ZOOM_FACTOR
+    levels = []
+    for reduction in reversed(reductions):
+        levels.insert(0, ZoomLevel(reduction, levels[0] if levels else None))
+
+    with open(path, 'wb') as f:
+        f.write(b'\0' * (64 + 24 * len(levels)))
+        summary_offset = f.tell()
+        f.write(b'\0' * 40)
+        chrom_tree_offset = f.tell()
+        write_chrom_tree(f, [(name.encode(), i, size) for i, (name, size, items) in enumerate(chroms)])
+
+        # full resolution data: sections of up to ITEMS_PER_SLOT items of one chromosome
+        data_offset = f.tell()
+        f.write(struct.pack('<Q', 0))
+        sections, max_buf = [], 0
+        covered, low, high, total, squares = 0, float('inf'), float('-inf'), 0.0, 0.0
+        for chrom_id, (name, size, items) in enumerate(chroms):
+            with open(items, 'rb') as src:
+                while True:
+                    raw = src.read(ITEM.size * ITEMS_PER_SLOT)
+                    if not raw:
+                        break
+                    batch = list(ITEM.iter_unpack(raw))
+                    for start, end, value in batch:
+                        bases = end - start
+                        covered += bases
+                        low, high = min(low, value), max(high, value)
+                        total += value * bases
+                        squares += value * value * bases
+                        if levels:
+                            levels[0].add_item(chrom_id, size, start, end, value)
+                    block = SECTION_HEADER.pack(chrom_id, batch[0][0], batch[-1][1], 0, 0, 1, 0, len(batch)) + raw
+                    max_buf = max(max_buf, len(block))
+                    offset = f.tell()
+                    f.write(zlib.compress(block))
+                    sections.append((chrom_id, batch[0][0], chrom_id, batch[-1][1], offset, f.tell() - offset))
+            for level in levels:
+                level.finish()
+        index_offset = f.tell()
+        f.seek(data_offset)
+        f.write(struct.pack('<Q', len(sections)))
+        f.seek(index_offset)
+        write_rtree(f, sections, index_offset)
+
+        zoom_headers = []
+        for level in levels:
+            zoom_offset = f.tell()
+            f.write(struct.pack('<I', level.count))
+            blocks = []
+            level.spool.seek(0)
+            while True:
+                raw = level.spool.read(ZOOM_RECORD.size * ITEMS_PER_SLOT)
+                if not raw:
+                    break
+                records = list(ZOOM_RECORD.iter_unpack(raw))
+                max_buf = max(max_buf, len(raw))
+                offset = f.tell()
+                f.write(zlib.compress(raw))
+                blocks.append((records[0][0], records[0][1], records[-1][0], records[-1][2],
+                               offset, f.tell() - offset))
+            level.spool.close()
+            zoom_index = f.tell()
+            write_rtree(f, blocks, zoom_index)
+            zoom_headers.append(struct.pack('<IIQQ', level.reduction, 0, zoom_offset, zoom_index))
+
+        f.write(struct.pack('<I', BIGWIG_MAGIC))
+        f.seek(0)
+        f.write(struct.pack('<IHHQQQHHQQIQ', BIGWIG_MAGIC, 4, len(levels), chrom_tree_offset, data_offset,
+                            index_offset, 0, 0, 0, summary_offset, max_buf, 0))
+        f.write(b''.join(zoom_headers))
+        if not covered:
+            low = high = 0.0
+        f.write(struct.pack('<Qdddd', covered, low, high, total, squares))
+    return path
+
+
+def write_chrom_tree(f, chroms):
+    '''B+ tree of (name, id, size) written root first, nodes padded to the
+    block size as UCSC tools expect.
+    '''
+    chroms = sorted(chroms)
+    key_size = max([len(name) for name, chrom_id, size in chroms] or [1])
+    block_size = max(1, min(BLOCK_SIZE, len(chroms)))
+    f.write(struct.pack('<IIIIQQ', BPT_MAGIC, block_size, key_size, 8, len(chroms), 0))
+    node_size = 4 + block_size * (key_size + 8)
+
+    # levels from the leaves up; every node is a list of (key, payload)
+    levels = [[chroms[i:i + block_size] for i in range(0, len(chroms), block_size)] or [[]]]
+    while len(levels[-1]) > 1:
+        levels.append([levels[-1][i:i + block_size] for i in range(0, len(levels[-1]), block_size)])
+    levels.reverse()
+
+    offset = f.tell()
+    starts = []
+    for level in levels:
+        starts.append(offset)
+        offset += node_size * len(level)
+    for depth, level in enumerate(levels):
+        leaf = depth == len(levels) - 1
+        for i, node in enumerate(level):
+            out = [struct.pack('<BBH', leaf, 0, len(node))]
+            for j, item in enumerate(node):
+                if leaf:
+                    name, chrom_id, size = item
+                    out.append(name.ljust(key_size, b'\0') + struct.pack('<II', chrom_id, size))
+                else:
+                    child = i * block_size + j
+                    key = first_key(item)
+                    out.append(key.ljust(key_size, b'\0') + struct.pack('<Q', starts[depth + 1] + child * node_size))
+            out.append(b'\0' * ((block_size - len(node)) * (key_size + 8)))
+            f.write(b''.join(out))
+
+
+def first_key(node):
+    while isinstance(node, list):
+        node = node[0]
+    return node[0]
+
+
+def write_rtree(f, entries, index_offset):
+    '''R tree over (start chrom, start, end chrom, end, offset, size) entries
+    sorted by position, written root first at index_offset.
+    '''
+    block_size = BLOCK_SIZE
+    if entries:
+        bounds = (entries[0][0], entries[0][1], entries[-1][2], entries[-1][3])
+    else:
+        bounds = (0, 0, 0, 0)
+    end_offset = entries[-1][4] + entries[-1][5] if entries else index_offset
+    f.write(struct.pack('<IIQIIIIQII', CIR_TREE_MAGIC, block_size, len(entries),
+                        bounds[0], bounds[1], bounds[2], bounds[3], end_offset, ITEMS_PER_SLOT, 0))
+
+    levels = [[entries[i:i + block_size] for i in range(0, len(entries), block_size)] or [[]]]
+    while len(levels[-1]) > 1:
+        levels.append([levels[-1][i:i + block_size] for i in range(0, len(levels[-1]), block_size)])
+    levels.reverse()
+
+    leaf_size = 4 + block_size * 32
+    node_size = 4 + block_size * 24
+    offset = f.tell()
+    starts = []
+    for depth, level in enumerate(levels):
+        starts.append(offset)
+        offset += (leaf_size if depth == len(levels) - 1 else node_size) * len(level)
+    for depth, level in enumerate(levels):
+        leaf = depth == len(levels) - 1
+        for i, node in enumerate(level):
+            out = [struct.pack('<BBH', leaf, 0, len(node))]
+            for j, item in enumerate(node):
+                if leaf:
+                    out.append(struct.pack('<IIIIQQ', *item))
+                else:
+                    child = i * block_size + j
+                    child_size = leaf_size if depth + 1 == len(levels) - 1 else node_size
+                    lo, hi = node_bounds(item)
+                    out.append(struct.pack('<IIIIQ', lo[0], lo[1], hi[0], hi[1],
+                                           starts[depth + 1] + child * child_size))
+            out.append(b'\0' * ((block_size - len(node)) * (32 if leaf else 24)))
+            f.write(b''.join(out))
+
+
+def node_bounds(node):
+    first = last = node
+    while isinstance(first, list):
+        first, last = first[0], last[-1]
+    return (first[0], first[1]), (last[2], last[3])
+
+
+class BigWigReader(object):
+    """Reads the chromosome list of a bigWig and its full resolution data
+    overlapping a region, through the chromosome B+ tree and the R tree
+    index. Files of either byte order are read.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        try:
+            header = self.file.read(64)
+            if len(header) < 64:
+                raise ValueError('{} is not a bigWig file'.format(path))
+            for self.order in '<>':
+                if struct.unpack(self.order + 'I', header[:4])[0] == BIGWIG_MAGIC:
+                    break
+            else:
+                raise ValueError('{} is not a bigWig file'.format(path))
+            (magic, version, zoom_levels, chrom_tree_offset, data_offset, self.index_offset, field_count,
+             defined_field_count, auto_sql_offset, summary_offset, self.uncompress_buf_size,
+             reserved) = struct.unpack(self.order + 'IHHQQQHHQQIQ', header)
+            self.chroms = self.read_chrom_tree(chrom_tree_offset)
+        except BaseException:
+            self.file.close()
+            raise
+
+    def unpack(self, fmt, offset):
+        fmt = struct.Struct(self.order + fmt)
+        self.file.seek(offset)
+        return fmt.unpack(self.file.read(fmt.size))
+
+    def read_chrom_tree(self, offset):
+        # {name: (chrom id, size)}, from a walk of every node
+        magic, block_size, key_size, val_size, count, reserved = self.unpack('IIIIQQ', offset)
+        if magic != BPT_MAGIC:
+            raise ValueError('bad chromosome tree in {}'.format(self.file.name))
+        chroms, nodes = {}, [offset + 32]
+        while nodes:
+            node = nodes.pop()
+            leaf, reserved, n = self.unpack('BBH', node)
+            item = struct.Struct(self.order + '%ds%s' % (key_size, 'II' if leaf else 'Q'))
+            data = self.file.read(item.size * n)
+            for fields in item.iter_unpack(data):
+                if leaf:
+                    chroms[fields[0].rstrip(b'\0').decode()] = (fields[1], fields[2])
+                else:
+                    nodes.append(fields[1])
+        return chroms
+
+    def blocks(self, chrom_id, beg, end):
+        # (offset, size) of the data sections overlapping [beg, end) of a chromosome, in file order
+        found, nodes = [], [self.index_offset + 48]
+        while nodes:
+            node = nodes.pop()
+            leaf, reserved, n = self.unpack('BBH', node)
+            item = struct.Struct(self.order + ('IIIIQQ' if leaf else 'IIIIQ'))
+            data = self.file.read(item.size * n)
+            for fields in item.iter_unpack(data):
+                if (fields[0], fields[1]) < (chrom_id, end) and (fields[2], fields[3]) > (chrom_id, beg):
+                    if leaf:
+                        found.append((fields[4], fields[5]))
+                    else:
+                        nodes.append(fields[4])
+        return sorted(found)
+
+    def intervals(self, name, beg, end):
+        '''Yields the (start, end, value) items of chromosome name that
+        overlap [beg, end), by start; none for an unknown chromosome.
+        '''
+        if name not in self.chroms:
+            return
+        chrom_id = self.chroms[name][0]
+        header = struct.Struct(self.order + 'IIIIIBBH')
+        for offset, size in self.blocks(chrom_id, beg, end):
+            self.file.seek(offset)
+            data = self.file.read(size)
+            if self.uncompress_buf_size:
+                data = zlib.decompress(data)
+            section_chrom, start, stop, step, span, kind, reserved, n = header.unpack_from(data)
+            if section_chrom != chrom_id:
+                continue
+            if kind == 1:
+                items = struct.iter_unpack(self.order + 'IIf', data[header.size:header.size + 12 * n])
+            elif kind == 2:
+                items = ((item_start, item_start + span, value) for item_start, value in
+                         struct.iter_unpack(self.order + 'If', data[header.size:header.size + 8 * n]))
+            elif kind == 3:
+                items = ((start + i * step, start + i * step + span, value) for i, (value,) in
+                         enumerate(struct.iter_unpack(self.order + 'f', data[header.size:header.size + 4 * n])))
+            else:
+                raise ValueError('unknown section type {} in {}'.format(kind, self.file.name))
+            for item_start, item_end, value in items:
+                if item_end > beg and item_start < end:
+                    yield item_start, item_end, value
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def slice_bigwig(src, dst, regions):
+    '''Writes a bigWig of the data of src within the (chromosome, beg, end)
+    regions to dst, with zoom levels of its own. Items are cut at the region
+    edges; the chromosomes of the regions keep their sizes. Returns the
+    number of items written.
+    '''
+    tmp = tempfile.mkdtemp(prefix='igv_bw_')
+    try:
+        with BigWigReader(src) as reader:
+            chroms, resolution, written = [], None, 0
+            regions = merge_regions(regions, sorted(reader.chroms))
+            for name in sorted(set(region[0] for region in regions)):
+                items = os.path.join(tmp, '%d.items' % len(chroms))
+                with open(items, 'wb') as out:
+                    for region_name, beg, end in regions:
+                        if region_name != name:
+                            continue
+                        for start, stop, value in reader.intervals(name, beg, end):
+                            resolution = min(resolution or stop - start, stop - start)
+                            out.write(ITEM.pack(max(start, beg), min(stop, end), value))
+                            written += 1
+                chroms.append((name, reader.chroms[name][1], items))
+        write_bigwig(dst + '.tmp', chroms, max(1, resolution or 1))
+        os.replace(dst + '.tmp', dst)
+    finally:
+        shutil.rmtree(tmp)
+    return written
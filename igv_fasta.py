@@ -0,0 +1,269 @@
+# FASTA indexing (.fai, and .gzi for bgzipped FASTA) and region extraction
+# for igv_web.py.
+
+import mmap
+import os
+import struct
+from bisect import bisect_right
+
+from igv_bgzf import BgzfWriter, bgzf_blocks, is_bgzf, merge_regions, read_block
+
+# uncompressed bytes scanned per task; tasks only hold their own chunk in memory
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+class LineSummary(object):
+    """Line layout of a run of sequence lines: the first and last line, the
+    number of lines and bases, and whether the lines before the last all have
+    the width of the first. Runs of one record split over several chunks are
+    joined with extend().
+    """
+    __slots__ = ('lines', 'first_width', 'first_bases', 'last_width', 'last_bases',
+                 'bases', 'uniform', 'blank_tail')
+
+    def __init__(self, data, start, end):
+        # trailing blank lines are allowed at the end of a record only
+        stop = end
+        while stop > start and data[stop - 1] in b'\r\n':
+            stop -= 1
+        self.lines = data.count(b'\n', start, stop) + 1 if stop > start else 0
+        self.blank_tail = data.count(b'\n', stop, end) > (1 if self.lines else 0)
+        self.uniform = True
+        if not self.lines:
+            self.first_width = self.first_bases = self.last_width = self.last_bases = self.bases = 0
+            return
+        newline = 2 if data[stop:stop + 2] == b'\r\n' else 1 if data[stop:stop + 1] == b'\n' else 0
+        first_end = data.find(b'\n', start, stop)
+        last_start = data.rfind(b'\n', start, stop) + 1 or start
+        self.last_bases = stop - last_start
+        self.last_width = self.last_bases + newline
+        if first_end < 0:
+            self.first_width, self.first_bases = self.last_width, self.last_bases
+            self.bases = self.last_bases
+            return
+        width = first_end - start + 1
+        crlf = data[first_end - 1:first_end] == b'\r'
+        self.first_width, self.first_bases = width, width - 1 - crlf
+        # the other newlines are exactly where equal lines put them
+        full = self.lines - 1
+        self.uniform = (last_start == start + full * width and self.last_bases <= self.first_bases
+                        and data[start + width - 1:last_start:width] == b'\n' * full
+                        and (not crlf or data[start + width - 2:last_start:width] == b'\r' * full))
+        self.bases = full * self.first_bases + self.last_bases
+
+    def extend(self, other):
+        if not other.lines:
+            self.blank_tail = self.blank_tail or other.blank_tail
+            return
+        if not self.lines:
+            # nothing but blank lines so far: they came before the sequence
+            blank = self.blank_tail
+            for name in self.__slots__:
+                setattr(self, name, getattr(other, name))
+            self.uniform = other.uniform and not blank
+            return
+        self.uniform = (self.uniform and other.uniform and not self.blank_tail
+                        and self.last_width == self.first_width and self.last_bases == self.first_bases
+                        and (other.first_width == self.first_width and other.first_bases == self.first_bases
+                             or other.lines == 1 and other.last_bases <= self.first_bases))
+        self.lines += other.lines
+        self.last_width, self.last_bases = other.last_width, other.last_bases
+        self.bases += other.bases
+        self.blank_tail = other.blank_tail
+
+
+def scan_chunk(data, offset):
+    '''Splits data, whole lines of a FASTA file starting at uncompressed
+    offset, into records. Returns [(name, sequence offset, LineSummary), ...]
+    where a leading run of sequence continuing the previous chunk's record
+    has None as name.
+    '''
+    records = []
+    pos = 0
+    if not data.startswith(b'>'):
+        end = data.find(b'\n>') + 1 or len(data)
+        records.append((None, None, LineSummary(data, 0, end)))
+        pos = end
+    while pos < len(data):
+        eol = data.find(b'\n', pos)
+        eol = len(data) if eol < 0 else eol
+        name = data[pos + 1:eol].split(None, 1)
+        if not name:
+            raise ValueError('empty sequence name at offset %d' % (offset + pos))
+        end = data.find(b'\n>', eol) + 1 or len(data)
+        seq = min(eol + 1, len(data))
+        records.append((name[0].decode(), offset + seq, LineSummary(data, seq, end)))
+        pos = end
+    return records
+
+
+def scan_plain(path, start, end):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return scan_chunk(mm[start:end], start)
+
+
+def scan_bgzf(path, blocks, last):
+    '''Scans the lines starting within the given (compressed, uncompressed)
+    offset blocks; the line running past the last block is read to its end
+    from the blocks that follow, unless last.
+    '''
+    start = blocks[0][1]
+    data = bytearray()
+    with open(path, 'rb') as f:
+        f.seek(blocks[0][0])
+        for _ in blocks:
+            data += read_block(f)[0]
+        own = len(data)
+        while not last and data.find(b'\n', own) < 0:
+            block, size = read_block(f)
+            if not size:
+                break
+            data += block
+    # chunks are cut after the first newline at or past their nominal start
+    begin = data.find(b'\n') + 1 if start else 0
+    end = len(data) if last else data.find(b'\n', own) + 1 or len(data)
+    if start and not begin or begin >= end:
+        return []
+    return scan_chunk(bytes(data[begin:end]), start + begin)
+
+
+def stitch(chunks):
+    # join records split over chunks, in file order
+    records, seen = [], set()
+    for chunk in chunks:
+        for name, offset, lines in chunk:
+            if name is None:
+                if records:
+                    records[-1][2].extend(lines)
+                elif lines.lines:
+                    raise ValueError('sequence before the first header, not a FASTA file')
+                continue
+            if name in seen:
+                raise ValueError('duplicate sequence name {}'.format(name))
+            seen.add(name)
+            records.append((name, offset, lines))
+    for name, offset, lines in records:
+        if not lines.uniform:
+            raise ValueError('different line lengths in sequence {}'.format(name))
+    return records
+
+
+def faidx(fasta, executor=None, chunk_size=CHUNK_SIZE):
+    '''Writes fasta + '.fai', and fasta + '.gzi' when fasta is bgzipped.
+
+    The file is split into chunks of about chunk_size bytes which are scanned
+    by executor, if given, and joined at record boundaries. Index files are
+    written next to fasta under a temporary name and renamed into place.
+    '''
+    if is_bgzf(fasta):
+        blocks = bgzf_blocks(fasta)
+        per_chunk = max(1, chunk_size // 0xff00)
+        groups = [blocks[i:i + per_chunk] for i in range(0, len(blocks), per_chunk)]
+        tasks = [(scan_bgzf, fasta, group, i == len(groups) - 1) for i, group in enumerate(groups)]
+    else:
+        size = os.path.getsize(fasta)
+        bounds = [0]
+        with open(fasta, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for nominal in range(chunk_size, size, chunk_size):
+                cut = mm.find(b'\n', max(nominal, bounds[-1])) + 1
+                if not cut or cut >= size:
+                    break
+                bounds.append(cut)
+        bounds.append(size)
+        blocks = None
+        tasks = [(scan_plain, fasta, bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+    if executor and len(tasks) > 1:
+        chunks = [task.result() for task in [executor.submit(*args) for args in tasks]]
+    else:
+        chunks = [args[0](*args[1:]) for args in tasks]
+    records = stitch(chunks)
+
+    with open(fasta + '.fai.tmp', 'w') as out:
+        for name, offset, lines in records:
+            # samtools leaves empty sequences out as well
+            if not lines.bases:
+                continue
+            out.write('%s\t%d\t%d\t%d\t%d\n' % (name, lines.bases, offset, lines.first_bases, lines.first_width))
+    if blocks is not None:
+        with open(fasta + '.gzi.tmp', 'wb') as out:
+            out.write(struct.pack('<Q', len(blocks) - 1))
+            out.write(b''.join(struct.pack('<QQ', *block) for block in blocks[1:]))
+        os.replace(fasta + '.gzi.tmp', fasta + '.gzi')
+    os.replace(fasta + '.fai.tmp', fasta + '.fai')
+    return fasta + '.fai'
+
+
+def read_fai(path):
+    '''{name: (length, offset, line bases, line width)} of a .fai, in file order.'''
+    entries = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) >= 5:
+                entries[fields[0]] = tuple(int(field) for field in fields[1:5])
+    return entries
+
+
+def fetch(fasta, entry, beg, end, blocks=None):
+    '''Bases [beg, end) of the sequence with the .fai entry, without line
+    breaks. blocks are the bgzf_blocks() of a bgzipped fasta.
+    '''
+    length, offset, line_bases, line_width = entry
+    end = min(end, length)
+    if beg >= end:
+        return b''
+    first = offset + beg // line_bases * line_width + beg % line_bases
+    last = offset + (end - 1) // line_bases * line_width + (end - 1) % line_bases + 1
+    with open(fasta, 'rb') as f:
+        if blocks is None:
+            f.seek(first)
+            data = f.read(last - first)
+        else:
+            i = bisect_right([uoffset for coffset, uoffset in blocks], first) - 1
+            f.seek(blocks[i][0])
+            data, start = bytearray(), blocks[i][1]
+            while start + len(data) < last:
+                block, size = read_block(f)
+                if not size:
+                    break
+                data += block
+            data = bytes(data[first - start:last - start])
+    return data.replace(b'\n', b'').replace(b'\r', b'')
+
+
+def write_masked_fasta(dst, lengths, regions, read, line_bases=60):
+    '''Writes the sequences the (name, beg, end) regions are on, at their
+    full lengths from lengths, as a bgzipped FASTA to dst with its .fai and
+    .gzi. Bases inside the regions come from read(name, beg, end), those
+    outside are N, so coordinates are kept while the masked runs compress to
+    almost nothing. Returns the number of bases kept.
+    '''
+    regions = merge_regions(regions, list(lengths))
+    kept = 0
+    with BgzfWriter(dst + '.tmp') as out:
+        for name in sorted(set(region[0] for region in regions), key=list(lengths).index):
+            length = lengths[name]
+            own = [(beg, min(end, length)) for region_name, beg, end in regions if region_name == name]
+            out.write(b'>' + name.encode() + b'\n')
+            step = line_bases * 4096
+            for start in range(0, length, step):
+                stop = min(start + step, length)
+                seq = bytearray(b'N' * (stop - start))
+                for beg, end in own:
+                    if beg < stop and end > start:
+                        bases = read(name, max(beg, start), min(end, stop))
+                        seq[max(beg, start) - start:max(beg, start) - start + len(bases)] = bases
+                        kept += len(bases)
+                out.write(b'\n'.join(seq[i:i + line_bases] for i in range(0, len(seq), line_bases)) + b'\n')
+    os.replace(dst + '.tmp', dst)
+    faidx(dst)
+    return kept
+
+
+def mask_fasta(fasta, dst, regions):
+    '''write_masked_fasta() of the sequences of fasta, which has a .fai.'''
+    entries = read_fai(fasta + '.fai')
+    blocks = bgzf_blocks(fasta) if is_bgzf(fasta) else None
+    return write_masked_fasta(dst, {name: entry[0] for name, entry in entries.items()}, regions,
+                              lambda name, beg, end: fetch(fasta, entries[name], beg, end, blocks))
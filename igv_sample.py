@@ -0,0 +1,163 @@
+# Reservoir sampling of large streams for igv_web.py.
+
+import heapq
+import itertools
+import random
+from math import exp, expm1, floor, log, log1p
+
+import numpy as np
+
+# keys drawn per step by the vectorized samplers; bounds their temporary memory
+CHUNK_SIZE = 1 << 20
+
+
+def algorithm_r(iterable, n, seed=None):
+    '''Uniform sample of n items of iterable, one random number per item.
+    The reference the faster samplers are checked against.
+    '''
+    rng = random.Random(seed)
+    iterable = iter(iterable)
+    reservoir = list(itertools.islice(iterable, n))
+    for t, x in enumerate(iterable, n + 1):
+        m = rng.randrange(t)
+        if m < n:
+            reservoir[m] = x
+    return reservoir
+
+
+class PrioritySampler(object):
+    """Keeps the n items with the smallest random keys, in a heap with the
+    largest key on top (method 4 without the argmax per replacement).
+
+    A key is an exponential variate divided by the item's weight, so the
+    sample is uniform with equal weights and follows Efraimidis-Spirakis
+    weighted sampling otherwise. Keys are independent of the order the items
+    come in, so samplers of separate partitions can be merged into a sample
+    of the whole.
+    """
+    def __init__(self, n, seed=None):
+        if n < 1:
+            raise ValueError('sample size must be positive')
+        self.n = n
+        self.rng = np.random.default_rng(seed)
+        self.random = random.Random(seed)
+        self.heap = []
+        self.counter = itertools.count()
+        self.seen = 0
+
+    def offer(self, key, item):
+        heap = self.heap
+        if len(heap) < self.n:
+            heapq.heappush(heap, (-key, next(self.counter), item))
+        elif key < -heap[0][0]:
+            heapq.heapreplace(heap, (-key, next(self.counter), item))
+
+    def add(self, item, weight=1.0):
+        if weight < 0:
+            raise ValueError('negative weight {}'.format(weight))
+        self.seen += 1
+        if weight:
+            self.offer(self.random.expovariate(1.0) / weight, item)
+
+    def extend(self, items, weights=None):
+        '''Adds a NumPy array (or any sequence indexable by arrays) of items.
+        Keys are drawn and compared chunk by chunk; only the few items that
+        beat the current largest key reach the heap.
+        '''
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float)
+            if len(weights) != len(items):
+                raise ValueError('{} weights for {} items'.format(len(weights), len(items)))
+            if (weights < 0).any():
+                raise ValueError('negative weights')
+        for start in range(0, len(items), CHUNK_SIZE):
+            chunk = items[start:start + CHUNK_SIZE]
+            self.seen += len(chunk)
+            full = len(self.heap) == self.n
+            if weights is None:
+                # uniform draws; the exponential key -log(1 - u) only for the few
+                # below the largest key, which is where u < 1 - exp(-key)
+                u = self.rng.random(len(chunk))
+                candidates = np.flatnonzero(u < -expm1(self.heap[0][0])) if full else np.arange(len(chunk))
+                keys = -np.log1p(-u[candidates])
+            else:
+                keys = self.rng.standard_exponential(len(chunk))
+                with np.errstate(divide='ignore'):
+                    keys /= weights[start:start + CHUNK_SIZE]
+                candidates = np.flatnonzero(keys < (-self.heap[0][0] if full else np.inf))
+                keys = keys[candidates]
+            if len(candidates) > self.n:
+                smallest = np.argpartition(keys, self.n - 1)[:self.n]
+                candidates, keys = candidates[smallest], keys[smallest]
+            for i, key in zip(candidates.tolist(), keys.tolist()):
+                self.offer(key, chunk[i])
+
+    def merge(self, other):
+        '''Adds the sample of other, drawn from a disjoint part of the stream.'''
+        for key, _, item in other.heap:
+            self.offer(-key, item)
+        self.seen += other.seen
+        return self
+
+    def sample(self):
+        # by ascending key: any prefix is itself a sample
+        return [item for key, _, item in sorted(self.heap, reverse=True)]
+
+
+class ReservoirL(object):
+    """Uniform sample of n items by Algorithm L: the number of items to skip
+    before the next replacement is drawn directly, so extend() only touches
+    the items that enter the reservoir, about n * log(N / n) of N.
+    """
+    def __init__(self, n, seed=None):
+        if n < 1:
+            raise ValueError('sample size must be positive')
+        self.n = n
+        self.random = random.Random(seed)
+        self.reservoir = []
+        self.seen = 0
+        self.w = exp(log(self.uniform()) / n)
+        # stream index of the next item to enter the reservoir
+        self.next = n + self.skip()
+
+    def uniform(self):
+        # in (0, 1], so that log() is defined
+        return 1.0 - self.random.random()
+
+    def skip(self):
+        if self.w <= 0.0:
+            return float('inf')
+        return floor(log(self.uniform()) / log1p(-self.w))
+
+    def extend(self, items):
+        '''Adds a sliceable run of items (a NumPy array, list, ...).'''
+        start = self.seen
+        self.seen += len(items)
+        if len(self.reservoir) < self.n:
+            self.reservoir.extend(items[:self.n - len(self.reservoir)])
+        n, reservoir, randrange = self.n, self.reservoir, self.random.randrange
+        while self.next < self.seen:
+            reservoir[randrange(n)] = items[self.next - start]
+            self.w *= exp(log(self.uniform()) / n)
+            self.next += 1 + self.skip()
+
+    def add(self, item):
+        self.extend((item,))
+
+    def sample(self):
+        return list(self.reservoir)
+
+
+def sample(items, n, weights=None, seed=None):
+    '''Sample of n items of a NumPy array or sequence, weighted if weights
+    are given; all items when there are no more than n and no weights.
+    '''
+    if weights is None and len(items) <= n:
+        return list(items)
+    if weights is None:
+        sampler = ReservoirL(n, seed)
+        sampler.extend(items)
+    else:
+        sampler = PrioritySampler(n, seed)
+        sampler.extend(items, weights)
+    return sampler.sample()
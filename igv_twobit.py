@@ -0,0 +1,179 @@
+# UCSC .2bit reference sequences for igv_web.py: conversion from FASTA and
+# decoding of regions straight from a memory-mapped file.
+
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+from igv_bgzf import bgzf_blocks, is_bgzf
+from igv_fasta import fetch, read_fai, write_masked_fasta
+
+TWOBIT_MAGIC = 0x1A412743
+# bases read per step while packing a sequence; a multiple of 4
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# 2-bit codes in the order of the format; other letters are packed as T and listed as N blocks
+BASES = b'TCAG'
+CODES = np.full(256, 4, np.uint8)
+for code, base in enumerate(BASES):
+    CODES[base] = CODES[base | 0x20] = code
+# the four upper-case bases packed in each byte value, first base in the high bits
+LETTERS = np.frombuffer(BASES, np.uint8)[(np.arange(256)[:, None] >> np.array([6, 4, 2, 0])) & 3]
+
+
+def runs(mask, offset=0):
+    '''(starts, ends) of the runs of True in a boolean array, offset added.'''
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.view(np.int8), [0]))))
+    return edges[0::2] + offset, edges[1::2] + offset
+
+
+def join_runs(parts):
+    # concatenate runs found chunk by chunk, merging those that meet at a chunk edge
+    starts = np.concatenate([part[0] for part in parts] or [np.zeros(0, np.int64)])
+    ends = np.concatenate([part[1] for part in parts] or [np.zeros(0, np.int64)])
+    if len(starts) < 2:
+        return starts, ends
+    apart = starts[1:] != ends[:-1]
+    return starts[np.concatenate(([True], apart))], ends[np.concatenate((apart, [True]))]
+
+
+def pack_sequence(fasta, entry, blocks, out):
+    '''Writes the .2bit record of one sequence of fasta, given its .fai
+    entry, to out: its size, the N and lower-case run tables and the bases
+    at 2 bits each. The packed bases are spooled next to out while the
+    tables are collected. Returns the size of the record.
+    '''
+    size = entry[0]
+    n_parts, mask_parts = [], []
+    with open(out + '.dna', 'wb') as dna:
+        for start in range(0, size, CHUNK_SIZE):
+            bases = np.frombuffer(fetch(fasta, entry, start, min(start + CHUNK_SIZE, size), blocks), np.uint8)
+            codes = CODES[bases]
+            n_parts.append(runs(codes == 4, start))
+            mask_parts.append(runs(bases >= ord('a'), start))
+            codes[codes == 4] = 0
+            codes = np.concatenate((codes, np.zeros(-len(codes) % 4, np.uint8))).reshape(-1, 4)
+            dna.write((codes[:, 0] << 6 | codes[:, 1] << 4 | codes[:, 2] << 2 | codes[:, 3]).astype(np.uint8))
+    with open(out, 'wb') as f:
+        f.write(struct.pack('<I', size))
+        for starts, ends in (join_runs(n_parts), join_runs(mask_parts)):
+            f.write(struct.pack('<I', len(starts)))
+            f.write(starts.astype('<u4').tobytes())
+            f.write((ends - starts).astype('<u4').tobytes())
+        f.write(struct.pack('<I', 0))
+        with open(out + '.dna', 'rb') as dna:
+            shutil.copyfileobj(dna, f)
+    os.remove(out + '.dna')
+    return os.path.getsize(out)
+
+
+def fasta_to_twobit(fasta, out, executor=None):
+    '''Converts fasta, plain or bgzipped with its .fai, to a .2bit at out.
+    Sequences are packed by executor, if given, in parallel; the records are
+    then joined behind the index under a temporary name and renamed.
+    '''
+    entries = read_fai(fasta + '.fai')
+    blocks = bgzf_blocks(fasta) if is_bgzf(fasta) else None
+    tmp = tempfile.mkdtemp(prefix='igv_2bit_', dir=os.path.dirname(os.path.abspath(out)))
+    try:
+        parts = [os.path.join(tmp, '%d' % i) for i in range(len(entries))]
+        args = [(fasta, entry, blocks, part) for entry, part in zip(entries.values(), parts)]
+        if executor and len(args) > 1:
+            sizes = [task.result() for task in [executor.submit(pack_sequence, *arg) for arg in args]]
+        else:
+            sizes = [pack_sequence(*arg) for arg in args]
+        names = [name.encode() for name in entries]
+        index_size = 16 + sum(1 + len(name) + 4 for name in names)
+        # version 1 has 64-bit record offsets, for files past 4 GB
+        version = 1 if index_size + sum(sizes) + 4 * len(names) > 0xffffffff else 0
+        offset = index_size + 4 * len(names) * version
+        with open(out + '.tmp', 'wb') as f:
+            f.write(struct.pack('<IIII', TWOBIT_MAGIC, version, len(names), 0))
+            for name, size in zip(names, sizes):
+                f.write(struct.pack('<B', len(name)) + name + struct.pack('<Q' if version else '<I', offset))
+                offset += size
+            for part in parts:
+                with open(part, 'rb') as src:
+                    shutil.copyfileobj(src, f)
+        os.replace(out + '.tmp', out)
+    finally:
+        shutil.rmtree(tmp)
+    return out
+
+
+def read_index(buf):
+    '''Reads the index of a .2bit held in buf (bytes or a mapping) into
+    (byte order, {sequence name: record offset}).
+    '''
+    for order in '<>':
+        if struct.unpack_from(order + 'I', buf)[0] == TWOBIT_MAGIC:
+            break
+    else:
+        raise ValueError('not a .2bit file')
+    version, count = struct.unpack_from(order + 'II', buf, 4)
+    index, pos = {}, 16
+    for _ in range(count):
+        size = buf[pos]
+        name = bytes(buf[pos + 1:pos + 1 + size]).decode()
+        index[name], = struct.unpack_from(order + ('Q' if version else 'I'), buf, pos + 1 + size)
+        pos += 1 + size + (8 if version else 4)
+    return order, index
+
+
+def overlapping(buf, order, pos, beg, end):
+    '''Marks the runs of the run table at pos of buf that overlap [beg, end)
+    in a boolean array of end - beg; returns it and the position after the
+    table. The table is searched in place, as runs are sorted and disjoint.
+    '''
+    count, = struct.unpack_from(order + 'I', buf, pos)
+    starts = np.frombuffer(buf, order + 'u4', count, pos + 4)
+    sizes = np.frombuffer(buf, order + 'u4', count, pos + 4 + 4 * count)
+    first = max(int(np.searchsorted(starts, beg, 'right')) - 1, 0)
+    last = int(np.searchsorted(starts, end, 'left'))
+    run_starts = starts[first:last].astype(np.int64)
+    run_ends = np.clip(run_starts + sizes[first:last], beg, end) - beg
+    run_starts = np.clip(run_starts, beg, end) - beg
+    edges = np.zeros(end - beg + 1, np.int32)
+    np.add.at(edges, run_starts, 1)
+    np.add.at(edges, run_ends, -1)
+    return np.cumsum(edges[:-1]) > 0, pos + 4 + 8 * count
+
+
+def decode(buf, order, offset, beg, end, mask=True):
+    '''Bases [beg, end) of the sequence whose record is at offset of a .2bit
+    held in buf, as upper-case letters with N runs, and soft-masked runs in
+    lower case unless mask is False. Only the bytes of the region and the
+    run tables are touched, so a mapped file stays mostly on disk.
+    '''
+    size, = struct.unpack_from(order + 'I', buf, offset)
+    end = min(end, size)
+    if not 0 <= beg < end:
+        raise ValueError('empty interval {}-{} of a sequence of {} bp'.format(beg + 1, end, size))
+    unknown, pos = overlapping(buf, order, offset + 4, beg, end)
+    masked, pos = overlapping(buf, order, pos, beg, end)
+    packed = np.frombuffer(buf, np.uint8, (end - 1) // 4 - beg // 4 + 1, pos + 4 + beg // 4)
+    bases = LETTERS[packed].reshape(-1)[beg % 4:beg % 4 + end - beg]
+    bases[unknown] = ord('N')
+    if mask:
+        bases[masked] |= 0x20
+    return bases.tobytes()
+
+
+def sequence_sizes(path):
+    '''{sequence name: size} of a .2bit file.'''
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        order, index = read_index(buf)
+        return {name: struct.unpack_from(order + 'I', buf, offset)[0] for name, offset in index.items()}
+
+
+def mask_twobit(path, dst, regions):
+    '''igv_fasta.write_masked_fasta() of the sequences of a .2bit file.'''
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        order, index = read_index(buf)
+        sizes = {name: struct.unpack_from(order + 'I', buf, offset)[0] for name, offset in index.items()}
+        return write_masked_fasta(dst, sizes, regions,
+                                  lambda name, beg, end: decode(buf, order, index[name], beg, end))
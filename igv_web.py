@@ -2,10 +2,31 @@
 
 import sys
 import argparse
+import bisect
+import datetime
+import difflib
+import hashlib
+import importlib.util
+import io
+import ipaddress
 import json
-import wget
+import mmap
 import os
 import re
+import shutil
+import signal
+import socket
+import struct
+import threading
+import time
+import traceback
+import types
+import zlib
+import http.client
+import urllib.parse
+from collections import OrderedDict, deque
+from email import utils as email_utils
+from html import escape as html_escape
 from os.path import basename
 from os.path import isfile
 try:
@@ -16,41 +37,242 @@ except ImportError:
     import SimpleHTTPServer
 
 
+def lazy_import(name):
+    # import a module on first attribute access, so that -ab/-rb edits and
+    # plain server starts do not pay for what only some commands use
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    # a normal import binds submodules on their package, later "import a.b" relies on it
+    parent, _, child = name.rpartition(".")
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+asyncio = lazy_import("asyncio")
+csv = lazy_import("csv")
+futures = lazy_import("concurrent.futures")
+glob = lazy_import("glob")
+sqlite3 = lazy_import("sqlite3")
+igv_bam = lazy_import("igv_bam")
+igv_bgzf = lazy_import("igv_bgzf")
+igv_bigwig = lazy_import("igv_bigwig")
+igv_fasta = lazy_import("igv_fasta")
+igv_twobit = lazy_import("igv_twobit")
+urlrequest = lazy_import("urllib.request")
+
+
+BAM_SUFFIXES = (".bam",)
+BIGWIG_SUFFIXES = (".bw", ".bigwig", ".bigWig", ".BigWig")
+SHEET_SUFFIXES = (".tsv", ".csv", ".txt")
+# stat calls on network storage are latency bound, so validate with many threads
+VALIDATION_THREADS = 32
+GENOMES_URL = "https://s3.amazonaws.com/igv.org.genomes/genomes.json"
+GENOMES_TTL = 7 * 24 * 3600
+DEFAULT_ROI = "https://s3.amazonaws.com/igv.org.test/data/roi/roi_bed_1.bed"
+
 def get_opt():
     # get all arguments
     arguments = argparse.ArgumentParser()
-    arguments.add_argument("-r", "--ref", help="load own reference fasta file", required=False)
+    arguments.add_argument("-r", "--ref", help="load own reference fasta file, plain or bgzipped. A missing or \
+        outdated .fai (and .gzi) index is built next to it", required=False)
+    arguments.add_argument("-tb","--twobit", action="store_true", required=False, help="Pack the -r \
+        reference into a .2bit next to it, with its N and lower-case runs, rebuilt when older than the fasta, \
+        and load igv.js from that: a quarter of the bytes per base. Regions of any .2bit in the project are \
+        served as text from /sequence/<file>.2bit?locus=chr:start-end. Packing and /sequence need numpy")
     arguments.add_argument("-rn","--reference", help="enter the reference name, load reference from internet, \
         you can choose one ref from genome.json provided by -gl", required=False)
     arguments.add_argument("-m", "--bam", help="Input mapping file, in1.bam in2.bam ... Besides, \
         only bam files are needed when input arguments, and index files(.bai) should be saved in the \
-        same directory and named as same basename with bam files", required=False, nargs = "*")
-    arguments.add_argument("-w", "--bigwig", help="Input bigwig file, in1.bw in2.bw ...", required=False, nargs = "*")
+        same directory and named as same basename with bam files. Directories, quoted glob patterns \
+        and sample sheets (.tsv/.csv/.txt with a path and an optional name per line) are expanded",
+        required=False, nargs = "*")
+    arguments.add_argument("-w", "--bigwig", help="Input bigwig file, in1.bw in2.bw ... Directories, \
+        quoted glob patterns and sample sheets are expanded as for --bam", required=False, nargs = "*")
     arguments.add_argument("-b", "--bed", help="bed annotation", required=False)
     arguments.add_argument("-g", "--gtf", help="gtf annotation", required=False, nargs = "*")
     arguments.add_argument("-l", "--locus", help="Name of gene or the locus of gene, IGV will automatically \
-        locate to the target location. this function may not support your own reference genome", required=False,
-        default='')
-    arguments.add_argument("-gl", "--genomelist", help="list the reference genomes supported online and \
-        save the genomes.json file", action="store_true",required=False)
+        locate to the target location. this function may not support your own reference genome. Several loci \
+        (chr:start-end, chr or gene names) or BED files of regions open a multi-locus view", required=False,
+        nargs="*", default=[])
+    arguments.add_argument("-ex","--export", metavar="DIR", required=False, help="Write a session bundle of \
+        the loci of -l (or those saved in the project) to DIR and exit: the parts of every track overlapping \
+        them, indexed, a reference masked outside them and an index.html that any static web server can serve")
+    arguments.add_argument("-gl", "--genomelist", help="list the reference genomes supported online, or \
+        search them by id, id prefix or a close spelling. The list is cached in the project", nargs="?",
+        const="", metavar="QUERY", required=False)
+    arguments.add_argument("-rg", "--refresh-genomes", help="download the genome list again instead of using \
+        the cached copy. Without it -gl refreshes a copy older than a week, and starting the server never \
+        downloads it once it is cached", action="store_true", required=False)
     arguments.add_argument("-p","--port", default=8890, type=int, required=False, help='Specify alternate \
         port [default: 8890]')
-    arguments.add_argument("-ab","--addbam", help="Add Bam files when index.html exists.",required=False)
-    arguments.add_argument("-rb","--rmbam", help="remove the bam based on bam_id", required=False)
+    arguments.add_argument("-ab","--addbam", help="Add Bam files when index.html exists. Also accepts a \
+        directory, a quoted glob pattern or a sample sheet. When the project is already being served on \
+        --port, that server adds them (with -ix and -cov) and the open pages show them without a reload; \
+        track and page options such as -m or -l are then refused, as the server cannot apply them",required=False)
+    arguments.add_argument("-rb","--rmbam", help="remove the bam based on bam_id, through the running \
+        server like --addbam", required=False)
+    arguments.add_argument("-cov","--coverage", nargs="?", const=25, type=int, required=False, help="Precompute \
+        a multi-resolution coverage bigWig for every bam and show it above the alignments, optionally \
+        giving the finest bin size in bp [default: 25]")
+    arguments.add_argument("-ix","--index", action="store_true", required=False, help="Build the .bai of \
+        bams that have none or an outdated one, in parallel, instead of skipping them")
     arguments.add_argument("-roi","--ROI", help="Regions of interest, the value of an ROI is an annotation track \
         configuration object, so please input a file.", required=False)
+    arguments.add_argument("-ns","--no-sendfile", help="Disable the zero-copy os.sendfile path and copy \
+        responses through the buffered read/write loop instead.", action="store_true", required=False)
+    arguments.add_argument("-nz","--no-compression", help="Send text assets (index.html, igv.js, BED, ...) \
+        uncompressed instead of gzip or brotli, from precompressed copies in Cache/compressed or compressed \
+        on the fly", action="store_true", required=False)
+    arguments.add_argument("-e","--engine", choices=["thread", "asyncio"], default="thread", required=False,
+        help="Server engine: 'thread' is one HTTP/1.0 thread per connection, 'asyncio' serves persistent \
+        HTTP/1.1 connections from an event loop [default: thread]")
+    arguments.add_argument("-px","--proxy", nargs="?", const=1024, type=int, metavar="MB", required=False,
+        help="Serve remote track, genome and ROI URLs through this server, from an on-disk cache of at most \
+        MB megabytes in Cache/remote. The choice is kept in the project; 0 turns it off [default: 1024 when \
+        given]")
+    arguments.add_argument("-wk","--workers", default=1, type=int, required=False, help="Pre-fork N server \
+        processes sharing the listening socket, restarted when they die; SIGINT or SIGTERM lets them finish \
+        the responses in flight. Caches and /metrics are per worker [default: 1]")
+    arguments.add_argument("-mi","--metrics-interval", default=0, type=float, required=False, help="Print a \
+        summary of requests, bytes, latency and cache hit rates to stderr every N seconds; /metrics is \
+        always served for Prometheus [default: 0, off]")
+    arguments.add_argument("-sl","--slots", default=16, type=int, required=False, help="Most response \
+        bodies sent at once per process. Waiting ones start by priority: indexes and the page, then small \
+        reads such as track headers, then bulk BAM chunks, which never take the last quarter of the slots; \
+        0 sends everything at once [default: 16]")
+    arguments.add_argument("-cc","--client-concurrency", default=0, type=int, required=False, help="Most \
+        response bodies sent at once to one client address [default: 0, no limit]")
+    arguments.add_argument("-cr","--client-rate", default=0, type=float, required=False, metavar="MB/S",
+        help="Most megabytes per second sent to one client address, after a one second burst \
+        [default: 0, no limit]")
+    arguments.add_argument("-of","--open-files", default=64, type=int, required=False, help="Number of files \
+        kept open and memory-mapped between requests, 0 opens every file per request [default: 64]")
+    arguments.add_argument("-ra","--readahead", nargs="?", const=256, default=0, type=int, metavar="MB",
+        required=False, help="Prefetch the BAM blocks next to each requested chunk, found through the .bai, \
+        into at most MB megabytes of memory, so that panning is served from memory. With -wk every worker \
+        has its own MB [default: off, 256 when given]")
+    arguments.add_argument("-cs","--cache-size", default=128, type=int, required=False, help="Size in MB of the \
+        in-memory block cache for index files and track headers, 0 disables it [default: 128]")
 
     return arguments.parse_args()
     # get the terminal arguements behind the command
 
-def build_bam_tracks(bams):
+def expand_inputs(inputs, suffixes):
+    # -m/-w accept files, directories (searched recursively), glob patterns and
+    # sample sheets with a path and an optional track name per line.
+    # Returns the paths in input order and the names given by sample sheets.
+    paths, names = [], {}
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                paths.extend(os.path.join(root, name) for name in sorted(files) if name.endswith(suffixes))
+        elif item.endswith(SHEET_SUFFIXES) and isfile(item):
+            for path, name in read_sample_sheet(item):
+                paths.append(path)
+                if name:
+                    names[path] = name
+        elif re.search(r'[*?[]', item):
+            paths.extend(sorted(path for path in glob.glob(item, recursive=True) if path.endswith(suffixes)))
+        else:
+            paths.append(item)
+    return list(OrderedDict.fromkeys(paths)), names
+
+def read_sample_sheet(sheet):
+    # tab or comma separated; '#' comments and a 'path'/'file' header line are skipped,
+    # relative paths are taken relative to the sheet
+    with open(sheet, newline="") as file:
+        for row in csv.reader(file, delimiter="\t" if sheet.endswith(".tsv") else ","):
+            row = [field.strip() for field in row]
+            if not row or not row[0] or row[0].startswith("#") or row[0].lower() in ("path", "file"):
+                continue
+            yield os.path.join(os.path.dirname(sheet), row[0]), row[1] if len(row) > 1 else None
+
+def check_bam(bam, known=None):
+    # stat the bam and its index; the header is only read for new or changed files
+    fs = os.stat(bam)
+    if not isfile(bam + ".bai"):
+        raise ValueError("{}.bai is not existed, use -ix to build it".format(bam))
+    if os.path.getmtime(bam + ".bai") < fs.st_mtime:
+        raise ValueError("{}.bai is older than the bam, use -ix to rebuild it".format(bam))
+    if known != (fs.st_size, fs.st_mtime):
+        with igv_bgzf.BgzfReader(bam) as reader:
+            if reader.read(4) != b"BAM\1":
+                raise ValueError("not a BAM file")
+        # a bam cut short, by a copy or a crashed writer, lacks the closing empty block
+        with open(bam, "rb") as file:
+            file.seek(max(fs.st_size - len(igv_bgzf.BGZF_EOF), 0))
+            if file.read() != igv_bgzf.BGZF_EOF:
+                raise ValueError("truncated BAM file, the BGZF end-of-file block is missing")
+    return fs.st_size, fs.st_mtime
+
+def check_bigwig(bigwig, known=None):
+    fs = os.stat(bigwig)
+    if known != (fs.st_size, fs.st_mtime):
+        with open(bigwig, "rb") as file:
+            magic = file.read(4)
+        if magic not in (b"\x26\xfc\x8f\x88", b"\x88\x8f\xfc\x26"):
+            raise ValueError("not a bigWig file")
+    return fs.st_size, fs.st_mtime
+
+def validate_inputs(paths, check):
+    # run check on all paths in a thread pool, so that stat calls on network
+    # storage overlap, and report every failure in one summary at the end.
+    # Size and mtime of valid files are recorded so that unchanged files are
+    # not re-read next time. Returns the valid paths.
+    known = get_manifest().files()
+    def run(path):
+        try:
+            return path, check(path, known.get(path)), None
+        except (OSError, ValueError, zlib.error) as e:
+            return path, None, e
+    with futures.ThreadPoolExecutor(VALIDATION_THREADS) as pool:
+        results = list(pool.map(run, paths))
+
+    valid = [(path, stat) for path, stat, error in results if error is None]
+    failed = [(path, error) for path, stat, error in results if error is not None]
+    get_manifest().put_files([(path, size, mtime) for path, (size, mtime) in valid])
+    if failed:
+        print("{} of {} inputs failed validation and were skipped:".format(len(failed), len(results)),
+              file=sys.stderr)
+        for path, error in failed:
+            print("    {}: {}".format(path, error.strerror if isinstance(error, OSError) and error.strerror
+                                      else error), file=sys.stderr)
+    return [path for path, stat in valid]
+
+def index_bams(bams):
+    # write a .bai for every bam that has none or an outdated one. Every bam
+    # is split into chunks of its BGZF block stream and all chunks of all bams
+    # share one process pool.
+    todo = [bam for bam in bams if isfile(bam) and
+            (not isfile(bam + ".bai") or os.path.getmtime(bam + ".bai") < os.path.getmtime(bam))]
+    if not todo:
+        return
+    with futures.ProcessPoolExecutor() as pool, futures.ThreadPoolExecutor(bam_threads(todo)) as threads:
+        jobs = [threads.submit(igv_bam.write_bai, bam, None, pool) for bam in todo]
+        for bam, job in zip(todo, jobs):
+            try:
+                job.result()
+            except BAM_ERRORS as e:
+                # the bam is then reported again, with the other failures, by validate_inputs
+                print("could not index {}: {}".format(bam, e), file=sys.stderr)
+            else:
+                print("{}.bai written".format(bam), file=sys.stderr)
+
+def build_bam_tracks(bams, coverage=None, index=False):
     tracks = []
 
+    bams, names = expand_inputs(bams, BAM_SUFFIXES)
+    if index:
+        index_bams(bams)
+    bams = validate_inputs(bams, check_bam)
     for bam in bams:
-        if not isfile( bam + ".bai"):
-            print("{}.bai is not existed".format(bam), file=sys.stderr)
-            sys.exit()
-        bam_id = basename(bam).replace(".bam","")
+        bam_id = names.get(bam) or basename(bam).replace(".bam","")
 
         # track = """
         # {{
@@ -72,20 +294,66 @@ def build_bam_tracks(bams):
         track["url"] = bam
         track["indexURL"] = bam+".bai"
         
-        # track: dict -> json and save in the Cache
-        track = json.dumps(track, sort_keys=True, indent=4, separators=(',',': '))
-        file = 'Cache/'+bam_id+'.json'
-        with open(file,'w') as file_obj:
-            json.dump(track,file_obj)
+        tracks.append((bam_id, track))
+
+    # track: dict -> manifest in the Cache, the whole batch in one transaction
+    get_manifest().put_many(tracks)
+
+    if coverage:
+        build_coverage_tracks(bams, coverage, names)
+
+# what a broken or truncated bam raises while it is scanned
+BAM_ERRORS = (OSError, ValueError, zlib.error, struct.error)
+
+def bam_threads(todo):
+    # threads feeding per-bam tasks to a shared process pool: one per core
+    # keeps it busy without a thread for every bam of a cohort
+    return min(len(todo), os.cpu_count() or 1)
+
+def build_coverage_tracks(bams, bin_size, names=None):
+    # precompute read depth as a bigWig next to each bam, so that wide views
+    # load zoom levels instead of streaming every read. All bams and their
+    # references are scanned in parallel; bigWigs newer than the bam are reused.
+    # Only the bigWigs that exist afterwards are registered, so a bam that
+    # fails is reported and skipped without stopping the others.
+    todo = []
+    failed = set()
+    for bam in bams:
+        coverage = os.path.splitext(bam)[0] + ".coverage.bw"
+        if not isfile(coverage) or os.path.getmtime(coverage) < os.path.getmtime(bam):
+            todo.append((bam, coverage))
+    if todo:
+        with futures.ProcessPoolExecutor() as pool, futures.ThreadPoolExecutor(bam_threads(todo)) as threads:
+            jobs = [threads.submit(igv_bam.bam_coverage, bam, coverage, bin_size, pool) for bam, coverage in todo]
+            for (bam, coverage), job in zip(todo, jobs):
+                try:
+                    job.result()
+                except BAM_ERRORS as e:
+                    print("could not compute the coverage of {}: {}".format(bam, e), file=sys.stderr)
+                    failed.add(bam)
+                else:
+                    print("coverage of {} written to {}".format(bam, coverage), file=sys.stderr)
 
-    #     tracks.append(track)
-    # tracks = "".join(tracks)[:-1]
-    # return tracks
+    tracks = []
+    for bam in bams:
+        if bam in failed:
+            continue
+        bam_id = (names or {}).get(bam) or basename(bam).replace(".bam","")
+        track = {
+            "name": bam_id + " coverage",
+            "type": "wig",
+            "format": "bigwig",
+            "url": os.path.splitext(bam)[0] + ".coverage.bw",
+        }
+        tracks.append((bam_id + ".coverage", track))
+    get_manifest().put_many(tracks)
 
 def build_bw_tracks(bigwigs):
     tracks = []
+    bigwigs, names = expand_inputs(bigwigs, BIGWIG_SUFFIXES)
+    bigwigs = validate_inputs(bigwigs, check_bigwig)
     for bigwig in bigwigs:
-        bw_id = basename(bigwig).replace(".bw","").replace(".bigwig","").replace(".bigWig","").replace("BigWig","")
+        bw_id = names.get(bigwig) or basename(bigwig).replace(".bw","").replace(".bigwig","").replace(".bigWig","").replace("BigWig","")
         
         # track = """
         # {{
@@ -102,14 +370,9 @@ def build_bw_tracks(bigwigs):
         track["name"] = bw_id
         track["url"] = bigwig
 
-        track = json.dumps(track, sort_keys=True, indent=4, separators=(',',': '))
-        file = 'Cache/'+bw_id+'.json'
-        with open(file,'w') as file_obj:
-            json.dump(track,file_obj)
+        tracks.append((bw_id, track))
 
-    #     tracks.append(track)
-    # tracks = "".join(tracks)[:-1]
-    # return tracks
+    get_manifest().put_many(tracks)
 
 def build_gtf_tracks(gtfs):
     tracks =  [] 
@@ -134,12 +397,11 @@ def build_gtf_tracks(gtfs):
             "displayMode": "COLLAPSED",
             "autoHeight": "true",
         }
-        track["url"] = gtf
+        gtf_gz = index_annotation(gtf, 'gff')
+        track["url"] = gtf_gz
+        track["indexURL"] = gtf_gz + ".tbi"
 
-        track = json.dumps(track, sort_keys=True, indent=4, separators=(',',': '))
-        file = 'Cache/'+gtf+'.json'
-        with open(file,'w') as file_obj:
-            json.dump(track,file_obj)
+        save_track(gtf, track)
 
     #     tracks.append(track)
     # tracks = "".join(tracks)[:-1]	
@@ -167,34 +429,98 @@ def build_bed_tracks(bed):
         "visibilityWindow": 300000000,
         "displayMode": "EXPANDED",
     }
-    track["url"] = bed
-
-    track = json.dumps(track, sort_keys=True, indent=4, separators=(',',': '))
-    file = 'Cache/'+bed+'.json'
-    with open(file,'w') as file_obj:
-        json.dump(track,file_obj)
-
-def build_ref_track(fasta):
+    bed_gz = index_annotation(bed, 'bed')
+    track["url"] = bed_gz
+    track["indexURL"] = bed_gz + ".tbi"
+
+    save_track(bed, track)
+
+ANNOTATION_CACHE = os.path.join("Cache", "annotations")
+
+def index_annotation(annotation, preset):
+    # sort, bgzip and tabix-index a GTF/BED annotation so that igv.js only
+    # fetches the features in view. Outputs newer than the input are reused.
+    # They go next to the input, or into the project cache when its
+    # directory is read-only.
+    if annotation.endswith(".gz") and isfile(annotation + ".tbi"):
+        return annotation
+    root, ext = os.path.splitext(annotation[:-3] if annotation.endswith(".gz") else annotation)
+    indexed = root + ".sorted" + ext + ".gz"
+    if not os.access(os.path.dirname(os.path.abspath(annotation)), os.W_OK):
+        # named after the input's full path, so equal names in other directories do not clash
+        digest = hashlib.sha1(os.path.abspath(annotation).encode("utf-8")).hexdigest()[:8]
+        indexed = os.path.join(ANNOTATION_CACHE, digest + "." + basename(indexed))
+        os.makedirs(ANNOTATION_CACHE, exist_ok=True)
+    if isfile(indexed) and isfile(indexed + ".tbi") and \
+            os.path.getmtime(indexed + ".tbi") >= os.path.getmtime(annotation):
+        return indexed
+    print("indexing {} into {}".format(annotation, indexed), file=sys.stderr)
+    return igv_bgzf.bgzip_tabix(annotation, indexed, preset)
+
+def index_fasta(fasta):
+    # build <fasta>.fai (and .gzi for bgzipped FASTA) when missing or older than fasta
+    compressed = igv_bgzf.is_bgzf(fasta)
+    indexes = [fasta + ".fai"] + ([fasta + ".gzi"] if compressed else [])
+    mtime = os.path.getmtime(fasta)
+    if all(isfile(index) and os.path.getmtime(index) >= mtime for index in indexes):
+        return compressed
+    print("indexing {}".format(fasta), file=sys.stderr)
+    with futures.ProcessPoolExecutor() as pool:
+        igv_fasta.faidx(fasta, pool)
+    return compressed
+
+def pack_fasta(fasta):
+    # write <root>.2bit next to fasta when missing or older than it, one sequence per process
+    twobit = os.path.splitext(fasta[:-3] if fasta.endswith(".gz") else fasta)[0] + ".2bit"
+    if isfile(twobit) and os.path.getmtime(twobit) >= os.path.getmtime(fasta):
+        return twobit
+    if importlib.util.find_spec("numpy") is None:
+        print("-tb needs numpy to pack {}: pip install numpy".format(fasta), file=sys.stderr)
+        sys.exit(1)
+    print("packing {} into {}".format(fasta, twobit), file=sys.stderr)
+    with futures.ProcessPoolExecutor() as pool:
+        return igv_twobit.fasta_to_twobit(fasta, twobit, pool)
+
+def build_ref_track(fasta, twobit=False):
     # build the local reference genome 
-    if not isfile( fasta + ".fai"):
-        print("{}.fai is not existed".format(fasta), file=sys.stderr)
-        sys.exit()
+    if not isfile(fasta):
+        print("{} is not existed".format(fasta), file=sys.stderr)
+        sys.exit(1)
+    try:
+        compressed = index_fasta(fasta)
+        packed = pack_fasta(fasta) if twobit else None
+    except (OSError, ValueError, zlib.error) as e:
+        print("could not index {}: {}".format(fasta, e), file=sys.stderr)
+        sys.exit(1)
 
     genome = basename(fasta)
+    if genome.endswith(".gz"):
+        genome = genome[:-3]
     genome_id = genome.replace(".fasta","").replace(".fas","").replace(".fa","")
 
-    ref_track ="{{ id: \"{genome_id}\",fastaURL: \"{fasta}\", indexURL: \"{fasta}.fai\"}}".format(genome_id = genome_id, fasta = fasta)
-    return ref_track
+    if packed:
+        return json.dumps({"id": genome_id, "twoBitURL": packed})
+    ref_track = {"id": genome_id, "fastaURL": fasta, "indexURL": fasta + ".fai"}
+    if compressed:
+        ref_track["compressedIndexURL"] = fasta + ".gzi"
+    return json.dumps(ref_track)
 
 def build_refn_track(refn):
     # build the reference genome from online source
-    bam_track ="""genome: "{genome}" """.format(genome = refn)
+    bam_track = json.dumps(refn)
     return bam_track
 
 
-def make_html(genome, tracks, locus, roi):
-    # make html file which will be opened as a website.
-    html="""<!DOCTYPE html>
+def make_html(bundle=None):
+    # the page: it fetches the genome and tracks from /api/tracks and follows
+    # /api/events, so the file itself never changes with the tracks. A
+    # session bundle's page carries its track list instead.
+    if bundle is None:
+        return PAGE
+    data = json.dumps(bundle, sort_keys=True).replace("</", "<\\/")
+    return PAGE.replace("var bundled = null;", "var bundled = {};".format(data), 1)
+
+PAGE = """<!DOCTYPE html>
     <html lang="en">
     <head>
         <meta charset="UTF-8">
@@ -221,24 +547,36 @@ def make_html(genome, tracks, locus, roi):
         return null;
     }
     var print = console.log
+    // a session bundle has its tracks written in here and no server to follow
+    var bundled = null;
         window.onload=function(){
+            if (bundled !== null) {
+                createBrowser(bundled);
+                return;
+            }
+            fetch("api/tracks").then(function (response) {
+                return response.json();
+            }).then(function (page) {
+                createBrowser(page);
+            });
+        }
+
+    function createBrowser(page) {
             //console.log(getUrlParam("chr"))
             var chr = getUrlParam("chr")
             print(chr)
             if (chr === null){
-                chr = "{locus}";
+                chr = page.locus;
             }
             var aColors = getUrlParam("colors")
             if (aColors === null){
-                aColors = "{color}";
+                aColors = "";
             }
             print(aColors)
-            var ref = getUrlParam("genome");
-            var refer = {genome}
-            if (ref === null){
-                ref = "";
-            }else{
-                refer = "";
+            // a genome id in the url overrides the project's genome
+            var genome = getUrlParam("genome");
+            if (genome === null){
+                genome = page.genome;
             }
 
         var igvDiv = document.getElementById("igv-div");
@@ -246,50 +584,287 @@ def make_html(genome, tracks, locus, roi):
         var options = {
             showNavigation: true,
             showRuler: true,
-            genome: ref ,
-            reference: refer,
+            genome: genome,
             locus: chr,
             roi:[{
                     name: 'ROI set',
-                    url: '{roi}',
+                    url: page.roi,
                     indexed: false,
                     color: "rgba(68, 134, 247, 0.25)"
             }] ,
-            tracks: [
-                {tracks}
-            ]
+            tracks: []
         };
-            
+
         igv.createBrowser(igvDiv, options)
             .then(function (browser) {
                 console.log("Created IGV browser");
-                }   
-            )   
+                followTracks(browser, page);
+                }
+            )
+        }
+
+    function followTracks(browser, page) {
+        // track id -> {config: its JSON, track: the igv.js track}
+        var loaded = {};
+        var settings = JSON.stringify([page.genome, page.roi]);
+        var version = page.version;
+        var queue = Promise.resolve();
+
+        function apply(page) {
+            // a new genome or ROI needs a new browser; tracks are removed and added in place
+            if (JSON.stringify([page.genome, page.roi]) !== settings) {
+                window.location.reload();
+                return Promise.resolve();
+            }
+            var wanted = {};
+            page.tracks.forEach(function (entry) {
+                wanted[entry.id] = JSON.stringify(entry.config);
+            });
+            Object.keys(loaded).forEach(function (id) {
+                if (wanted[id] !== loaded[id].config) {
+                    browser.removeTrack(loaded[id].track);
+                    delete loaded[id];
+                }
+            });
+            var added = page.tracks.filter(function (entry) {
+                return !(entry.id in loaded);
+            });
+            return browser.loadTrackList(added.map(function (entry) {
+                return entry.config;
+            })).then(function (tracks) {
+                tracks.forEach(function (track, i) {
+                    loaded[added[i].id] = {config: wanted[added[i].id], track: track};
+                });
+            });
         }
-    </script>
-    </html>""".format(tracks = tracks,genome = genome,locus = locus, roi = roi)
 
-    return html
+        queue = apply(page);
+        if (bundled !== null) {
+            return;
+        }
+        var events = new EventSource("api/events");
+        events.addEventListener("tracks", function (event) {
+            var next = JSON.parse(event.data);
+            if (next.version === version) {
+                return;
+            }
+            version = next.version;
+            queue = queue.then(function () {
+                return apply(next);
+            }, function () {
+                return apply(next);
+            });
+        });
+    }
+    </script>
+    </html>"""
 
 def write_html(html):
-    # write whole content into html file.
-    with open("index.html", "w") as file:
+    # write whole content into html file, replacing it atomically; an unchanged page is left alone.
+    if isfile("index.html"):
+        with open("index.html") as file:
+            if file.read() == html:
+                return
+    with open("index.html.tmp", "w") as file:
         file.writelines(html)
+    os.replace("index.html.tmp", "index.html")
 
-def igv_web(fasta, bams, bws, bed, gtfs, locus, refn, roi):
+# settings the page shows; changing one is announced on /api/events
+PAGE_SETTINGS = frozenset(("genome", "locus", "roi", "proxy"))
+
+class TrackManifest(object):
+    """Tracks and page settings of a project, kept in one SQLite file.
+
+    Tracks are keyed by id and carry an insertion sequence for display
+    order, so adding, removing or looking up a track is one indexed
+    statement, and every change is an atomic transaction.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS tracks "
+                            "(id TEXT PRIMARY KEY, seq INTEGER NOT NULL, config TEXT NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS tracks_seq ON tracks (seq)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS genomes (id TEXT PRIMARY KEY, config TEXT NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS files "
+                            "(path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL)")
+
+    def bump(self):
+        # count a change of the page in its own transaction, for the browsers following /api/events
+        self.db.execute("INSERT INTO settings (key, value) VALUES ('version', '1') "
+                        "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+
+    def version(self):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM settings WHERE key = 'version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def put(self, track_id, track):
+        self.put_many([(track_id, track)])
+
+    def put_many(self, tracks):
+        # re-registering an id replaces its config but keeps its place; the
+        # version only moves when a row was added or its config changed
+        with self.lock, self.db:
+            changed = self.db.executemany(
+                "INSERT INTO tracks (id, seq, config) "
+                "VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM tracks), ?) "
+                "ON CONFLICT (id) DO UPDATE SET config = excluded.config WHERE config != excluded.config",
+                [(track_id, json.dumps(track, sort_keys=True)) for track_id, track in tracks]).rowcount
+            if changed > 0:
+                self.bump()
+
+    def remove(self, track_id):
+        with self.lock, self.db:
+            removed = self.db.execute("DELETE FROM tracks WHERE id = ?", (track_id,)).rowcount > 0
+            if removed:
+                self.bump()
+            return removed
+
+    def get(self, track_id):
+        with self.lock:
+            row = self.db.execute("SELECT config FROM tracks WHERE id = ?", (track_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def tracks(self):
+        with self.lock:
+            rows = self.db.execute("SELECT id, config FROM tracks ORDER BY seq").fetchall()
+        return [(track_id, json.loads(config)) for track_id, config in rows]
+
+    def settings(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT key, value FROM settings").fetchall())
+
+    def set_settings(self, **settings):
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                                [(key, value) for key, value in settings.items() if value is not None])
+            if PAGE_SETTINGS.intersection(settings):
+                self.bump()
+
+    def files(self):
+        # size and mtime of input files as last validated, by path
+        with self.lock:
+            rows = self.db.execute("SELECT path, size, mtime FROM files").fetchall()
+        return {path: (size, mtime) for path, size, mtime in rows}
+
+    def put_files(self, files):
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO files (path, size, mtime) VALUES (?, ?, ?)", files)
+
+    def put_genomes(self, genomes):
+        # replace the whole genome catalog in one transaction
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM genomes")
+            self.db.executemany("INSERT OR REPLACE INTO genomes (id, config) VALUES (?, ?)",
+                                [(genome["id"], json.dumps(genome)) for genome in genomes])
+
+    def genome(self, genome_id):
+        with self.lock:
+            row = self.db.execute("SELECT config FROM genomes WHERE id = ?", (genome_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def genome_ids(self, prefix=""):
+        # ids in order, optionally those starting with prefix (an index range scan)
+        with self.lock:
+            rows = self.db.execute("SELECT id FROM genomes WHERE id >= ? AND id < ? ORDER BY id",
+                                   (prefix, prefix + "\U0010ffff")).fetchall()
+        return [row[0] for row in rows]
+
+    def import_json_dir(self, directory):
+        # move tracks saved by older versions as one Cache/<id>.json each
+        legacy = sorted(name for name in os.listdir(directory) if name.endswith(".json"))
+        tracks = []
+        for name in legacy:
+            with open(os.path.join(directory, name)) as file:
+                tracks.append((name[:-len(".json")], json.loads(json.load(file))))
+        self.put_many(tracks)
+        for name in legacy:
+            os.remove(os.path.join(directory, name))
+
+manifest = None
+
+def get_manifest():
+    # the project's TrackManifest, opened once per process: a pre-forked
+    # worker must not share its parent's SQLite connection
+    global manifest
+    if manifest is None or manifest.pid != os.getpid():
+        create_cache()
+        manifest = TrackManifest("Cache/tracks.db")
+        manifest.import_json_dir("Cache")
+    return manifest
+
+def save_track(track_id, track):
+    get_manifest().put(track_id, track)
+
+def track_list():
+    # what /api/tracks serves: page settings plus every track in order, with its id
+    settings = get_manifest().settings()
+    genome, roi = settings.get("genome", ""), settings.get("roi", DEFAULT_ROI)
+    # one read, so that ids and configs come from the same state of the manifest
+    rows = get_manifest().tracks()
+    ids = [track_id for track_id, track in rows]
+    tracks = [track for track_id, track in rows]
+    if int(settings.get("proxy") or 0):
+        genome, tracks, roi = proxied_page(genome, tracks, roi, set())
+    return {"version": int(settings.get("version", 0)), "genome": json.loads(genome) if genome else None,
+            "locus": settings.get("locus", ""), "roi": roi,
+            "tracks": [{"id": track_id, "config": track} for track_id, track in zip(ids, tracks)]}
+
+def proxy_urls(value, origins):
+    # value with every http(s) URL in it pointing at the local proxy; their origins are added to origins
+    if isinstance(value, dict):
+        return {key: proxy_urls(item, origins) for key, item in value.items()}
+    if isinstance(value, list):
+        return [proxy_urls(item, origins) for item in value]
+    if isinstance(value, str) and value.startswith(("http://", "https://")):
+        parts = urllib.parse.urlsplit(value)
+        origins.add(parts.scheme + "://" + parts.netloc)
+        return "{}{}/{}{}{}".format(PROXY_PATH[1:], parts.scheme, parts.netloc, parts.path,
+                                    "?" + parts.query if parts.query else "")
+    return value
+
+def proxied_page(genome, tracks, roi, origins):
+    # genome (as stored in the settings), tracks and ROI with remote URLs going through the proxy
+    if genome:
+        config = json.loads(genome)
+        if isinstance(config, str):
+            # a genome id: proxy the files of its catalog entry, when the catalog has it
+            config = get_manifest().genome(config) or config
+        genome = json.dumps(proxy_urls(config, origins))
+    return genome, proxy_urls(tracks, origins), proxy_urls(roi, origins)
+
+def configure_proxy(size=None):
+    # -px: record the cache size in the project, then let REMOTE_CACHE
+    # serve the origins the page refers to
+    if size is not None:
+        get_manifest().set_settings(proxy=str(size))
+    settings = get_manifest().settings()
+    size = int(settings.get("proxy") or 0)
+    if size:
+        origins = set()
+        proxied_page(settings.get("genome", ""), [track for track_id, track in get_manifest().tracks()],
+                     settings.get("roi", DEFAULT_ROI), origins)
+        REMOTE_CACHE.configure(size * 1024 * 1024, origins)
+
+def igv_web(fasta, bams, bws, bed, gtfs, locus, refn, roi, coverage=None, index=False, twobit=False):
     # to check whether files exist and build the content of html.
     if bams is None and bws is None and bed is None and gtfs is None:
         return
 
-    tracks = ""
     if fasta is not None:
-        genome_track = build_ref_track(fasta)
+        genome_track = build_ref_track(fasta, twobit)
     else:
         genome_track = ""
     if refn is not None:
+        check_reference(refn)
         genome_track = build_refn_track(refn)
     if bams is not None:
-        build_bam_tracks(bams)
+        build_bam_tracks(bams, coverage, index)
     if bws is not None:
         build_bw_tracks(bws)
     if gtfs is not None:
@@ -297,30 +872,286 @@ def igv_web(fasta, bams, bws, bed, gtfs, locus, refn, roi):
     if bed is not None:
         build_bed_tracks(bed)
 
-
-    filelist = os.listdir(path="Cache/")
-    for item in filelist:
-        file = open("Cache/"+item,'r')
-        content = json.load(file)
-        tracks = tracks + content + ','
-    tracks = tracks[:-1]
     if roi is None:
-        roi = "https://s3.amazonaws.com/igv.org.test/data/roi/roi_bed_1.bed"
-    html = make_html( genome_track, tracks, locus, roi)
-
-    write_html(html)
-
-def print_genomelist():
-    # print genomelist supported online
-    if not isfile('genomes.json'):
-        url = 'https://s3.amazonaws.com/igv.org.genomes/genomes.json'
-        path = './genomes.json'
-        wget.download(url,path)
-    file = open('genomes.json')
-    data = json.load(file)
+        roi = DEFAULT_ROI
+    get_manifest().set_settings(genome=genome_track, locus=locus, roi=roi)
+    write_html(make_html())
+
+# subdirectory of a session bundle holding its data files
+BUNDLE_DATA = "data"
+ANNOTATION_FORMATS = ("gtf", "gff", "gff3", "bed")
+EXPORT_ERRORS = (OSError, ValueError, KeyError, zlib.error, struct.error)
+
+def read_loci(loci):
+    # -l values: loci as igv.js takes them, with the regions of BED files as chr:start-end
+    out = []
+    for locus in loci:
+        if locus.endswith(".bed") and isfile(locus):
+            with open(locus) as file:
+                for line in file:
+                    fields = line.split()
+                    if len(fields) >= 3 and not line.startswith(("#", "track", "browser")):
+                        out.append("{}:{}-{}".format(fields[0], int(fields[1]) + 1, fields[2]))
+        elif locus.strip():
+            out.append(locus.strip())
+    return out
+
+def is_local_file(url):
+    return isinstance(url, str) and not url.startswith(("http://", "https://")) and isfile(url)
+
+def reference_lengths(tracks, genome):
+    # sequence lengths by name, from the local bams, bigWigs and reference fasta
+    lengths = {}
+    for track in tracks:
+        url = track.get("url")
+        if not is_local_file(url):
+            continue
+        try:
+            if track.get("format") == "bam":
+                with igv_bgzf.BgzfReader(url) as reader:
+                    lengths.update(igv_bam.read_bam_header(reader)[1])
+            elif track.get("format") == "bigwig":
+                with igv_bigwig.BigWigReader(url) as reader:
+                    lengths.update((name, size) for name, (chrom_id, size) in reader.chroms.items())
+        except EXPORT_ERRORS:
+            continue
+    if isinstance(genome, dict) and is_local_file(genome.get("indexURL")):
+        lengths.update((name, entry[0]) for name, entry in igv_fasta.read_fai(genome["indexURL"]).items())
+    if isinstance(genome, dict) and is_local_file(genome.get("twoBitURL")):
+        lengths.update(igv_twobit.sequence_sizes(genome["twoBitURL"]))
+    return lengths
+
+def find_features(names, tracks):
+    # extent of the features called one of names (gene_name, gene_id or
+    # transcript_id of a GTF, Name or ID of a GFF, the name of a BED line)
+    # in the local annotation tracks, by upper-case name
+    wanted = set(name.upper() for name in names)
+    found = {}
+    for track in tracks:
+        if track.get("format") not in ANNOTATION_FORMATS or not is_local_file(track.get("url")):
+            continue
+        with igv_bgzf.open_text(track["url"]) as file:
+            for line in file:
+                fields = line.rstrip(b"\r\n").split(b"\t")
+                if line.startswith((b"#", b"track", b"browser")) or len(fields) < 4:
+                    continue
+                if track["format"] == "bed":
+                    keys, beg, end = [fields[3]], int(fields[1]), int(fields[2])
+                elif len(fields) >= 9:
+                    keys = re.findall(rb'(?:gene_name|gene_id|transcript_id|Name|ID)[ =]"?([^";]+)', fields[8])
+                    beg, end = int(fields[3]) - 1, int(fields[4])
+                else:
+                    continue
+                for key in set(key.decode().upper() for key in keys) & wanted:
+                    chrom = fields[0].decode()
+                    if key not in found:
+                        found[key] = (chrom, beg, end)
+                    elif found[key][0] == chrom:
+                        found[key] = (chrom, min(found[key][1], beg), max(found[key][2], end))
+    return found
+
+def locus_regions(loci, tracks, genome):
+    # loci as (name, beg, end), 0-based half-open; sequence names cover the
+    # whole sequence and other names are looked up in the annotation tracks
+    parsed = [LOCUS_RE.match(locus).groups() for locus in loci]
+    names = [name for name, start, end in parsed if not start]
+    lengths = reference_lengths(tracks, genome) if names else {}
+    features = find_features([name for name in names if name not in lengths], tracks) if names else {}
+    regions, unknown = [], []
+    for locus, (name, start, end) in zip(loci, parsed):
+        if start:
+            beg = int(start.replace(",", "")) - 1
+            regions.append((name, max(beg, 0), int(end.replace(",", "")) if end else beg + 1))
+        elif name in lengths:
+            regions.append((name, 0, lengths[name]))
+        elif name.upper() in features:
+            regions.append(features[name.upper()])
+        else:
+            unknown.append(locus)
+    if unknown:
+        raise ValueError("not a sequence or a feature of the annotation tracks: {}".format(", ".join(unknown)))
+    return regions
+
+def bundle_name(path, used):
+    # file name of path in the bundle, numbered when another track took it
+    name, n = basename(path), 1
+    while name in used:
+        n += 1
+        name = "{}_{}".format(n, basename(path))
+    used.add(name)
+    return name
+
+def slice_roi(roi, out, regions):
+    # the lines of a local ROI BED overlapping regions
+    with open(roi) as file, open(out, "w") as dst:
+        for line in file:
+            fields = line.split("\t")
+            if len(fields) >= 3 and not line.startswith(("#", "track", "browser")) and any(
+                    fields[0] == name and int(fields[1]) < end and int(fields[2]) > beg
+                    for name, beg, end in regions):
+                dst.write(line)
+    return out
+
+def export_bundle(directory, loci):
+    # write the parts of every track overlapping loci, indexed, with a
+    # static page into directory; the files are cut in parallel, one task
+    # per track, and a track that fails is reported and left out
+    if not loci:
+        raise ValueError("no loci, give them with -l")
+    settings = get_manifest().settings()
+    genome = json.loads(settings["genome"]) if settings.get("genome") else None
+    tracks = get_manifest().tracks()
+    regions = locus_regions(loci, [track for track_id, track in tracks], genome)
+    data = os.path.join(directory, BUNDLE_DATA)
+    os.makedirs(data, exist_ok=True)
+    used = set()
+
+    def target(path):
+        name = bundle_name(path, used)
+        return os.path.join(data, name), BUNDLE_DATA + "/" + name
+
+    jobs, bundled, reference = [], [], None
+    with futures.ProcessPoolExecutor() as pool:
+        for track_id, track in tracks:
+            url = track.get("url")
+            if not is_local_file(url):
+                if isinstance(url, str) and url.startswith(("http://", "https://")):
+                    bundled.append((track_id, track, None))
+                else:
+                    print("{}: {} is not a local file, left out".format(track_id, url), file=sys.stderr)
+                continue
+            out, link = target(url)
+            if track.get("format") == "bam":
+                job = pool.submit(igv_bam.slice_bam, url, out, regions)
+                config = dict(track, url=link, indexURL=link + ".bai")
+            elif track.get("format") == "bigwig":
+                job = pool.submit(igv_bigwig.slice_bigwig, url, out, regions)
+                config = dict(track, url=link)
+            elif track.get("format") in ANNOTATION_FORMATS and url.endswith(".gz") and isfile(url + ".tbi"):
+                job = pool.submit(igv_bgzf.slice_tabix, url, out, regions)
+                config = dict(track, url=link, indexURL=link + ".tbi")
+            else:
+                print("{}: {} tracks cannot be cut to loci, left out".format(track_id, track.get("format")),
+                      file=sys.stderr)
+                continue
+            jobs.append((track_id, job))
+            bundled.append((track_id, config, job))
+        if isinstance(genome, dict) and is_local_file(genome.get("fastaURL")):
+            fasta = genome["fastaURL"]
+            root = basename(fasta[:-3] if fasta.endswith(".gz") else fasta)
+            out, link = target(root + ".gz")
+            reference = pool.submit(igv_fasta.mask_fasta, fasta, out, regions)
+            jobs.append((fasta, reference))
+        elif isinstance(genome, dict) and is_local_file(genome.get("twoBitURL")):
+            # a packed reference goes into the bundle as a masked bgzipped FASTA, which compresses
+            root = os.path.splitext(basename(genome["twoBitURL"]))[0] + ".fa"
+            out, link = target(root + ".gz")
+            reference = pool.submit(igv_twobit.mask_twobit, genome["twoBitURL"], out, regions)
+            jobs.append((genome["twoBitURL"], reference))
+        failed = []
+        for name, job in jobs:
+            try:
+                job.result()
+            except EXPORT_ERRORS as e:
+                failed.append((name, e))
+
+    if failed:
+        print("{} of {} tracks could not be cut and were left out:".format(len(failed), len(jobs)), file=sys.stderr)
+        for name, error in failed:
+            print("    {}: {}".format(name, error), file=sys.stderr)
+    if reference is not None and not reference.exception():
+        genome = {"id": genome.get("id", root), "fastaURL": link, "indexURL": link + ".fai",
+                  "compressedIndexURL": link + ".gzi"}
+    roi = settings.get("roi", DEFAULT_ROI)
+    if is_local_file(roi):
+        out, roi = target(roi)
+        slice_roi(settings["roi"], out, regions)
+    page = {"version": 0, "genome": genome, "roi": roi,
+            "locus": " ".join("{}:{}-{}".format(name, beg + 1, end) for name, beg, end in regions),
+            "tracks": [{"id": track_id, "config": config} for track_id, config, job in bundled
+                       if job is None or not job.exception()]}
+    with open(os.path.join(directory, "index.html"), "w") as file:
+        file.write(make_html(page))
+    if isfile("igv.js"):
+        shutil.copy("igv.js", os.path.join(directory, "igv.js"))
+    else:
+        print("igv.js is not in the project, copy it next to {}".format(os.path.join(directory, "index.html")),
+              file=sys.stderr)
+    size = sum(os.path.getsize(os.path.join(root, name)) for root, dirs, files in os.walk(directory)
+               for name in files)
+    print("{} tracks of {} loci written to {} ({:.1f} MB)".format(len(page["tracks"]), len(regions), directory,
+                                                                   size / 1024 / 1024), file=sys.stderr)
+
+def fetch_genomes(legacy=False):
+    # download the igv.org genome list, or with legacy use a genomes.json left by older versions
+    if legacy and isfile("genomes.json"):
+        path = "genomes.json"
+    else:
+        import wget
+        path = wget.download(GENOMES_URL, "Cache/genomes.json.download")
+        print(file=sys.stderr)
+    with open(path) as file:
+        genomes = json.load(file)
+    if path != "genomes.json":
+        os.remove(path)
+    if not isinstance(genomes, list) or not all("id" in genome for genome in genomes):
+        raise ValueError("unexpected genome list format")
+    return genomes
+
+def genome_catalog(refresh=False, max_age=None):
+    # the genome list, fetched once into the manifest; downloaded again when
+    # refresh is asked for or the copy is older than max_age seconds
+    catalog = get_manifest()
+    fetched = float(catalog.settings().get("genomes_fetched", 0))
+    if not fetched or refresh or (max_age is not None and time.time() - fetched > max_age):
+        try:
+            genomes = fetch_genomes(legacy=not fetched and not refresh)
+        except (OSError, ValueError) as e:
+            if not fetched:
+                raise
+            print("could not refresh the genome list ({}), using the cached one".format(e), file=sys.stderr)
+        else:
+            catalog.put_genomes(genomes)
+            catalog.set_settings(genomes_fetched=str(time.time()))
+    return catalog
+
+def search_genomes(catalog, query):
+    # exact id, then id prefix, then close matches for typos
+    if catalog.genome(query) is not None:
+        return [query]
+    matches = catalog.genome_ids(prefix=query)
+    if matches:
+        return matches
+    ids = catalog.genome_ids()
+    lowered = {genome_id.lower(): genome_id for genome_id in ids}
+    return [lowered[match] for match in difflib.get_close_matches(query.lower(), list(lowered), n=5, cutoff=0.6)]
+
+def check_reference(refn):
+    # fail at startup instead of in the browser when -rn is not a known genome id.
+    # Only the cached list is used once there is one; -gl/-rg refresh it.
+    try:
+        catalog = genome_catalog()
+    except (OSError, ValueError) as e:
+        print("could not load the genome list ({}), {} is not checked".format(e, refn), file=sys.stderr)
+        return
+    if catalog.genome(refn) is not None:
+        return
+    suggestions = search_genomes(catalog, refn)
+    print("{} is not a supported reference genome.{}".format(
+        refn, " Did you mean: " + ", ".join(suggestions) + "?" if suggestions else ""), file=sys.stderr)
+    sys.exit(1)
+
+def print_genomelist(query="", refresh=False):
+    # print genomelist supported online, or the ones matching query
+    try:
+        catalog = genome_catalog(refresh, GENOMES_TTL)
+    except (OSError, ValueError) as e:
+        print("could not load the genome list: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    ids = search_genomes(catalog, query) if query else catalog.genome_ids()
     print('The following reference genomes have been supported:')
-    for i in range(0,len(data)):
-        print(data[i]["id"])
+    for genome_id in ids:
+        print("{}\t{}".format(genome_id, catalog.genome(genome_id).get("name", "")))
 
 def create_cache():
     isExist = os.path.exists('Cache')
@@ -330,106 +1161,1796 @@ def create_cache():
     else:
         return False
 
-def add_bam(addbam):
+def add_bam(addbam, index=False):
     #add bam files into index.html
     if addbam is None:
         return
-    build_bam_tracks([addbam])
-
-    f = open('index.html','r',encoding='utf-8')
-    html = f.read()
-    f.close
-    con = html.split('[')
-    before = con[0] + '['
-
-    # before = re.findall(r'.(.*?)tracks:', html, re.S)
-    # mid = re.findall(r'tracks: \[(.*?)\]', html, re.S)
-
-    con = html.split(']')
-    last = ']'+con[1]
-
-    tracks = ''
-    # read all files in Cache folder
-    filelist = os.listdir(path="Cache/")
-    for item in filelist:
-        file = open("Cache/"+item,'r')
-        content = json.load(file)
-        tracks = tracks + content + ','
-    tracks = tracks[:-1]
-    content = before + tracks + last
-    file = open('index.html','w')
-    file.write(content)
-    file.close
+    build_bam_tracks([addbam], index=index)
+    write_html(make_html())
+
+def remove_track(track_id):
+    # a track and the coverage track built with it; returns the ids that were registered
+    return [name for name in (track_id, track_id + ".coverage") if get_manifest().remove(name)]
 
 def remove_bam(rmbam):
     #remove bam files from index.html
     if rmbam is None:
         return
     rmbam_id = basename(rmbam).replace(".bam","")
-    os.remove("Cache/"+rmbam_id+".json")
-    f = open('index.html','r',encoding='utf-8')
-    html = f.read()
-    f.close
-    con = html.split('[')
-    before = con[0] + '['
-
-    # before = re.findall(r'.(.*?)tracks:', html, re.S)
-    # mid = re.findall(r'tracks: \[(.*?)\]', html, re.S)
-
-    con = html.split(']')
-    last = ']'+con[1]
-
-    tracks = ''
-    # read all files in Cache folder
-    filelist = os.listdir(path="Cache/")
-    for item in filelist:
-        file = open("Cache/"+item,'r')
-        content = json.load(file)
-        tracks = tracks + content + ','
-    tracks = tracks[:-1]
-    content = before + tracks + last
-    file = open('index.html','w')
-    file.write(content)
-    file.close
-
-
-def create_server(port):
+    if rmbam_id not in remove_track(rmbam_id):
+        print("{} is not a registered track".format(rmbam_id), file=sys.stderr)
+    write_html(make_html())
+
+def upgrade_page():
+    # pages written by older versions carry their tracks inline and would not follow /api/events
+    if isfile("index.html") and get_manifest().tracks():
+        write_html(make_html())
+
+def local_only_options(opts):
+    # options given with -ab/-rb that a running server cannot apply for them
+    given = [("-r", opts.ref), ("-rn", opts.reference), ("-m", opts.bam), ("-w", opts.bigwig), ("-b", opts.bed),
+             ("-g", opts.gtf), ("-l", opts.locus or None), ("-roi", opts.ROI), ("-ex", opts.export),
+             ("-tb", opts.twobit or None), ("-px", opts.proxy)]
+    return [flag for flag, value in given if value is not None]
+
+def server_running(port):
+    try:
+        socket.create_connection(("127.0.0.1", port), timeout=5).close()
+    except OSError:
+        return False
+    return True
+
+def control_server(port, addbam=None, rmbam=None, index=False, coverage=None):
+    '''Hands -ab/-rb (with -ix and -cov) to an igv_web.py already serving
+    the project on port, which applies them at once and updates the open
+    pages. False when no server answers there.
+    '''
+    def call(method, target, inputs=None):
+        # no timeout: the server may be indexing the bam
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        try:
+            if inputs is None:
+                conn.request(method, target)
+            else:
+                conn.request(method, target, json.dumps(inputs), {"Content-Type": "application/json"})
+            response = conn.getresponse()
+            body = response.read()
+        finally:
+            conn.close()
+        try:
+            return response.status, json.loads(body)
+        except ValueError:
+            return response.status, {"error": "HTTP {}".format(response.status)}
+
+    try:
+        if addbam is not None:
+            inputs = {"bam": [addbam], "index": index}
+            if coverage is not None:
+                inputs["coverage"] = coverage
+            status, reply = call("POST", API_PATH, inputs)
+            if status != 200:
+                print("could not add {}: {}".format(addbam, reply.get("error")), file=sys.stderr)
+            else:
+                print("added {}".format(", ".join(reply["added"]) or "no tracks"), file=sys.stderr)
+        if rmbam is not None:
+            rmbam_id = basename(rmbam).replace(".bam","")
+            status, reply = call("DELETE", API_PATH + "/" + urllib.parse.quote(rmbam_id))
+            if status == 404:
+                print("{} is not a registered track".format(rmbam_id), file=sys.stderr)
+            elif status != 200:
+                print("could not remove {}: {}".format(rmbam_id, reply.get("error")), file=sys.stderr)
+    except ConnectionRefusedError:
+        return False
+    return True
+
+
+WORKER_DRAIN_TIMEOUT = 30
+
+def create_server(port, engine='thread', workers=1, metrics_interval=0):
     # create python server which supported rangerequest.
+    if workers > 1:
+        serve_workers(port, engine, workers, metrics_interval)
+        return
+    if metrics_interval > 0:
+        METRICS.report_every(metrics_interval)
+    if engine == 'asyncio':
+        # HTTP/1.1 keep-alive on one event loop instead of a thread per connection
+        server = AsyncRangeServer()
+        server.use_sendfile = RangeRequestHandler.use_sendfile
+        server.use_compression = RangeRequestHandler.use_compression
+        server.serve_forever(port)
+        return
     SimpleHTTPServer.test(HandlerClass=RangeRequestHandler, port=port)
 
+class WorkerHTTPServer(SimpleHTTPServer.ThreadingHTTPServer):
+    """ThreadingHTTPServer on a listening socket inherited from the parent
+    process. Request threads are joined by server_close(), so a worker that
+    is told to stop finishes the responses in flight before it exits.
+    """
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, sock):
+        SimpleHTTPServer.ThreadingHTTPServer.__init__(self, sock.getsockname()[:2], RangeRequestHandler,
+                                                      bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_name, self.server_port = self.server_address[:2]
+
+def listen_socket(port):
+    # on all addresses, IPv4 and IPv6 where the system allows both on one socket
+    if socket.has_dualstack_ipv6():
+        return socket.create_server(("", port), family=socket.AF_INET6, dualstack_ipv6=True, backlog=1024)
+    return socket.create_server(("", port), backlog=1024)
+
+def run_worker(sock, engine, metrics_interval):
+    # serve sock until SIGTERM, then stop accepting and drain the requests in flight
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    METRICS.tag = "[metrics {}]".format(os.getpid())
+    if metrics_interval > 0:
+        METRICS.report_every(metrics_interval)
+    if engine == 'asyncio':
+        server = AsyncRangeServer()
+        server.use_sendfile = RangeRequestHandler.use_sendfile
+        server.use_compression = RangeRequestHandler.use_compression
+        asyncio.run(server.serve(None, sock=sock))
+        return
+    RangeRequestHandler.protocol_version = "HTTP/1.0"
+    server = WorkerHTTPServer(sock)
+    def stop(signum, frame):
+        # event streams never end on their own; shutdown() waits for
+        # serve_forever, so it cannot run in the signal handler's thread
+        TRACK_FEED.close()
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    server.serve_forever()
+    server.server_close()
+
+def serve_workers(port, engine, workers, metrics_interval=0):
+    # pre-fork workers that share one listening socket and restart the ones
+    # that die. SIGINT or SIGTERM stops them with SIGTERM, so they drain;
+    # workers still busy after WORKER_DRAIN_TIMEOUT seconds are killed.
+    sock = listen_socket(port)
+    host, port = sock.getsockname()[:2]
+    url_host = "[{}]".format(host) if ":" in host else host
+    print("Serving HTTP on {} port {} (http://{}:{}/) with {} {} workers ...".format(
+        host, port, url_host, port, workers, engine))
+    sys.stdout.flush()
+    children = {}  # pid -> start time
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(sock, engine, metrics_interval)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        children[pid] = time.time()
+
+    def stop(signum, frame):
+        if not stopping:
+            stopping.append(time.time() + WORKER_DRAIN_TIMEOUT)
+            signal_workers(signal.SIGTERM)
+
+    def signal_workers(signum):
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    # the workers share the proxy's cache directory
+    REMOTE_CACHE.shared = True
+    for _ in range(workers):
+        spawn()
+    while children:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if not pid:
+            if stopping and time.time() > stopping[0]:
+                print("killing {} workers still busy after {}s".format(len(children), WORKER_DRAIN_TIMEOUT),
+                      file=sys.stderr)
+                signal_workers(signal.SIGKILL)
+            time.sleep(0.2)
+            continue
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        print("worker {} exited with code {}, restarting it".format(pid, os.waitstatus_to_exitcode(status)),
+              file=sys.stderr)
+        if time.time() - started < 1:
+            # do not spin on a worker that dies at startup
+            time.sleep(1)
+        spawn()
+    sock.close()
+    print("\nAll workers stopped, exiting.")
+
 def copy_byte_range(infile, outfile, start=None, stop=None, bufsize=16*1024):
     '''Like shutil.copyfileobj, but only copy a range of the streams.
 
     Both start and stop are inclusive.
     '''
     if start is not None: infile.seek(start)
-    while 1:
-        to_read = min(bufsize, stop + 1 - infile.tell() if stop else bufsize)
+    # count down the bytes left instead of asking infile.tell() on every pass
+    remaining = None if stop is None else stop + 1 - infile.tell()
+    while remaining is None or remaining > 0:
+        to_read = bufsize if remaining is None else min(bufsize, remaining)
         # In this cycle, file to read will be divided into many subfile (which length is bufsize).
         # and those subfiles will be writed into outfile
         buf = infile.read(to_read)
         if not buf:
             break
         outfile.write(buf)
+        if remaining is not None:
+            remaining -= len(buf)
 
-BYTE_RANGE_RE = re.compile(r'bytes=(\d+)-(\d+)?$')
+def sendfile_byte_range(infile, sock, start=None, stop=None):
+    '''Like copy_byte_range, but let the kernel copy the range with os.sendfile.
+
+    Both start and stop are inclusive. Returns False without sending anything
+    when the zero-copy path is not available (no os.sendfile, a wrapped/TLS
+    socket or a source without a real file descriptor), so that the caller
+    can fall back to copy_byte_range.
+    '''
+    if not hasattr(os, 'sendfile') or type(sock) is not socket.socket:
+        return False
+    try:
+        fs = os.fstat(infile.fileno())
+    except (AttributeError, OSError, ValueError):
+        return False
+    offset = infile.tell() if start is None else start
+    if stop is None or stop >= fs.st_size:
+        stop = fs.st_size - 1
+    count = stop + 1 - offset
+    if count > 0:
+        # socket.sendfile drives os.sendfile and copes with socket timeouts
+        sock.sendfile(infile, offset, count)
+    return True
+
+BYTE_RANGE_RE = re.compile(r'bytes=(\d*-\d*(?:\s*,\s*\d*-\d*)*)\s*$')
+BYTE_RANGE_SPEC_RE = re.compile(r'(\d*)-(\d*)$')
 
 def parse_byte_range(byte_range):
-    '''Returns the two numbers in 'bytes=123-456' or throws ValueError.
+    '''Returns the ranges in 'bytes=123-456,-500,789-' as a list of
+    (first, last) tuples or throws ValueError.
 
-    The last number or both numbers may be None.
+    last is None for open ranges ('789-') and first is None for suffix
+    ranges ('-500' gives (None, 500), the final 500 bytes). An empty header
+    gives an empty list.
     '''
     if byte_range.strip() == '':
-        return None, None
+        return []
 
-    m = BYTE_RANGE_RE.match(byte_range)
+    m = BYTE_RANGE_RE.match(byte_range.strip())
     if not m:
         raise ValueError('Invalid byte range %s' % byte_range)
 
-    first, last = [x and int(x) for x in m.groups()]
-    if last and last < first:
-        raise ValueError('Invalid byte range %s' % byte_range)
-    return first, last
+    ranges = []
+    for spec in m.group(1).split(','):
+        first, last = [int(x) if x else None for x in BYTE_RANGE_SPEC_RE.match(spec.strip()).groups()]
+        if first is None and last is None:
+            raise ValueError('Invalid byte range %s' % byte_range)
+        if first is not None and last is not None and last < first:
+            raise ValueError('Invalid byte range %s' % byte_range)
+        ranges.append((first, last))
+    return ranges
+
+def resolve_byte_ranges(ranges, file_len):
+    '''Turn parsed ranges into absolute, inclusive (first, last) pairs for a
+    file of file_len bytes.
+
+    Unsatisfiable ranges are dropped, the rest are sorted and overlapping or
+    adjacent ranges are merged, so the file can be read in a single forward
+    pass. An empty result means the whole set is unsatisfiable (416).
+    '''
+    resolved = []
+    for first, last in ranges:
+        if first is None:
+            # suffix range: the final `last` bytes of the file
+            if last == 0:
+                continue
+            first, last = max(file_len - last, 0), file_len - 1
+        elif last is None or last >= file_len:
+            last = file_len - 1
+        if first >= file_len:
+            continue
+        resolved.append((first, last))
+
+    merged = []
+    for first, last in sorted(resolved):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+def multipart_byteranges(ranges, ctype, file_len):
+    '''Frame resolved ranges as a multipart/byteranges body.
+
+    Returns (boundary, parts, length): parts holds the header bytes written
+    before each range plus the closing delimiter as its last item, and length
+    is the total body size including the range data.
+    '''
+    boundary = '%032x' % int.from_bytes(os.urandom(16), 'big')
+    parts = []
+    length = 0
+    for first, last in ranges:
+        part_header = ('\r\n--%s\r\nContent-type: %s\r\nContent-Range: bytes %s-%s/%s\r\n\r\n'
+                       % (boundary, ctype, first, last, file_len)).encode('latin-1')
+        parts.append(part_header)
+        length += len(part_header) + last - first + 1
+    parts.append(('\r\n--%s--\r\n' % boundary).encode('latin-1'))
+    length += len(parts[-1])
+    return boundary, parts, length
+
+# Cache-Control policy per file extension. Pages and track lists change
+# whenever tracks are edited, so they are always revalidated (cheap with
+# ETags); static assets and track data may be reused for a while.
+CACHE_CONTROL = {
+    '.html': 'no-cache', '.htm': 'no-cache', '.json': 'no-cache',
+    '.js': 'public, max-age=86400', '.css': 'public, max-age=86400',
+    '.png': 'public, max-age=86400', '.ico': 'public, max-age=86400', '.svg': 'public, max-age=86400',
+}
+for ext in ('.bam', '.bai', '.csi', '.bw', '.bigwig', '.bb', '.bigbed', '.fa', '.fasta', '.fas', '.fai',
+            '.gzi', '.2bit', '.gtf', '.gff', '.gff3', '.bed', '.gz', '.tbi'):
+    CACHE_CONTROL[ext] = 'public, max-age=3600'
+
+def file_etag(fs):
+    # strong validator: changes whenever the file is replaced, resized or touched
+    return '"%x-%x-%x"' % (fs.st_ino, fs.st_size, fs.st_mtime_ns)
+
+def cache_control(path):
+    return CACHE_CONTROL.get(os.path.splitext(path)[1].lower(), 'no-cache')
+
+# text assets worth compressing; binary formats and bgzipped tracks are sent as they are
+COMPRESSIBLE = frozenset(('.html', '.htm', '.js', '.css', '.json', '.svg', '.txt', '.tsv', '.csv', '.bed',
+                          '.gtf', '.gff', '.gff3', '.fai', '.wig', '.bedgraph', '.seg'))
+COMPRESS_MIN_SIZE = 1024
+SIDECAR_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+def is_compressible(path):
+    return os.path.splitext(path)[1].lower() in COMPRESSIBLE
+
+def encoded_etag(fs, encoding, streamed=False):
+    # every encoding of a file is its own representation with its own validator.
+    # gzip made on the fly is not byte-identical to the sidecar, so its tag is weak
+    return '%s"%s-%s"' % ('W/' if streamed else '', file_etag(fs)[1:-1], encoding)
+
+def parse_accept_encoding(value):
+    # {coding: q} of an Accept-Encoding header
+    accepted = {}
+    for item in value.split(','):
+        coding, _, params = item.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            name, _, number = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(number)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = q
+    return accepted
+
+def negotiate_encoding(path, fs, headers):
+    '''(Content-Encoding, sidecar path or None) for a full GET of a text
+    asset, or None to send the file as it is. Precompressed sidecars win;
+    without one, gzip is applied on the fly while SIDECARS builds them.
+    '''
+    if 'Range' in headers or not is_compressible(path) or fs.st_size < COMPRESS_MIN_SIZE:
+        return None
+    accepted = parse_accept_encoding(headers.get('Accept-Encoding', ''))
+    wanted = [encoding for encoding in ('br', 'gzip') if accepted.get(encoding, accepted.get('*', 0)) > 0]
+    if not wanted:
+        return None
+    for encoding in wanted:
+        sidecar = SIDECARS.lookup(path, fs, encoding)
+        if sidecar is not None:
+            return encoding, sidecar
+    SIDECARS.schedule(path, fs)
+    return ('gzip', None) if 'gzip' in wanted else None
+
+def gzip_stream(f, bufsize=256*1024):
+    # gzip-compress f while it is sent; closes f at the end
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    try:
+        f.seek(0)
+        while True:
+            data = f.read(bufsize)
+            if not data:
+                break
+            data = compressor.compress(data)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        f.close()
+
+class SidecarStore(object):
+    """Precompressed copies of text assets under Cache/compressed, named after
+    the source path, mtime and size, so that a changed file never matches an
+    old copy. Copies are built once, on a background thread, the first time a
+    file is asked for compressed: gzip always, brotli when the brotli module
+    is installed. Copies of earlier versions of a file are then removed.
+    """
+    def __init__(self, directory=os.path.join("Cache", "compressed")):
+        self.lock = threading.Lock()
+        self.directory = directory
+        self.building = set()
+        self.executor = None
+
+    def name(self, path, fs, encoding):
+        key = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, "%s-%x-%x%s" % (key, fs.st_mtime_ns, fs.st_size,
+                                                             SIDECAR_SUFFIXES[encoding]))
+
+    def lookup(self, path, fs, encoding):
+        sidecar = self.name(path, fs, encoding)
+        return sidecar if isfile(sidecar) else None
+
+    def schedule(self, path, fs):
+        with self.lock:
+            if path in self.building:
+                return
+            self.building.add(path)
+            if self.executor is None:
+                self.executor = futures.ThreadPoolExecutor(1)
+        self.executor.submit(self.build, path, fs)
+
+    def build(self, path, fs):
+        try:
+            encoders = [("gzip", lambda: zlib.compressobj(9, zlib.DEFLATED, 31))]
+            if importlib.util.find_spec("brotli"):
+                import brotli
+                encoders.append(("br", lambda: brotli.Compressor(mode=brotli.MODE_TEXT)))
+            os.makedirs(self.directory, exist_ok=True)
+            current = set()
+            for encoding, compressor in encoders:
+                sidecar = self.name(path, fs, encoding)
+                current.add(os.path.basename(sidecar))
+                if isfile(sidecar):
+                    continue
+                compressor = compressor()
+                compress = getattr(compressor, "compress", None) or compressor.process
+                tmp = "%s.%d.tmp" % (sidecar, os.getpid())
+                with open(path, "rb") as src, open(tmp, "wb") as out:
+                    for data in iter(lambda: src.read(1024 * 1024), b""):
+                        out.write(compress(data))
+                    out.write(compressor.flush() if encoding == "gzip" else compressor.finish())
+                if os.stat(path).st_mtime_ns != fs.st_mtime_ns:
+                    # changed while it was read
+                    os.remove(tmp)
+                    return
+                os.replace(tmp, sidecar)
+            # copies of earlier versions, and what a killed process left of them
+            prefix = os.path.basename(self.name(path, fs, "gzip")).partition("-")[0] + "-"
+            for entry in os.scandir(self.directory):
+                if entry.name.startswith(prefix) and entry.name.rsplit(".", 2)[0] not in current \
+                        and entry.name not in current:
+                    os.remove(entry.path)
+        except OSError as e:
+            print("could not compress {}: {}".format(path, e), file=sys.stderr)
+        finally:
+            with self.lock:
+                self.building.discard(path)
+
+SIDECARS = SidecarStore()
+
+def parse_http_date(value):
+    try:
+        date = email_utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp()
+
+def is_not_modified(headers, fs, etag):
+    '''True when If-None-Match or If-Modified-Since lets the client reuse its copy.
+
+    If-None-Match takes precedence and is compared weakly, as RFC 7232 asks.
+    '''
+    if 'If-None-Match' in headers:
+        tags = [tag.strip() for tag in headers['If-None-Match'].split(',')]
+        etag = etag[2:] if etag.startswith('W/') else etag
+        return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+    if 'If-Modified-Since' in headers:
+        since = parse_http_date(headers['If-Modified-Since'])
+        return since is not None and int(fs.st_mtime) <= since
+    return False
+
+def if_range_matches(headers, fs, etag):
+    '''True when a Range request may be answered with partial content: there
+    is no If-Range, or its entity tag or date still matches strongly.
+    '''
+    value = headers.get('If-Range')
+    if value is None:
+        return True
+    value = value.strip()
+    if value.startswith('"') or value.startswith('W/'):
+        return value == etag and not etag.startswith('W/')
+    since = parse_http_date(value)
+    return since is not None and int(fs.st_mtime) == since
+
+class BlockCache(object):
+    """Process-wide LRU cache of file blocks keyed by (path, mtime, block offset).
+
+    Only index files (INDEX_SUFFIXES) and the first head_size bytes of other
+    files, where BAM and bigWig headers live, go through the cache, so that
+    bulk chunk streaming does not evict them. Blocks of a path are dropped as
+    soon as the file is seen with a different mtime. A capacity of 0 disables
+    the cache.
+    """
+    def __init__(self, capacity=128*1024*1024, block_size=64*1024, head_size=64*1024):
+        self.lock = threading.Lock()
+        self.block_size = block_size
+        self.head_size = head_size
+        self.hits = 0
+        self.misses = 0
+        self.configure(capacity)
+
+    def configure(self, capacity):
+        with self.lock:
+            self.capacity = capacity
+            self.blocks = OrderedDict()
+            self.paths = {}  # path -> (mtime, set of block offsets)
+            self.size = 0
+
+    def accepts(self, path, first, last):
+        if self.capacity <= 0 or last < first:
+            return False
+        return path.endswith(INDEX_SUFFIXES) or last < self.head_size
+
+    def read_range(self, path, mtime, first, last, f=None):
+        '''Return bytes first..last (inclusive) of path as of mtime.
+
+        Missing blocks are read from f; without f a miss returns None, which
+        lets event-loop callers try the cache before handing off to a thread.
+        '''
+        bs = self.block_size
+        offsets = range(first - first % bs, last + 1, bs)
+        found = {}
+        with self.lock:
+            known = self.paths.get(path)
+            if known is not None and known[0] != mtime:
+                self._drop_path(path)
+            for offset in offsets:
+                block = self.blocks.get((path, mtime, offset))
+                if block is not None:
+                    self.blocks.move_to_end((path, mtime, offset))
+                    found[offset] = block
+        missing = [offset for offset in offsets if offset not in found]
+        if missing and f is None:
+            return None
+        with self.lock:
+            self.hits += len(found)
+            self.misses += len(missing)
+        for offset in missing:
+            f.seek(offset)
+            found[offset] = block = f.read(bs)
+            self._store(path, mtime, offset, block)
+        data = b''.join(found[offset] for offset in offsets)
+        start = first - offsets[0]
+        return data[start:start + last - first + 1]
+
+    def _store(self, path, mtime, offset, block):
+        with self.lock:
+            known = self.paths.get(path)
+            if known is not None and known[0] != mtime:
+                self._drop_path(path)
+            key = (path, mtime, offset)
+            if key in self.blocks or len(block) > self.capacity:
+                return
+            self.blocks[key] = block
+            self.paths.setdefault(path, (mtime, set()))[1].add(offset)
+            self.size += len(block)
+            while self.size > self.capacity:
+                (old_path, old_mtime, old_offset), old = self.blocks.popitem(last=False)
+                self.size -= len(old)
+                self.paths[old_path][1].discard(old_offset)
+                if not self.paths[old_path][1]:
+                    del self.paths[old_path]
+
+    def _drop_path(self, path):
+        # called with the lock held
+        mtime, offsets = self.paths.pop(path)
+        for offset in offsets:
+            self.size -= len(self.blocks.pop((path, mtime, offset)))
+
+BLOCK_CACHE = BlockCache()
+
+class Readahead(object):
+    """Background prefetch of the BAM chunks a panning igv.js asks for next.
+
+    The .bai of each served BAM is read once per mtime into the offsets of
+    the BGZF blocks it points at. A range request for the BAM is snapped to
+    those block boundaries, and the run of blocks twice its length next to
+    it (after it, or before it when the client pans left) is read on a
+    background thread. Segments are kept in memory within budget bytes,
+    least recently used dropped first, and a later request that falls
+    inside one is served from it. A budget of 0 turns readahead off.
+
+    The segments of a file are found by bisecting their sorted starts, and
+    a BAM has at most one prefetch waiting for a thread, so a busy server
+    does not pile up reads that are stale by the time they run.
+    """
+    def __init__(self, budget=0, max_segment=16*1024*1024, workers=2):
+        self.lock = threading.Lock()
+        self.max_segment = max_segment
+        self.workers = workers
+        self.executor = None
+        self.segments = OrderedDict()  # (path, mtime, first) -> bytes, least recently used first
+        self.starts = {}  # (path, mtime) -> sorted firsts of its segments
+        self.size = 0
+        self.offsets = {}  # path -> (mtime, sorted block offsets from the .bai)
+        self.last = {}  # (client, path) -> first byte of the previous request
+        self.pending = set()  # (path, mtime, first) being read
+        self.queued = set()  # paths with a prefetch waiting for a thread
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.configure(budget)
+
+    def configure(self, budget):
+        with self.lock:
+            self.budget = budget
+            self.segments.clear()
+            self.starts.clear()
+            self.size = 0
+
+    def read(self, path, mtime, first, last):
+        # bytes first..last of a BAM from a prefetched segment, or None
+        if not self.budget or not path.endswith(BAM_SUFFIXES):
+            return None
+        with self.lock:
+            key = self.find(path, mtime, first, last)
+            if key is None:
+                self.misses += 1
+                return None
+            self.segments.move_to_end(key)
+            self.hits += 1
+            data = self.segments[key]
+        return data[first - key[2]:last + 1 - key[2]]
+
+    def find(self, path, mtime, first, last):
+        # key of a segment holding first..last, with the lock held; segments may
+        # overlap, so the few starting closest before first are tried
+        starts = self.starts.get((path, mtime), ())
+        i = bisect.bisect_right(starts, first)
+        for start in starts[max(0, i - 4):i][::-1]:
+            if last < start + len(self.segments[(path, mtime, start)]):
+                return (path, mtime, start)
+        return None
+
+    def advise(self, client, path, fs, first, last):
+        # note a request for first..last of path and prefetch its neighbour; does not block
+        if not self.budget or not path.endswith(BAM_SUFFIXES):
+            return
+        with self.lock:
+            previous = self.last.pop((client, path), None)
+            self.last[(client, path)] = first
+            if len(self.last) > 4096:
+                self.last.pop(next(iter(self.last)))
+            if self.executor is None:
+                self.executor = futures.ThreadPoolExecutor(self.workers)
+            if path in self.queued:
+                # the waiting prefetch will do; it is for an earlier request of this bam
+                return
+            self.queued.add(path)
+        backward = previous is not None and first < previous
+        self.executor.submit(self.prefetch, path, fs.st_mtime_ns, fs.st_size, first, last, backward)
+
+    def block_offsets(self, path, mtime):
+        # the .bai's block offsets, read once per mtime of the bam; empty without a .bai
+        with self.lock:
+            known = self.offsets.get(path)
+        if known is not None and known[0] == mtime:
+            return known[1]
+        try:
+            offsets = igv_bam.block_offsets(igv_bam.read_bai(path + ".bai"))
+        except (OSError, ValueError, struct.error) as e:
+            print("no readahead for {}: {}".format(path, e), file=sys.stderr)
+            offsets = []
+        with self.lock:
+            self.offsets[path] = (mtime, offsets)
+        return offsets
+
+    def prefetch(self, path, mtime, size, first, last, backward):
+        with self.lock:
+            self.queued.discard(path)
+        offsets = self.block_offsets(path, mtime)
+        if not offsets:
+            return
+        span = min(2 * (last + 1 - first), self.max_segment)
+        if backward:
+            end = first
+            start = offsets[max(0, bisect.bisect_right(offsets, max(0, first - span)) - 1)]
+        else:
+            # from the block holding the byte after the request to a block boundary span bytes on
+            start = offsets[max(0, bisect.bisect_right(offsets, last + 1) - 1)]
+            i = bisect.bisect_left(offsets, start + span)
+            end = offsets[i] if i < len(offsets) else size
+        end = min(end, size)
+        if end <= start:
+            return
+        key = (path, mtime, start)
+        with self.lock:
+            if key in self.pending or self.find(path, mtime, start, end - 1) is not None:
+                return
+            self.pending.add(key)
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_mtime_ns != mtime:
+                    return
+                data = os.pread(f.fileno(), end - start, start)
+        except OSError:
+            return
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+        with self.lock:
+            if key in self.segments or len(data) > self.budget:
+                return
+            self.segments[key] = data
+            bisect.insort(self.starts.setdefault(key[:2], []), start)
+            self.size += len(data)
+            self.prefetched += len(data)
+            while self.size > self.budget:
+                (old_path, old_mtime, old_start), old = self.segments.popitem(last=False)
+                self.size -= len(old)
+                starts = self.starts[(old_path, old_mtime)]
+                del starts[bisect.bisect_left(starts, old_start)]
+                if not starts:
+                    del self.starts[(old_path, old_mtime)]
+
+READAHEAD = Readahead()
+
+class OpenFile(object):
+    """A file held open by FilePool: the file object, its stat when opened and
+    a read-only mapping of it (None for empty or unmappable files).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.stat = os.fstat(self.file.fileno())
+            try:
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                self.map = None
+        except BaseException:
+            self.file.close()
+            raise
+        self.users = 0
+        self.checked = time.monotonic()
+        self.retired = False
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # a view is still exported; the mapping goes with its last reference
+                pass
+        self.file.close()
+
+class PooledFile(object):
+    """File-like, read-only handle on a pooled file with its own position, so
+    that threads sharing one descriptor never race on seek(). Reads come from
+    the mapping, and close() hands the file back to the pool.
+    """
+    mode = 'rb'
+
+    def __init__(self, pool, entry):
+        self.pool = pool
+        self.entry = entry
+        self.name = entry.path
+        self.stat = entry.stat
+        self.pos = 0
+        self.closed = False
+
+    def fileno(self):
+        return self.entry.file.fileno()
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.stat.st_size
+        self.pos = offset
+        return offset
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        end = self.stat.st_size if size is None or size < 0 else min(self.stat.st_size, self.pos + size)
+        if end <= self.pos:
+            return b''
+        if self.entry.map is not None:
+            data = self.entry.map[self.pos:end]
+        else:
+            data = os.pread(self.fileno(), end - self.pos, self.pos)
+        self.pos += len(data)
+        return data
+
+    def view(self, first, last):
+        # bytes first..last (inclusive) without copying; release the view before close()
+        if self.entry.map is None:
+            self.seek(first)
+            return memoryview(self.read(last - first + 1))
+        return memoryview(self.entry.map)[first:last + 1]
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.pool.release(self.entry)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class FilePool(object):
+    """Process-wide LRU pool of open, memory-mapped files keyed by path.
+
+    acquire() returns a PooledFile for one stat() instead of an open(),
+    fstat(), mmap() and close(): the file is reopened when its inode, size or
+    mtime changed. With revalidate > 0 a path is only re-stat()ed once per
+    that many seconds, at the risk of serving a file rewritten in place from
+    its old mapping. Files evicted or replaced while in use are closed by
+    their last user. A capacity of 0 opens every file per request.
+    """
+    def __init__(self, capacity=64, revalidate=0.0):
+        self.lock = threading.Lock()
+        self.files = OrderedDict()
+        self.hits = 0
+        self.opens = 0
+        self.configure(capacity, revalidate)
+
+    def configure(self, capacity, revalidate=None):
+        with self.lock:
+            self.capacity = capacity
+            if revalidate is not None:
+                self.revalidate = revalidate
+            self._evict()
+
+    def acquire(self, path, cached_only=False):
+        '''Return a PooledFile for path, raising OSError like open().
+
+        With cached_only, return None instead of doing any I/O, which lets
+        event-loop callers try the pool before handing off to a thread.
+        '''
+        now = time.monotonic()
+        with self.lock:
+            entry = self.files.get(path)
+            if entry is not None and now - entry.checked < self.revalidate:
+                return self._lease(entry)
+        if cached_only:
+            return None
+        if entry is not None:
+            try:
+                fs = os.stat(path)
+            except OSError:
+                with self.lock:
+                    self._drop(entry)
+                raise
+            same = (fs.st_dev, fs.st_ino, fs.st_size, fs.st_mtime_ns) == (
+                entry.stat.st_dev, entry.stat.st_ino, entry.stat.st_size, entry.stat.st_mtime_ns)
+            with self.lock:
+                if same and not entry.retired:
+                    entry.checked = now
+                    return self._lease(entry)
+                self._drop(entry)
+        entry = OpenFile(path)
+        with self.lock:
+            self.opens += 1
+            old = self.files.pop(path, None)
+            if old is not None:
+                self._retire(old)
+            if self.capacity > 0:
+                self.files[path] = entry
+                self._evict()
+            else:
+                entry.retired = True
+            entry.users += 1
+        return PooledFile(self, entry)
+
+    def release(self, entry):
+        with self.lock:
+            entry.users -= 1
+            done = entry.retired and not entry.users
+        if done:
+            entry.close()
+
+    def _lease(self, entry):
+        # called with the lock held
+        self.files.move_to_end(entry.path)
+        self.hits += 1
+        entry.users += 1
+        return PooledFile(self, entry)
+
+    def _drop(self, entry):
+        # called with the lock held
+        if self.files.get(entry.path) is entry:
+            del self.files[entry.path]
+        self._retire(entry)
+
+    def _retire(self, entry):
+        entry.retired = True
+        if not entry.users:
+            entry.close()
+
+    def _evict(self):
+        while len(self.files) > max(self.capacity, 0):
+            path, entry = self.files.popitem(last=False)
+            self._retire(entry)
+
+FILE_POOL = FilePool()
+
+PROXY_PATH = '/proxy/'
+
+class RemoteCache(object):
+    """Block-aligned on-disk cache of remote files for the proxy mode.
+
+    Remote track URLs are served from /proxy/<scheme>/<host>/<path>. Each
+    block of block_size bytes is fetched from the origin with a range
+    request, kept as one file under directory, and evicted least recently
+    used first once the files take more than capacity bytes. Runs of
+    missing blocks are fetched in one request; a block already being
+    fetched by another request is waited for instead of fetched again.
+    Only origins of the project's own tracks are proxied.
+
+    The size, ETag and Last-Modified a url's blocks were fetched under are
+    kept next to them; when the origin reports other values, the file has
+    changed and its cached blocks are dropped. With shared set, as for
+    pre-forked workers on one directory, the directory is scanned again
+    before evicting, so the capacity holds for all of them together.
+    """
+    def __init__(self, directory=os.path.join("Cache", "remote"), capacity=0, block_size=1024*1024, window=16,
+                 timeout=30):
+        self.lock = threading.Lock()
+        self.directory = directory
+        self.block_size = block_size
+        self.window = window  # most blocks fetched by one origin request
+        self.timeout = timeout
+        self.capacity = capacity
+        self.shared = False
+        self.origins = set()
+        self.blocks = OrderedDict()  # block file name -> size, least recently used first
+        self.size = 0
+        self.pending = {}  # block file name -> Future of its data
+        self.meta = {}  # url -> (size, etag, last modified)
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+
+    def configure(self, capacity, origins):
+        # pick up the blocks of earlier runs, oldest first
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock:
+            self.capacity = capacity
+            self.origins = set(origins)
+            self._scan()
+        self._evict()
+
+    def _scan(self):
+        # the blocks in the directory, least recently used (by mtime) first; with the lock held
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith((".json", ".tmp")):
+                try:
+                    fs = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((fs.st_mtime, entry.name, fs.st_size))
+        self.blocks = OrderedDict((name, size) for mtime, name, size in sorted(entries))
+        self.size = sum(self.blocks.values())
+
+    def url_of(self, target):
+        # the remote URL of a /proxy/ request target, None unless its origin is proxied
+        parts = urllib.parse.urlsplit(target)
+        scheme, _, rest = parts.path[len(PROXY_PATH):].partition("/")
+        netloc, _, path = rest.partition("/")
+        if not self.capacity or scheme not in ("http", "https") or scheme + "://" + netloc not in self.origins:
+            return None
+        return "{}://{}/{}{}".format(scheme, netloc, path, "?" + parts.query if parts.query else "")
+
+    def key(self, url):
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def info(self, url):
+        '''(size, etag, last modified) of url, from the first block's response
+        when it is not known yet.
+        '''
+        with self.lock:
+            meta = self.meta.get(url)
+        if meta is None:
+            try:
+                with open(os.path.join(self.directory, self.key(url) + ".json")) as file:
+                    meta = tuple(json.load(file))
+            except (OSError, ValueError):
+                self.fetch_blocks(url, 0, 0)
+                if url not in self.meta:
+                    # block 0 was on disk without its .json
+                    self.fetch_run(url, [(0, futures.Future())])
+                meta = self.meta.get(url)
+                if meta is None:
+                    raise OSError("origin did not describe {}".format(url))
+            with self.lock:
+                self.meta[url] = meta
+        return meta
+
+    def read_range(self, url, first, last):
+        # yields bytes first..last (inclusive) of url, block by block
+        bs = self.block_size
+        for window in range(first // bs, last // bs + 1, self.window):
+            # a window of blocks at a time, so that long reads do not sit in memory
+            stop = min(window + self.window, last // bs + 1)
+            fresh = self.fetch_blocks(url, window, stop - 1)
+            for index in range(window, stop):
+                data = fresh.pop(index, None)
+                while data is None:
+                    # a block evicted before it is read may be stored again by
+                    # another request, which fetch_blocks then counts as a hit
+                    data = self.load(url, index)
+                    if data is None:
+                        data = self.fetch_blocks(url, index, index).get(index)
+                yield data[max(first - index * bs, 0):last + 1 - index * bs]
+
+    def load(self, url, index):
+        name = "%s.%d" % (self.key(url), index)
+        with self.lock:
+            if name not in self.blocks:
+                return None
+            self.blocks.move_to_end(name)
+        try:
+            with open(os.path.join(self.directory, name), "rb") as file:
+                if self.shared:
+                    # the other workers learn of the use from the mtime
+                    os.utime(file.fileno())
+                return file.read()
+        except FileNotFoundError:
+            with self.lock:
+                self.size -= self.blocks.pop(name, 0)
+            return None
+
+    def fetch_blocks(self, url, first, last):
+        '''Makes blocks first..last of url local. Returns {index: data} of the
+        blocks fetched here or by the requests this one waited for; blocks
+        that were already on disk are left there.
+        '''
+        key = self.key(url)
+        mine, waiting = [], []
+        with self.lock:
+            for index in range(first, last + 1):
+                name = "%s.%d" % (key, index)
+                if name in self.blocks:
+                    self.hits += 1
+                elif name in self.pending:
+                    waiting.append((index, self.pending[name]))
+                else:
+                    self.misses += 1
+                    future = self.pending[name] = futures.Future()
+                    mine.append((index, future))
+        # one request for every run of consecutive blocks claimed here
+        runs = []
+        for index, future in mine:
+            if runs and runs[-1][-1][0] == index - 1:
+                runs[-1].append((index, future))
+            else:
+                runs.append([(index, future)])
+        fetched = {}
+        try:
+            for run in runs:
+                fetched.update(self.fetch_run(url, run))
+        finally:
+            with self.lock:
+                for index, future in mine:
+                    self.pending.pop("%s.%d" % (key, index), None)
+                    if not future.done():
+                        future.set_exception(OSError("fetch of {} was abandoned".format(url)))
+        for index, future in waiting:
+            fetched[index] = future.result()
+        return fetched
+
+    def fetch_run(self, url, run):
+        bs = self.block_size
+        first, last = run[0][0] * bs, (run[-1][0] + 1) * bs - 1
+        request = urlrequest.Request(url, headers={"Range": "bytes=%d-%d" % (first, last)})
+        with self.lock:
+            self.fetches += 1
+        try:
+            response = urlrequest.urlopen(request, timeout=self.timeout)
+        except urlrequest.HTTPError as e:
+            if e.code != 416:
+                raise
+            # past the end of the file; from the first block on, the file is empty
+            if first == 0:
+                self._set_meta(url, (0, e.headers.get("ETag"), e.headers.get("Last-Modified")))
+            for index, future in run:
+                future.set_result(b"")
+            return {index: b"" for index, future in run}
+        fetched = {}
+        with response:
+            content_range = response.headers.get("Content-Range", "")
+            if response.status == 206 and "/" in content_range:
+                total = content_range.rpartition("/")[2]
+                total = int(total) if total.isdigit() else None
+            else:
+                # the origin ignored the range and sends the whole file, of unknown size when chunked
+                length = response.headers.get("Content-Length", "")
+                total = int(length) if length.isdigit() else None
+                skip = first
+                while skip > 0:
+                    skipped = len(response.read(min(skip, bs)))
+                    if not skipped:
+                        break
+                    skip -= skipped
+            meta = (total, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+            self._set_meta(url, meta)
+            for index, future in run:
+                data = response.read(bs)
+                if data:
+                    self._store(url, meta, "%s.%d" % (self.key(url), index), data)
+                future.set_result(data)
+                fetched[index] = data
+        return fetched
+
+    def _set_meta(self, url, meta):
+        # record what the origin reported for url; a change drops the blocks fetched before it
+        key = self.key(url)
+        with self.lock:
+            known = self.meta.get(url)
+            self.meta[url] = meta
+            if known == meta:
+                return
+            # blocks without a known description are dropped too, they cannot be validated
+            for name in os.listdir(self.directory):
+                if name.startswith(key + ".") and not name.endswith((".json", ".tmp")):
+                    self.size -= self.blocks.pop(name, 0)
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except FileNotFoundError:
+                        pass
+            path = os.path.join(self.directory, key + ".json")
+            os.replace(self._write_tmp(path, json.dumps(meta).encode("utf-8")), path)
+
+    def _write_tmp(self, path, data):
+        # data under a name of this thread next to path, to be renamed into place
+        tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        with open(tmp, "wb") as file:
+            file.write(data)
+        return tmp
+
+    def _store(self, url, meta, name, data):
+        if len(data) > self.capacity:
+            return
+        path = os.path.join(self.directory, name)
+        tmp = self._write_tmp(path, data)
+        with self.lock:
+            # a block of a version that changed while it was fetched is not kept
+            if self.meta.get(url) != meta:
+                os.remove(tmp)
+                return
+            os.replace(tmp, path)
+            self.size += len(data) - self.blocks.pop(name, 0)
+            self.blocks[name] = len(data)
+        self._evict()
+
+    def _evict(self):
+        with self.lock:
+            if self.shared and self.size > self.capacity:
+                # other workers add and evict blocks too; count what is there
+                self._scan()
+        while True:
+            with self.lock:
+                if self.size <= self.capacity or not self.blocks:
+                    return
+                name, size = self.blocks.popitem(last=False)
+                self.size -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+REMOTE_CACHE = RemoteCache()
+
+def proxy_response(target, headers, guess_type):
+    '''Answer to a /proxy/ request as (code, headers, body generator) or,
+    for errors, (code, message, None).
+    '''
+    url = REMOTE_CACHE.url_of(target)
+    if url is None:
+        return 404, "File not found", None
+    try:
+        size, etag, modified = REMOTE_CACHE.info(url)
+    except urlrequest.HTTPError as e:
+        return (e.code if e.code in (403, 404, 410) else 502), "Origin answered {}".format(e.code), None
+    except OSError as e:
+        return 502, "Origin unavailable: {}".format(e), None
+    if size is None:
+        return 502, "Origin did not report the file size", None
+    path = urllib.parse.urlsplit(url).path
+    ctype = guess_type(path)
+    validators = [("Accept-Ranges", "bytes"), ("Cache-Control", cache_control(path))]
+    if etag:
+        validators.append(("ETag", etag))
+    if modified:
+        validators.append(("Last-Modified", modified))
+    ranges = []
+    if "Range" in headers and (not headers.get("If-Range") or headers.get("If-Range") in (etag, modified)):
+        try:
+            ranges = parse_byte_range(headers["Range"])
+        except ValueError:
+            return 400, "Invalid byte range", None
+    if not ranges:
+        return 200, [("Content-type", ctype), ("Content-Length", str(size))] + validators, \
+            REMOTE_CACHE.read_range(url, 0, size - 1)
+    ranges = resolve_byte_ranges(ranges, size)
+    if not ranges:
+        return 416, [("Content-Range", "bytes */%s" % size), ("Content-Length", "0")], None
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        return 206, [("Content-type", ctype), ("Content-Range", "bytes %s-%s/%s" % (first, last, size)),
+                     ("Content-Length", str(last - first + 1))] + validators, \
+            REMOTE_CACHE.read_range(url, first, last)
+    boundary, parts, length = multipart_byteranges(ranges, ctype, size)
+    def multipart():
+        for part, (first, last) in zip(parts, ranges):
+            yield part
+            for data in REMOTE_CACHE.read_range(url, first, last):
+                yield data
+        yield parts[-1]
+    return 206, [("Content-type", "multipart/byteranges; boundary=%s" % boundary),
+                 ("Content-Length", str(length))] + validators, multipart()
+
+METRICS_PATH = '/metrics'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RANGE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1 KiB .. 256 MiB
+
+class Histogram(object):
+    """Counts of observations per bucket upper bound, Prometheus style."""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q, counts=None):
+        # upper bound of the bucket holding the q-quantile
+        counts = counts or self.counts
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0.0
+
+class Metrics(object):
+    """Request counters and histograms by track, status code and client.
+
+    Handlers call observe() once per response, which costs one lock and a
+    few dict updates. render() formats everything, with the block cache and
+    file pool counters, as Prometheus text for METRICS_PATH. Only files that
+    were found count as tracks; other paths are labelled "-" so that probes
+    for missing files cannot grow the label set.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # (track, code) -> count
+        self.sent = {}      # track -> bytes
+        self.clients = {}   # client -> [requests, bytes]
+        self.latency = {}   # track -> Histogram
+        self.ranges = {}    # track -> Histogram
+        self.total_latency = Histogram(LATENCY_BUCKETS)
+        self.tag = "[metrics]"
+
+    def observe(self, track, code, client, seconds, sent, ranges=()):
+        track = track or '-'
+        with self.lock:
+            self.requests[(track, code)] = self.requests.get((track, code), 0) + 1
+            self.sent[track] = self.sent.get(track, 0) + sent
+            counts = self.clients.setdefault(client, [0, 0])
+            counts[0] += 1
+            counts[1] += sent
+            if track not in self.latency:
+                self.latency[track] = Histogram(LATENCY_BUCKETS)
+            self.latency[track].observe(seconds)
+            self.total_latency.observe(seconds)
+            for first, last in ranges:
+                if track not in self.ranges:
+                    self.ranges[track] = Histogram(RANGE_BUCKETS)
+                self.ranges[track].observe(last - first + 1)
+
+    def render(self):
+        out = []
+        def family(name, kind, text):
+            out.append('# HELP %s %s\n# TYPE %s %s\n' % (name, text, name, kind))
+        def sample(name, labels, value):
+            out.append('%s{%s} %s\n' % (name, ','.join('%s="%s"' % (key, label_value(value_))
+                                                      for key, value_ in labels), format_number(value)))
+        def histogram(name, hists, label):
+            for key, hist in sorted(hists.items()):
+                cumulative = 0
+                for bound, count in zip(hist.buckets + (float('inf'),), hist.counts):
+                    cumulative += count
+                    sample(name + '_bucket', [(label, key), ('le', format_number(bound))], cumulative)
+                sample(name + '_sum', [(label, key)], hist.sum)
+                sample(name + '_count', [(label, key)], hist.count)
+
+        with self.lock:
+            family('igv_requests_total', 'counter', 'Responses by track and status code.')
+            for (track, code), count in sorted(self.requests.items()):
+                sample('igv_requests_total', [('track', track), ('code', code)], count)
+            family('igv_sent_bytes_total', 'counter', 'Body bytes sent by track.')
+            for track, count in sorted(self.sent.items()):
+                sample('igv_sent_bytes_total', [('track', track)], count)
+            family('igv_client_requests_total', 'counter', 'Responses by client address.')
+            for client, (count, sent) in sorted(self.clients.items()):
+                sample('igv_client_requests_total', [('client', client)], count)
+            family('igv_client_sent_bytes_total', 'counter', 'Body bytes sent by client address.')
+            for client, (count, sent) in sorted(self.clients.items()):
+                sample('igv_client_sent_bytes_total', [('client', client)], sent)
+            family('igv_request_duration_seconds', 'histogram', 'Time from request line to last body byte.')
+            histogram('igv_request_duration_seconds', self.latency, 'track')
+            family('igv_range_bytes', 'histogram', 'Size of each requested byte range.')
+            histogram('igv_range_bytes', self.ranges, 'track')
+        for name, text, value in (
+                ('igv_block_cache_hits_total', 'Block cache lookups served from memory.', BLOCK_CACHE.hits),
+                ('igv_block_cache_misses_total', 'Block cache lookups read from disk.', BLOCK_CACHE.misses),
+                ('igv_file_pool_hits_total', 'Requests served from an already open file.', FILE_POOL.hits),
+                ('igv_file_pool_opens_total', 'Files opened and mapped.', FILE_POOL.opens),
+                ('igv_remote_cache_hits_total', 'Proxied blocks found in the disk cache.', REMOTE_CACHE.hits),
+                ('igv_remote_cache_misses_total', 'Proxied blocks fetched from the origin.', REMOTE_CACHE.misses),
+                ('igv_remote_fetches_total', 'Range requests sent to origins.', REMOTE_CACHE.fetches),
+                ('igv_readahead_hits_total', 'BAM ranges served from prefetched segments.', READAHEAD.hits),
+                ('igv_readahead_misses_total', 'BAM ranges not prefetched.', READAHEAD.misses),
+                ('igv_readahead_prefetched_bytes_total', 'Bytes read ahead of requests.', READAHEAD.prefetched)):
+            family(name, 'counter', text)
+            out.append('%s %s\n' % (name, value))
+        active, queued, waits = SCHEDULER.snapshot()
+        family('igv_scheduler_active', 'gauge', 'Response bodies being sent, by priority class.')
+        for name, count in zip(PRIORITY_CLASSES, active):
+            sample('igv_scheduler_active', [('class', name)], count)
+        family('igv_scheduler_queued', 'gauge', 'Response bodies waiting for a slot, by priority class.')
+        for name, count in zip(PRIORITY_CLASSES, queued):
+            sample('igv_scheduler_queued', [('class', name)], count)
+        family('igv_scheduler_wait_seconds', 'histogram', 'Time response bodies waited for a slot.')
+        histogram('igv_scheduler_wait_seconds', waits, 'class')
+        family('igv_block_cache_bytes', 'gauge', 'Bytes held by the block cache.')
+        out.append('igv_block_cache_bytes %s\n' % BLOCK_CACHE.size)
+        family('igv_remote_cache_bytes', 'gauge', 'Bytes held by the proxy disk cache.')
+        out.append('igv_remote_cache_bytes %s\n' % REMOTE_CACHE.size)
+        family('igv_readahead_bytes', 'gauge', 'Bytes held in prefetched segments.')
+        out.append('igv_readahead_bytes %s\n' % READAHEAD.size)
+        return ''.join(out)
+
+    def summary(self, previous, interval):
+        # one stderr line on the traffic since the previous snapshot; returns the new snapshot
+        with self.lock:
+            current = (sum(self.requests.values()), dict(self.sent), list(self.total_latency.counts),
+                       BLOCK_CACHE.hits, BLOCK_CACHE.misses, FILE_POOL.hits, FILE_POOL.opens,
+                       READAHEAD.hits, READAHEAD.misses)
+        if previous is None:
+            return current
+        requests = current[0] - previous[0]
+        sent = {track: count - previous[1].get(track, 0) for track, count in current[1].items()}
+        latency = [now - before for now, before in zip(current[2], previous[2])]
+        cache = [now - before for now, before in zip(current[3:], previous[3:])]
+        top = sorted((count, track) for track, count in sent.items() if count)[-5:]
+        active, queued, waits = SCHEDULER.snapshot()
+        print("{} {:g}s: {} req ({:.1f}/s), {:.1f} MB ({:.2f} MB/s), p50 <={:g} ms, p95 <={:g} ms, "
+              "block cache {}, file pool {}, readahead {}, queued {}; top: {}".format(
+                  self.tag, interval, requests, requests / interval, sum(sent.values()) / 1e6,
+                  sum(sent.values()) / 1e6 / interval,
+                  1000 * self.total_latency.quantile(0.5, latency), 1000 * self.total_latency.quantile(0.95, latency),
+                  hit_rate(cache[0], cache[0] + cache[1]), hit_rate(cache[2], cache[2] + cache[3]),
+                  hit_rate(cache[4], cache[4] + cache[5]),
+                  "/".join(str(count) for count in queued),
+                  ", ".join("{} {:.1f} MB".format(track, count / 1e6) for count, track in reversed(top)) or "-"),
+              file=sys.stderr)
+        return current
+
+    def report_every(self, interval):
+        # print summary() lines from a daemon thread
+        def loop():
+            snapshot = self.summary(None, interval)
+            while True:
+                time.sleep(interval)
+                snapshot = self.summary(snapshot, interval)
+        threading.Thread(target=loop, name="metrics", daemon=True).start()
+
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+def hit_rate(hits, lookups):
+    return "{:.0f}% hit".format(100.0 * hits / lookups) if lookups else "idle"
+
+METRICS = Metrics()
+
+# priority classes of the scheduler, most urgent first
+PRIORITY_CLASSES = ("index", "small", "bulk")
+INDEX, SMALL, BULK = range(len(PRIORITY_CLASSES))
+# what a page needs before it shows anything: indexes, the page and igv.js
+INDEX_SUFFIXES = ('.bai', '.csi', '.crai', '.tbi', '.fai', '.gzi', '.html', '.htm', '.js', '.css', '.json')
+SMALL_REQUEST = 256 * 1024
+THROTTLE_CHUNK = 256 * 1024
+
+def request_priority(path, length=None):
+    # bodies of unknown length (generated, proxied whole) count as bulk
+    if path.endswith(INDEX_SUFFIXES) or path == '/':
+        return INDEX
+    if length is not None and length <= SMALL_REQUEST:
+        return SMALL
+    return BULK
+
+def throttle_chunks(first, last):
+    # [first, last] in THROTTLE_CHUNK pieces while a client rate is set, else in one piece
+    step = THROTTLE_CHUNK if SCHEDULER.client_rate else max(1, last + 1 - first)
+    return [(offset, min(last, offset + step - 1)) for offset in range(first, last + 1, step)]
+
+class Ticket(object):
+    """One response body waiting for, or holding, a scheduler slot."""
+    def __init__(self, client, priority, wake):
+        self.client = client
+        self.priority = priority
+        self.wake = wake
+        self.queued = time.monotonic()
+        self.state = 'queued'
+
+class RequestScheduler(object):
+    """Admits response bodies to a bounded number of concurrent transfers.
+
+    Waiting bodies start by priority class: indexes and the page, then small
+    reads such as track headers, then bulk reads (BAM chunks, whole files,
+    generated bodies). Bulk transfers never hold the last quarter of the
+    slots, so an index fetch does not queue behind a screenful of BAM
+    chunks. Within a class the client with the fewest transfers running
+    goes first, and clients may be capped in running transfers and in
+    bytes per second. The same scheduler serves both engines: acquire()
+    calls wake() when a queued ticket may start.
+    """
+    def __init__(self, slots=16, per_client=0, client_rate=0):
+        self.lock = threading.Lock()
+        self.active = [0] * len(PRIORITY_CLASSES)
+        self.running = {}  # client -> transfers running
+        # per class: client -> deque of tickets, the client served longest ago first
+        self.waiting = [OrderedDict() for name in PRIORITY_CLASSES]
+        self.ready = {}  # client -> time until which its bandwidth is spent
+        self.waits = [Histogram(LATENCY_BUCKETS) for name in PRIORITY_CLASSES]
+        self.configure(slots, per_client, client_rate)
+
+    def configure(self, slots, per_client=0, client_rate=0):
+        # 0 slots admits everything at once, which only keeps the fairness counters
+        self.slots = slots
+        self.bulk_slots = max(1, slots - slots // 4)
+        self.per_client = per_client
+        self.client_rate = client_rate  # bytes per second, 0 for no limit
+
+    def acquire(self, client, priority, wake):
+        '''(ticket, started): a body that may start now, or that wake() is
+        called for, from the thread releasing a slot, once it may. Either
+        way the ticket ends with release().
+        '''
+        ticket = Ticket(client, priority, wake)
+        with self.lock:
+            self.waiting[priority].setdefault(client, deque()).append(ticket)
+            started = self._dispatch()
+        for other in started:
+            if other is not ticket:
+                other.wake()
+        return ticket, ticket.state == 'running'
+
+    def release(self, ticket):
+        # a finished body frees its slot; a queued one (its request was cancelled) leaves the queue
+        with self.lock:
+            if ticket.state == 'running':
+                self.active[ticket.priority] -= 1
+                self.running[ticket.client] -= 1
+                if not self.running[ticket.client]:
+                    del self.running[ticket.client]
+            elif ticket.state == 'queued':
+                queue = self.waiting[ticket.priority][ticket.client]
+                queue.remove(ticket)
+                if not queue:
+                    del self.waiting[ticket.priority][ticket.client]
+            ticket.state = 'done'
+            started = self._dispatch()
+        for other in started:
+            other.wake()
+
+    def _free(self, priority):
+        if not self.slots:
+            return True
+        if sum(self.active) >= self.slots:
+            return False
+        return priority != BULK or self.active[BULK] < self.bulk_slots
+
+    def _dispatch(self):
+        # start queued tickets while there are free slots; returns them
+        started = []
+        for priority, queues in enumerate(self.waiting):
+            while queues and self._free(priority):
+                eligible = [client for client in queues
+                            if not self.per_client or self.running.get(client, 0) < self.per_client]
+                if not eligible:
+                    break
+                client = min(eligible, key=lambda client: self.running.get(client, 0))
+                ticket = queues[client].popleft()
+                if queues[client]:
+                    queues.move_to_end(client)
+                else:
+                    del queues[client]
+                ticket.state = 'running'
+                self.active[priority] += 1
+                self.running[client] = self.running.get(client, 0) + 1
+                self.waits[priority].observe(time.monotonic() - ticket.queued)
+                started.append(ticket)
+        return started
+
+    def delay(self, client, size):
+        '''Seconds to wait before sending size more bytes to client, so that
+        it stays under client_rate after a burst of up to a second.
+        '''
+        if not self.client_rate:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            ready = max(self.ready.get(client, now), now) + size / self.client_rate
+            self.ready[client] = ready
+            if len(self.ready) > 4096:
+                self.ready = {key: value for key, value in self.ready.items() if value > now}
+        return max(0.0, ready - now - 1.0)
+
+    def snapshot(self):
+        # (running, queued, wait histograms) by class, for /metrics and the summary line
+        with self.lock:
+            queued = [sum(len(queue) for queue in queues.values()) for queues in self.waiting]
+            waits = {}
+            for name, hist in zip(PRIORITY_CLASSES, self.waits):
+                waits[name] = Histogram(hist.buckets)
+                waits[name].counts, waits[name].sum, waits[name].count = list(hist.counts), hist.sum, hist.count
+            return list(self.active), queued, waits
+
+SCHEDULER = RequestScheduler()
+
+DOWNSAMPLE_PATH = '/downsample'
+LOCUS_RE = re.compile(r'(.+?)(?::([\d,]+)(?:-([\d,]+))?)?$')
+
+def parse_downsample(target, translate_path):
+    '''Reads /downsample/<bam>?locus=chr:start-end&depth=&window=&seed=
+    into the bam path and the arguments of igv_bam.downsample_bam; raises
+    ValueError for a malformed query.
+    '''
+    parts = urllib.parse.urlsplit(target)
+    query = urllib.parse.parse_qs(parts.query)
+    match = LOCUS_RE.match(query.get('locus', [''])[0].strip())
+    if not match:
+        raise ValueError('locus=chr:start-end is required')
+    name, start, end = match.groups()
+    beg = int(start.replace(',', '')) - 1 if start else 0
+    end = int(end.replace(',', '')) if end else beg + 1 if start else None
+    numbers = {}
+    for key, default in (('depth', 100), ('window', 100), ('seed', 0)):
+        try:
+            numbers[key] = int(query.get(key, [default])[0])
+        except ValueError:
+            raise ValueError('{} must be an integer'.format(key))
+    bam = translate_path(parts.path[len(DOWNSAMPLE_PATH):])
+    return bam, (name, max(beg, 0), end, numbers['depth'], numbers['window'], numbers['seed'])
+
+SEQUENCE_PATH = '/sequence'
+# most bases one /sequence request returns
+MAX_SEQUENCE = 10 * 1000 * 1000
+SEQUENCE_ERRORS = (ValueError, IndexError, struct.error)
+SEQUENCE_NEEDS = 'Decoding .2bit needs numpy'
+TWOBIT_INDEXES = {}  # path -> (mtime_ns, byte order, {sequence name: record offset})
+
+def parse_sequence(target, translate_path):
+    '''Reads /sequence/<2bit>?locus=chr:start-end&mask=0 into the .2bit path
+    and the arguments of read_sequence; raises ValueError for a malformed
+    query. mask=0 returns upper case only.
+    '''
+    parts = urllib.parse.urlsplit(target)
+    query = urllib.parse.parse_qs(parts.query)
+    match = LOCUS_RE.match(query.get('locus', [''])[0].strip())
+    if not match or not match.group(3):
+        raise ValueError('locus=chr:start-end is required')
+    name, start, end = match.groups()
+    beg, end = int(start.replace(',', '')) - 1, int(end.replace(',', ''))
+    if not 0 <= beg < end:
+        raise ValueError('empty interval {}:{}-{}'.format(name, beg + 1, end))
+    if end - beg > MAX_SEQUENCE:
+        raise ValueError('at most {} bases per request'.format(MAX_SEQUENCE))
+    mask = query.get('mask', ['1'])[0].lower() not in ('0', 'false', 'no')
+    return translate_path(parts.path[len(SEQUENCE_PATH):]), (name, beg, end, mask)
+
+def read_sequence(path, name, beg, end, mask):
+    # bases of a .2bit region, decoded from its pooled mapping; the index is read once per mtime
+    with FILE_POOL.acquire(path) as f:
+        buf = f.entry.map if f.entry.map is not None else f.read()
+        known = TWOBIT_INDEXES.get(path)
+        if known is None or known[0] != f.stat.st_mtime_ns:
+            known = TWOBIT_INDEXES[path] = (f.stat.st_mtime_ns,) + igv_twobit.read_index(buf)
+        if name not in known[2]:
+            raise ValueError('unknown sequence {}'.format(name))
+        return igv_twobit.decode(buf, known[1], known[2][name], beg, end, mask)
+
+API_PATH = '/api/tracks'
+EVENTS_PATH = '/api/events'
+API_INPUTS = ("bam", "bigwig", "gtf", "bed", "coverage", "index")
+MAX_API_BODY = 64 * 1024
+
+def is_api_path(path):
+    return path == API_PATH or path.startswith(API_PATH + '/')
+
+def is_local(host):
+    # loopback clients, also when they come as IPv4-mapped IPv6 addresses
+    try:
+        address = ipaddress.ip_address(host.partition('%')[0])
+    except ValueError:
+        return False
+    mapped = getattr(address, 'ipv4_mapped', None)
+    return address.is_loopback or (mapped is not None and mapped.is_loopback)
+
+LOCAL_NAMES = ("localhost", "127.0.0.1", "[::1]")
+
+def is_local_origin(headers, port):
+    # the Host a browser sends is the name it looked up, so a site rebound to
+    # 127.0.0.1 by DNS is still named by its own Host (and Origin)
+    host = headers.get('Host', '').strip().lower()
+    names = ["{}:{}".format(name, port) for name in LOCAL_NAMES] + (list(LOCAL_NAMES) if port == 80 else [])
+    if host not in names:
+        return False
+    origin = headers.get('Origin')
+    return origin is None or origin.strip().lower() == "http://" + host
+
+def add_tracks(inputs):
+    '''Registers the tracks of a control API request, given as on the command
+    line: {"bam": [...], "bigwig": [...], "gtf": [...], "bed": path,
+    "coverage": bin size, "index": true}. Returns the ids added or changed.
+    '''
+    if not isinstance(inputs, dict) or not set(inputs) <= set(API_INPUTS):
+        raise ValueError("expected an object with any of {}".format(", ".join(API_INPUTS)))
+    def paths(value):
+        if isinstance(value, str):
+            return [value]
+        if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+            raise ValueError("expected a path or a list of paths, not {!r}".format(value))
+        return value
+    before = dict(get_manifest().tracks())
+    if inputs.get("bam"):
+        coverage = inputs.get("coverage")
+        build_bam_tracks(paths(inputs["bam"]), int(coverage) if coverage else None, bool(inputs.get("index")))
+    if inputs.get("bigwig"):
+        build_bw_tracks(paths(inputs["bigwig"]))
+    if inputs.get("gtf"):
+        build_gtf_tracks(paths(inputs["gtf"]))
+    if inputs.get("bed"):
+        for bed in paths(inputs["bed"]):
+            build_bed_tracks(bed)
+    return [track_id for track_id, track in get_manifest().tracks() if before.get(track_id) != track]
+
+def api_error(message):
+    return json.dumps({"error": message}).encode('utf-8')
+
+def api_response(method, target, headers, body, host, port):
+    '''Answer to a control API request as (code, JSON body). GET lists the
+    page, or one track by id; POST adds tracks; DELETE /api/tracks/<id>
+    removes a track with its coverage. Only local clients may change the
+    tracks, and only with an application/json body, which a page of
+    another site cannot send without a CORS preflight this server refuses.
+    Changes must also name this server on a loopback name and port in Host,
+    and in Origin when it is sent, against DNS rebinding.
+    '''
+    path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+    track_id = path[len(API_PATH) + 1:]
+    if method in ('GET', 'HEAD'):
+        if not track_id:
+            return 200, TRACK_FEED.current()[1]
+        track = get_manifest().get(track_id)
+        if track is None:
+            return 404, api_error("{} is not a registered track".format(track_id))
+        return 200, json.dumps({"id": track_id, "config": track}, sort_keys=True).encode('utf-8')
+    if not is_local(host):
+        return 403, api_error("only local clients may change the tracks")
+    if not is_local_origin(headers, port):
+        return 403, api_error("changes must be addressed to localhost:{} by a page of this server".format(port))
+    if method == 'DELETE' and track_id:
+        removed = remove_track(track_id)
+        if not removed:
+            return 404, api_error("{} is not a registered track".format(track_id))
+        return 200, json.dumps({"removed": removed}).encode('utf-8')
+    if method == 'POST' and not track_id:
+        if headers.get('Content-Type', '').partition(';')[0].strip().lower() != 'application/json':
+            return 415, api_error("send the inputs as application/json")
+        try:
+            added = add_tracks(json.loads(body or b'null'))
+        except (OSError, ValueError, TypeError, zlib.error) as e:
+            return 400, api_error(str(e))
+        return 200, json.dumps({"added": added}).encode('utf-8')
+    return 405, api_error("{} is not supported on {}".format(method, path))
+
+class TrackFeed(object):
+    """The track list of /api/tracks and its change notices on /api/events.
+
+    Any worker, or an igv_web.py -ab/-rb run next to the server, may change
+    the manifest, so its version is polled (one indexed read per interval)
+    and the list is rendered again only when the version moved.
+    """
+    interval = 1.0
+    heartbeat = 15.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rendered = (None, None)  # (version, JSON body)
+        self.closed = threading.Event()
+
+    def current(self):
+        version = get_manifest().version()
+        with self.lock:
+            if self.rendered[0] == version:
+                return self.rendered
+        rendered = (version, json.dumps(track_list(), sort_keys=True).encode('utf-8'))
+        with self.lock:
+            self.rendered = rendered
+        return rendered
+
+    def poll(self, last, idle):
+        # the next message for a client that has seen version last and has been sent nothing for idle seconds
+        version, body = self.current()
+        if version != last:
+            return version, b'id: %d\nevent: tracks\ndata: %s\n\n' % (version, body)
+        if idle >= self.heartbeat:
+            # comments keep proxies from timing out and show when the page is gone
+            return version, b': keep-alive\n\n'
+        return version, None
+
+    def stream(self, last=None):
+        # the event stream of one client, for the thread engine; ends when close() is called
+        yield b'retry: 3000\n\n'
+        idle = 0.0
+        while not self.closed.is_set():
+            last, message = self.poll(last, idle)
+            if message is not None:
+                idle = 0.0
+                yield message
+            self.closed.wait(self.interval)
+            idle += self.interval
+
+    def close(self):
+        self.closed.set()
+
+TRACK_FEED = TrackFeed()
+
+def last_event_id(headers):
+    # where a reconnecting EventSource left off
+    try:
+        return int(headers.get('Last-Event-ID', ''))
+    except ValueError:
+        return None
 
 class RangeRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     """Adds support for HTTP 'Range' requests to SimpleHTTPRequestHandler
@@ -437,77 +2958,917 @@ class RangeRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     The approach is to:
     - Override send_head to look for 'Range' and respond appropriately.
     - Override copyfile to only transmit a range when requested.
+
+    Range sets with more than one range (after merging) are answered with a
+    multipart/byteranges body, one part per range in file order.
+
+    When use_sendfile is set, copyfile hands both ranged and full-file bodies
+    to os.sendfile and only falls back to the buffered loop when the
+    connection is not a plain socket.
     """
+    use_sendfile = True
+    use_compression = True
+
+    def handle_one_request(self):
+        # time each request and hand it to METRICS once the body is out
+        self.started = time.perf_counter()
+        self.status = None
+        self.track = None
+        self.range = None
+        self.bytes_sent = 0
+        SimpleHTTPServer.SimpleHTTPRequestHandler.handle_one_request(self)
+        if self.status is not None:
+            METRICS.observe(self.track, self.status, self.client_address[0],
+                            time.perf_counter() - self.started, self.bytes_sent, self.range or ())
+
+    def send_response(self, code, message=None):
+        self.status = code
+        SimpleHTTPServer.SimpleHTTPRequestHandler.send_response(self, code, message)
+
     def send_head(self):
-        if 'Range' not in self.headers:
-            self.range = None
-            return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
-        try:
-            self.range = parse_byte_range(self.headers['Range'])
-        except ValueError as e:
-            self.send_error(400, 'Invalid byte range')
-            return None
-        first, last = self.range
+        self.range = None
+        self.range_parts = None
+        self.file_stat = None
+        if urllib.parse.urlsplit(self.path).path == METRICS_PATH:
+            return self.send_metrics()
+        if urllib.parse.urlsplit(self.path).path.startswith(DOWNSAMPLE_PATH + '/'):
+            return self.send_downsample()
+        if urllib.parse.urlsplit(self.path).path.startswith(SEQUENCE_PATH + '/'):
+            return self.send_sequence()
+        if urllib.parse.urlsplit(self.path).path.startswith(PROXY_PATH):
+            return self.send_proxy()
+        if is_api_path(urllib.parse.urlsplit(self.path).path):
+            return self.send_api()
+        if urllib.parse.urlsplit(self.path).path == EVENTS_PATH:
+            return self.send_events()
 
         # Mirroring SimpleHTTPServer.py here
         path = self.translate_path(self.path)
-        f = None
+        if os.path.isdir(path):
+            index = [os.path.join(path, name) for name in ('index.html', 'index.htm')
+                     if os.path.isfile(os.path.join(path, name))]
+            if not index or not urllib.parse.urlsplit(self.path).path.endswith('/'):
+                # directory redirects and listings stay with SimpleHTTPRequestHandler
+                return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+            path = index[0]
+        if path.endswith('/'):
+            self.send_error(404, 'File not found')
+            return None
         ctype = self.guess_type(path)
         try:
-            f = open(path, 'rb')
-        except IOError:
+            f = FILE_POOL.acquire(path)
+        except OSError:
             self.send_error(404, 'File not found')
             return None
-
-        fs = os.fstat(f.fileno())
+        self.track = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        try:
+            return self.send_file_head(path, f, ctype)
+        except BaseException:
+            f.close()
+            raise
+
+    def send_file_head(self, path, f, ctype):
+        # headers for a pooled file; returns f when a body follows, else closes it
+        compressed = self.use_compression and negotiate_encoding(path, f.stat, self.headers)
+        if compressed:
+            return self.send_compressed(path, f, ctype, *compressed)
+        fs = self.file_stat = f.stat
         file_len = fs[6]
-        if first >= file_len:
-            self.send_error(416, 'Requested Range Not Satisfiable')
+        etag = file_etag(fs)
+        if is_not_modified(self.headers, fs, etag):
+            f.close()
+            self.send_response(304)
+            self.send_validators(path, fs, etag)
+            self.end_headers()
+            return None
+
+        ranges = []
+        # a stale If-Range turns the request into a plain GET of the whole file
+        if 'Range' in self.headers and if_range_matches(self.headers, fs, etag):
+            try:
+                ranges = parse_byte_range(self.headers['Range'])
+            except ValueError as e:
+                f.close()
+                self.send_error(400, 'Invalid byte range')
+                return None
+        if not ranges:
+            self.send_response(200)
+            self.send_header('Content-type', ctype)
+            self.send_header('Content-Length', str(file_len))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_validators(path, fs, etag)
+            self.end_headers()
+            return f
+
+        self.range = resolve_byte_ranges(ranges, file_len)
+        if not self.range:
+            f.close()
+            self.send_response(416, 'Requested Range Not Satisfiable')
+            self.send_header('Content-Range', 'bytes */%s' % file_len)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
             return None
 
         self.send_response(206)
-        self.send_header('Content-type', ctype)
         self.send_header('Accept-Ranges', 'bytes')
 
-        if last is None or last >= file_len:
-            last = file_len - 1
-        response_length = last - first + 1
+        if len(self.range) == 1:
+            first, last = self.range[0]
+            response_length = last - first + 1
+            self.send_header('Content-type', ctype)
+            self.send_header('Content-Range',
+                             'bytes %s-%s/%s' % (first, last, file_len))
+        else:
+            boundary, self.range_parts, response_length = multipart_byteranges(self.range, ctype, file_len)
+            self.send_header('Content-type', 'multipart/byteranges; boundary=%s' % boundary)
 
-        self.send_header('Content-Range',
-                         'bytes %s-%s/%s' % (first, last, file_len))
         self.send_header('Content-Length', str(response_length))
-        self.send_header('Last-Modified', self.date_time_string(fs.st_mtime))
+        self.send_validators(path, fs, etag)
         self.end_headers()
         return f
 
-    def copyfile(self, source, outputfile):
-        if not self.range:
-            return SimpleHTTPServer.SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
+    def send_compressed(self, path, f, ctype, encoding, sidecar):
+        # a sidecar with its length, else gzip on the fly until the end of the connection
+        fs = f.stat
+        body = None
+        if sidecar is not None:
+            try:
+                body = FILE_POOL.acquire(sidecar)
+            except OSError:
+                encoding = 'gzip'
+        etag = encoded_etag(fs, encoding, body is None)
+        if is_not_modified(self.headers, fs, etag):
+            f.close()
+            if body is not None:
+                body.close()
+            self.send_response(304)
+            self.send_validators(path, fs, etag)
+            self.end_headers()
+            return None
+        self.send_response(200)
+        self.send_header('Content-type', ctype)
+        self.send_header('Content-Encoding', encoding)
+        if body is not None:
+            f.close()
+            self.file_stat = body.stat
+            self.send_header('Content-Length', str(body.stat.st_size))
+        elif self.command == 'HEAD':
+            # a generator that never starts would not close f
+            f.close()
+        else:
+            body = gzip_stream(f)
+            self.close_connection = True
+        self.send_validators(path, fs, etag)
+        self.end_headers()
+        return body
+
+    def send_metrics(self):
+        body = METRICS.render().encode('utf-8')
+        self.track = METRICS_PATH
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def send_api(self, body=b''):
+        code, body = api_response(self.command, self.path, self.headers, body, self.client_address[0],
+                                  self.server.server_address[1])
+        self.track = API_PATH
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def do_POST(self):
+        # control API requests; GET and HEAD go through send_head
+        if not is_api_path(urllib.parse.urlsplit(self.path).path):
+            self.send_error(501, 'Unsupported method (%r)' % self.command)
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            self.send_error(400, 'Bad Content-Length')
+            return
+        if length > MAX_API_BODY:
+            self.close_connection = True
+            self.send_error(413)
+            return
+        body = self.send_api(self.rfile.read(length)).getvalue()
+        self.wfile.write(body)
+        self.bytes_sent += len(body)
+
+    do_DELETE = do_POST
+
+    def send_events(self):
+        # server-sent events until the client goes away or the server stops
+        self.track = EVENTS_PATH
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        return TRACK_FEED.stream(last_event_id(self.headers))
+
+    def send_downsample(self):
+        # a generator of BGZF blocks of unknown total length: no Content-Length, close when done
+        try:
+            bam, args = parse_downsample(self.path, self.translate_path)
+            blocks = igv_bam.downsample_bam(bam, *args)
+        except OSError:
+            self.send_error(404, 'File not found')
+            return None
+        except (ValueError, zlib.error) as e:
+            self.send_error(400, str(e))
+            return None
+        self.track = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-type', 'application/octet-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        return blocks
+
+    def send_sequence(self):
+        try:
+            path, args = parse_sequence(self.path, self.translate_path)
+            body = read_sequence(path, *args)
+        except OSError:
+            self.send_error(404, 'File not found')
+            return None
+        except SEQUENCE_ERRORS as e:
+            self.send_error(400, str(e))
+            return None
+        except ImportError:
+            self.send_error(501, SEQUENCE_NEEDS)
+            return None
+        self.track = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', cache_control(path))
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def send_proxy(self):
+        code, headers, body = proxy_response(self.path, self.headers, self.guess_type)
+        if isinstance(headers, str):
+            self.send_error(code, headers)
+            return None
+        self.track = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        self.send_response(code)
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        return body
 
+    def send_validators(self, path, fs, etag):
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(fs.st_mtime))
+        self.send_header('Cache-Control', cache_control(path))
+        if self.use_compression and is_compressible(path):
+            self.send_header('Vary', 'Accept-Encoding')
+
+    def copy_range(self, source, outputfile, start=None, stop=None):
+        fs = self.file_stat  # set in send_head()
+        if fs is None or not SCHEDULER.client_rate:
+            return self.copy_slice(source, outputfile, start, stop)
+        for first, last in throttle_chunks(start or 0, fs.st_size - 1 if stop is None else stop):
+            time.sleep(SCHEDULER.delay(self.client_address[0], last + 1 - first))
+            self.copy_slice(source, outputfile, first, last)
+
+    def copy_slice(self, source, outputfile, start=None, stop=None):
+        fs = self.file_stat
+        if fs is not None:
+            self.bytes_sent += (fs.st_size - 1 if stop is None else stop) + 1 - (start or 0)
+            data = READAHEAD.read(source.name, fs.st_mtime_ns, start or 0, fs.st_size - 1 if stop is None else stop)
+            if data is not None:
+                outputfile.write(data)
+                return
+        if fs is not None and BLOCK_CACHE.accepts(source.name, start or 0, fs.st_size - 1 if stop is None else stop):
+            outputfile.write(BLOCK_CACHE.read_range(source.name, fs.st_mtime_ns, start or 0,
+                                                    fs.st_size - 1 if stop is None else stop, source))
+            return
         # SimpleHTTPRequestHandler uses shutil.copyfileobj, which doesn't let
         # you stop the copying before the end of the file.
-        start, stop = self.range  # set in send_head()
+        if self.use_sendfile and outputfile is self.wfile:
+            outputfile.flush()
+            if sendfile_byte_range(source, self.connection, start, stop):
+                return
+        if isinstance(source, PooledFile):
+            # straight from the mapping, without a read buffer
+            if fs.st_size:
+                with source.view(start or 0, fs.st_size - 1 if stop is None else stop) as view:
+                    outputfile.write(view)
+            return
+        if start is None and stop is None:
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
         copy_byte_range(source, outputfile, start, stop)
 
+    def copyfile(self, source, outputfile):
+        # bodies wait for a SCHEDULER slot; in-memory answers and event streams do not
+        if isinstance(source, io.BytesIO) or self.track == EVENTS_PATH:
+            return self.copy_body(source, outputfile)
+        if self.range and self.file_stat is not None:
+            READAHEAD.advise(self.client_address[0], source.name, self.file_stat, *self.range[-1])
+        if self.range:
+            length = sum(stop + 1 - start for start, stop in self.range)
+        else:
+            length = self.file_stat.st_size if self.file_stat is not None else None
+        started = threading.Event()
+        ticket, ready = SCHEDULER.acquire(self.client_address[0],
+                                          request_priority(urllib.parse.urlsplit(self.path).path, length),
+                                          started.set)
+        try:
+            if not ready:
+                started.wait()
+            self.copy_body(source, outputfile)
+        finally:
+            SCHEDULER.release(ticket)
+
+    def copy_body(self, source, outputfile):
+        if isinstance(source, types.GeneratorType):
+            # a generated body, from downsampling or the proxy; on errors it just ends early
+            try:
+                for block in source:
+                    time.sleep(SCHEDULER.delay(self.client_address[0], len(block)))
+                    outputfile.write(block)
+                    self.bytes_sent += len(block)
+            except (OSError, ValueError, zlib.error) as e:
+                self.close_connection = True
+                self.log_error('response cut short: %s', e)
+            return
+        if not self.range:
+            return self.copy_range(source, outputfile)
+        if not self.range_parts:
+            start, stop = self.range[0]  # set in send_head()
+            return self.copy_range(source, outputfile, start, stop)
+
+        # multipart/byteranges: the ranges are sorted, so this is one forward pass
+        for part_header, (start, stop) in zip(self.range_parts, self.range):
+            outputfile.write(part_header)
+            self.copy_range(source, outputfile, start, stop)
+        outputfile.write(self.range_parts[-1])
+
+
+class AsyncRangeServer(object):
+    """Serves the working directory like RangeRequestHandler, but on an asyncio
+    event loop with persistent HTTP/1.1 connections.
+
+    Requests pipelined on one connection are answered in order, file opens
+    and reads run on a bounded thread pool, and every write waits on drain()
+    so that a slow client only stalls its own connection.
+    """
+    server_version = RangeRequestHandler.server_version
+    sys_version = RangeRequestHandler.sys_version
+    protocol_version = 'HTTP/1.1'
+    responses = RangeRequestHandler.responses
+    extensions_map = RangeRequestHandler.extensions_map
+    # reuse the path and type mapping of SimpleHTTPRequestHandler as is
+    translate_path = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path
+    guess_type = SimpleHTTPServer.SimpleHTTPRequestHandler.guess_type
+    use_sendfile = True
+    use_compression = True
+    keepalive_timeout = 15
+    max_header_size = 64 * 1024
+    bufsize = 256 * 1024
+
+    def __init__(self, directory=None, max_workers=None):
+        self.directory = os.fspath(directory or os.getcwd())
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self.executor = None
+        self.io_slots = None
+        self.stats = {}  # writer -> [status, track, bytes sent, ranges] of the request in progress
+        self.connections = {}  # writer -> task serving the connection
+        self.busy = set()  # writers with a request in progress
+        self.draining = False
+
+    def serve_forever(self, port, bind=None):
+        try:
+            asyncio.run(self.serve(port, bind))
+        except KeyboardInterrupt:
+            print("\nKeyboard interrupt received, exiting.")
+
+    async def serve(self, port, bind=None, sock=None):
+        self.executor = futures.ThreadPoolExecutor(self.max_workers)
+        # at most a few queued reads per worker, the rest wait on the loop
+        self.io_slots = asyncio.Semaphore(self.max_workers * 4)
+        if sock is None:
+            server = await asyncio.start_server(self.handle_connection, bind or None, port,
+                                                limit=self.max_header_size, backlog=1024)
+            host, port = server.sockets[0].getsockname()[:2]
+            print("Serving HTTP/1.1 on {host} port {port} (http://{host}:{port}/) ...".format(host=host, port=port))
+        else:
+            # a pre-forked worker on its parent's listening socket
+            server = await asyncio.start_server(self.handle_connection, sock=sock, limit=self.max_header_size)
+        stop = asyncio.Event()
+        if threading.current_thread() is threading.main_thread():
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        try:
+            async with server:
+                await stop.wait()
+                server.close()
+                await self.drain()
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def drain(self):
+        # close idle keep-alive connections, let the others finish their request
+        self.draining = True
+        for writer in list(self.connections):
+            if writer not in self.busy:
+                writer.close()
+        if self.connections:
+            await asyncio.wait(list(self.connections.values()))
+
+    async def run_io(self, func, *args):
+        async with self.io_slots:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info('peername') or ('-',)
+        self.connections[writer] = asyncio.current_task()
+        try:
+            keep_alive = True
+            while keep_alive and not self.draining:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keepalive_timeout)
+                except asyncio.LimitOverrunError:
+                    await self.send_error(writer, peer, '-', 431, keep_alive=False)
+                    break
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                started = time.perf_counter()
+                stats = self.stats[writer] = [None, None, 0, ()]
+                self.busy.add(writer)
+                try:
+                    keep_alive = await self.handle_request(head, reader, writer, peer)
+                finally:
+                    self.busy.discard(writer)
+                if stats[0] is not None:
+                    METRICS.observe(stats[1], stats[0], peer[0], time.perf_counter() - started, stats[2], stats[3])
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.stats.pop(writer, None)
+            self.connections.pop(writer, None)
+            writer.close()
+
+    async def handle_request(self, head, reader, writer, peer):
+        lines = head.decode('latin-1').split('\r\n')
+        requestline = lines[0]
+        words = requestline.split()
+        if len(words) != 3 or not words[2].startswith('HTTP/'):
+            await self.send_error(writer, peer, requestline, 400, keep_alive=False)
+            return False
+        method, target, version = words
+        headers = http.client.parse_headers(io.BytesIO(head[len(lines[0]) + 2:]))
+
+        conntype = headers.get('Connection', '').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = conntype == 'keep-alive'
+        else:
+            keep_alive = conntype != 'close'
+        if 'Transfer-Encoding' in headers:
+            await self.send_error(writer, peer, requestline, 501, keep_alive=False)
+            return False
+        try:
+            length = int(headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            await self.send_error(writer, peer, requestline, 400, 'Bad Content-Length', keep_alive=False)
+            return False
+        if length > MAX_API_BODY:
+            await self.send_error(writer, peer, requestline, 413, keep_alive=False)
+            return False
+        # only control API requests use a body; reading it keeps the stream in sync
+        body = await reader.readexactly(length) if length else b''
+        request = (writer, peer, requestline, method == 'HEAD', keep_alive)
+        if is_api_path(urllib.parse.urlsplit(target).path):
+            return await self.send_api(request, method, target, headers, body)
+        if method not in ('GET', 'HEAD'):
+            await self.send_error(writer, peer, requestline, 501, keep_alive=keep_alive)
+            return keep_alive
+
+        if urllib.parse.urlsplit(target).path == EVENTS_PATH:
+            return await self.send_events(request, headers)
+        if urllib.parse.urlsplit(target).path == METRICS_PATH:
+            await self.send_metrics(request)
+            return keep_alive
+        if urllib.parse.urlsplit(target).path.startswith(DOWNSAMPLE_PATH + '/'):
+            return await self.send_downsample(request, target, version)
+        if urllib.parse.urlsplit(target).path.startswith(SEQUENCE_PATH + '/'):
+            return await self.send_sequence(request, target)
+        if urllib.parse.urlsplit(target).path.startswith(PROXY_PATH):
+            return await self.send_proxy(request, headers, target)
+        path = self.translate_path(target)
+        if os.path.isdir(path):
+            parts = urllib.parse.urlsplit(target)
+            if not parts.path.endswith('/'):
+                location = urllib.parse.urlunsplit((parts[0], parts[1], parts[2] + '/', parts[3], parts[4]))
+                await self.send_response(request, 301, [('Location', location), ('Content-Length', '0')])
+                return keep_alive
+            for index in ('index.html', 'index.htm'):
+                if os.path.isfile(os.path.join(path, index)):
+                    path = os.path.join(path, index)
+                    break
+            else:
+                await self.send_error(writer, peer, requestline, 404, 'No permission to list directory',
+                                      keep_alive=keep_alive)
+                return keep_alive
+        if path.endswith('/'):
+            await self.send_error(writer, peer, requestline, 404, 'File not found', keep_alive=keep_alive)
+            return keep_alive
+
+        try:
+            f = FILE_POOL.acquire(path, cached_only=True) or await self.run_io(FILE_POOL.acquire, path)
+            fs = f.stat
+        except OSError:
+            await self.send_error(writer, peer, requestline, 404, 'File not found', keep_alive=keep_alive)
+            return keep_alive
+        self.stats[writer][1] = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+        compressed = self.use_compression and negotiate_encoding(path, fs, headers)
+        try:
+            if compressed:
+                return await self.send_compressed(request, headers, f, fs, self.guess_type(path), compressed,
+                                                  version)
+            await self.send_file(request, headers, f, fs, self.guess_type(path))
+        finally:
+            f.close()
+        return keep_alive
+
+    async def send_file(self, request, headers, f, fs, ctype):
+        file_len = fs.st_size
+        etag = file_etag(fs)
+        validators = [('ETag', etag),
+                      ('Last-Modified', email_utils.formatdate(fs.st_mtime, usegmt=True)),
+                      ('Cache-Control', cache_control(f.name))]
+        if self.use_compression and is_compressible(f.name):
+            validators.append(('Vary', 'Accept-Encoding'))
+        if is_not_modified(headers, fs, etag):
+            await self.send_response(request, 304, validators)
+            return
+        ranges = []
+        if 'Range' in headers and if_range_matches(headers, fs, etag):
+            try:
+                ranges = parse_byte_range(headers['Range'])
+            except ValueError:
+                writer, peer, requestline, head_only, keep_alive = request
+                await self.send_error(writer, peer, requestline, 400, 'Invalid byte range', keep_alive=keep_alive)
+                return
+        if not ranges:
+            await self.send_response(request, 200, [('Content-type', ctype), ('Content-Length', str(file_len)),
+                                                    ('Accept-Ranges', 'bytes')] + validators)
+            await self.send_body(request, f, fs, [(0, file_len - 1)])
+            return
+        ranges = resolve_byte_ranges(ranges, file_len)
+        self.stats[request[0]][3] = ranges
+        if not ranges:
+            await self.send_response(request, 416, [('Content-Range', 'bytes */%s' % file_len),
+                                                    ('Content-Length', '0')])
+            return
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            await self.send_response(request, 206, [('Accept-Ranges', 'bytes'), ('Content-type', ctype),
+                                                    ('Content-Range', 'bytes %s-%s/%s' % (first, last, file_len)),
+                                                    ('Content-Length', str(last - first + 1))] + validators)
+            await self.send_body(request, f, fs, ranges)
+            return
+        boundary, parts, length = multipart_byteranges(ranges, ctype, file_len)
+        await self.send_response(request, 206, [('Accept-Ranges', 'bytes'),
+                                                ('Content-type', 'multipart/byteranges; boundary=%s' % boundary),
+                                                ('Content-Length', str(length))] + validators)
+        await self.send_body(request, f, fs, ranges, parts)
+
+    async def send_compressed(self, request, headers, f, fs, ctype, compressed, version):
+        # a sidecar with its length, else gzip on the fly, chunked for HTTP/1.1
+        writer, peer, requestline, head_only, keep_alive = request
+        encoding, sidecar = compressed
+        body = None
+        if sidecar is not None:
+            try:
+                body = FILE_POOL.acquire(sidecar, cached_only=True) or await self.run_io(FILE_POOL.acquire, sidecar)
+            except OSError:
+                encoding = 'gzip'
+        etag = encoded_etag(fs, encoding, body is None)
+        validators = [('ETag', etag), ('Last-Modified', email_utils.formatdate(fs.st_mtime, usegmt=True)),
+                      ('Cache-Control', cache_control(f.name)), ('Vary', 'Accept-Encoding')]
+        try:
+            if is_not_modified(headers, fs, etag):
+                await self.send_response(request, 304, validators)
+                return keep_alive
+            if body is not None:
+                size = body.stat.st_size
+                await self.send_response(request, 200, [('Content-type', ctype), ('Content-Encoding', encoding),
+                                                        ('Content-Length', str(size))] + validators)
+                await self.send_body(request, body, body.stat, [(0, size - 1)])
+                return keep_alive
+            chunked = version != 'HTTP/1.0'
+            keep_alive = keep_alive and chunked
+            request = (writer, peer, requestline, head_only, keep_alive)
+            await self.send_response(request, 200, [('Content-type', ctype), ('Content-Encoding', encoding)]
+                                     + [('Transfer-Encoding', 'chunked')] * chunked + validators)
+            if head_only:
+                return keep_alive
+            return await self.send_stream(request, gzip_stream(f), chunked) and keep_alive
+        finally:
+            if body is not None:
+                body.close()
+
+    async def send_metrics(self, request):
+        body = METRICS.render().encode('utf-8')
+        self.stats[request[0]][1] = METRICS_PATH
+        await self.send_response(request, 200, [('Content-type', 'text/plain; version=0.0.4; charset=utf-8'),
+                                                ('Content-Length', str(len(body))), ('Cache-Control', 'no-cache')])
+        if not request[3]:
+            request[0].write(body)
+            await request[0].drain()
+
+    async def send_api(self, request, method, target, headers, body):
+        writer, peer, requestline, head_only, keep_alive = request
+        code, body = await self.run_io(api_response, method, target, headers, body, peer[0],
+                                       writer.get_extra_info('sockname')[1])
+        self.stats[writer][1] = API_PATH
+        await self.send_response(request, code, [('Content-type', 'application/json'),
+                                                 ('Content-Length', str(len(body))), ('Cache-Control', 'no-cache')])
+        if not head_only:
+            writer.write(body)
+            await writer.drain()
+        return keep_alive
+
+    async def send_events(self, request, headers):
+        # server-sent events until the client goes away or the server drains
+        writer, peer, requestline, head_only, keep_alive = request
+        self.stats[writer][1] = EVENTS_PATH
+        request = (writer, peer, requestline, head_only, False)
+        await self.send_response(request, 200, [('Content-type', 'text/event-stream'), ('Cache-Control', 'no-cache')])
+        if head_only:
+            return False
+        last, idle = last_event_id(headers), 0.0
+        try:
+            writer.write(b'retry: 3000\n\n')
+            while not self.draining:
+                last, message = await self.run_io(TRACK_FEED.poll, last, idle)
+                if message is not None:
+                    idle = 0.0
+                    writer.write(message)
+                    self.stats[writer][2] += len(message)
+                    await writer.drain()
+                await asyncio.sleep(TRACK_FEED.interval)
+                idle += TRACK_FEED.interval
+        except OSError:
+            pass
+        return False
+
+    async def send_downsample(self, request, target, version):
+        # chunked for HTTP/1.1 clients, else the end of the body is the end of the connection
+        writer, peer, requestline, head_only, keep_alive = request
+        try:
+            bam, args = parse_downsample(target, self.translate_path)
+            blocks = await self.run_io(igv_bam.downsample_bam, bam, *args)
+        except OSError:
+            await self.send_error(writer, peer, requestline, 404, 'File not found', keep_alive=keep_alive)
+            return keep_alive
+        except (ValueError, zlib.error) as e:
+            await self.send_error(writer, peer, requestline, 400, str(e), keep_alive=keep_alive)
+            return keep_alive
+        chunked = version != 'HTTP/1.0'
+        keep_alive = keep_alive and chunked
+        request = (writer, peer, requestline, head_only, keep_alive)
+        self.stats[writer][1] = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+        await self.send_response(request, 200, [('Content-type', 'application/octet-stream')]
+                                 + [('Transfer-Encoding', 'chunked')] * chunked)
+        if head_only:
+            blocks.close()
+            return keep_alive
+        return await self.send_stream(request, blocks, chunked) and keep_alive
+
+    async def send_sequence(self, request, target):
+        writer, peer, requestline, head_only, keep_alive = request
+        try:
+            path, args = parse_sequence(target, self.translate_path)
+            body = await self.run_io(read_sequence, path, *args)
+        except OSError:
+            await self.send_error(writer, peer, requestline, 404, 'File not found', keep_alive=keep_alive)
+            return keep_alive
+        except SEQUENCE_ERRORS as e:
+            await self.send_error(writer, peer, requestline, 400, str(e), keep_alive=keep_alive)
+            return keep_alive
+        except ImportError:
+            await self.send_error(writer, peer, requestline, 501, SEQUENCE_NEEDS, keep_alive=keep_alive)
+            return keep_alive
+        self.stats[writer][1] = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+        await self.send_response(request, 200, [('Content-type', 'text/plain'), ('Content-Length', str(len(body))),
+                                                ('Cache-Control', cache_control(path))])
+        if not head_only:
+            writer.write(body)
+            await writer.drain()
+        return keep_alive
+
+    async def send_proxy(self, request, headers, target):
+        writer, peer, requestline, head_only, keep_alive = request
+        code, response_headers, body = await self.run_io(proxy_response, target, headers, self.guess_type)
+        if isinstance(response_headers, str):
+            await self.send_error(writer, peer, requestline, code, response_headers, keep_alive=keep_alive)
+            return keep_alive
+        self.stats[writer][1] = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+        await self.send_response(request, code, response_headers)
+        if body is None:
+            return keep_alive
+        if head_only:
+            body.close()
+            return keep_alive
+        return await self.send_stream(request, body) and keep_alive
+
+    async def send_stream(self, request, blocks, chunked=False):
+        # write what a generator yields, running it on the I/O pool; False when the body was cut short
+        writer, peer = request[0], request[1]
+        ticket = None
+        try:
+            ticket = await self.admit(request, None)
+            while True:
+                block = await self.run_io(next, blocks, None)
+                if block is None:
+                    break
+                if not block:
+                    continue
+                delay = SCHEDULER.delay(peer[0], len(block))
+                if delay:
+                    await asyncio.sleep(delay)
+                writer.write(b'%x\r\n%s\r\n' % (len(block), block) if chunked else block)
+                self.stats[writer][2] += len(block)
+                await writer.drain()
+        except (OSError, ValueError, zlib.error) as e:
+            sys.stderr.write('response cut short: %s\n' % e)
+            return False
+        finally:
+            blocks.close()
+            if ticket is not None:
+                SCHEDULER.release(ticket)
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        return True
+
+    async def send_response(self, request, code, headers):
+        writer, peer, requestline, head_only, keep_alive = request
+        if writer in self.stats:
+            self.stats[writer][0] = code
+        self.log_request(peer, requestline, code, dict(headers).get('Content-Length', '-'))
+        lines = ['%s %d %s' % (self.protocol_version, code, self.responses.get(code, ('',))[0]),
+                 'Server: %s %s' % (self.server_version, self.sys_version),
+                 'Date: %s' % email_utils.formatdate(usegmt=True)]
+        lines.extend('%s: %s' % header for header in headers)
+        if not keep_alive:
+            lines.append('Connection: close')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+    async def send_error(self, writer, peer, requestline, code, message=None, keep_alive=True):
+        short, explain = self.responses.get(code, ('???', '???'))
+        body = (SimpleHTTPServer.DEFAULT_ERROR_MESSAGE % {
+            'code': code, 'message': html_escape(message or short, quote=False),
+            'explain': html_escape(explain, quote=False)}).encode('utf-8', 'replace')
+        request = (writer, peer, requestline, requestline.startswith('HEAD '), keep_alive)
+        await self.send_response(request, code, [('Content-Type', SimpleHTTPServer.DEFAULT_ERROR_CONTENT_TYPE),
+                                                 ('Content-Length', str(len(body)))])
+        if not request[3]:
+            writer.write(body)
+            await writer.drain()
+
+    async def send_body(self, request, f, fs, ranges, parts=None):
+        writer, peer, requestline, head_only, keep_alive = request
+        if head_only:
+            return
+        if writer in self.stats:
+            self.stats[writer][2] += sum(last + 1 - first for first, last in ranges)
+        if ranges:
+            READAHEAD.advise(peer[0], f.name, fs, *ranges[-1])
+        ticket = await self.admit(request, sum(last + 1 - first for first, last in ranges))
+        try:
+            for i, (first, last) in enumerate(ranges):
+                if parts:
+                    writer.write(parts[i])
+                for chunk_first, chunk_last in throttle_chunks(first, last):
+                    delay = SCHEDULER.delay(peer[0], chunk_last + 1 - chunk_first)
+                    if delay:
+                        await asyncio.sleep(delay)
+                    await self.send_range(writer, f, fs, chunk_first, chunk_last)
+            if parts:
+                writer.write(parts[-1])
+                await writer.drain()
+        finally:
+            SCHEDULER.release(ticket)
+
+    async def admit(self, request, length):
+        # a SCHEDULER ticket for the body of request, once it may start
+        loop = asyncio.get_running_loop()
+        started = loop.create_future()
+        def wake():
+            loop.call_soon_threadsafe(lambda: started.done() or started.set_result(None))
+        path = urllib.parse.urlsplit(request[2].split()[1]).path
+        ticket, ready = SCHEDULER.acquire(request[1][0], request_priority(path, length), wake)
+        if not ready:
+            try:
+                await started
+            except asyncio.CancelledError:
+                SCHEDULER.release(ticket)
+                raise
+        return ticket
+
+    async def send_range(self, writer, f, fs, first, last):
+        count = last - first + 1
+        if count <= 0:
+            return
+        data = READAHEAD.read(f.name, fs.st_mtime_ns, first, last)
+        if data is not None:
+            writer.write(data)
+            await writer.drain()
+            return
+        if BLOCK_CACHE.accepts(f.name, first, last):
+            data = BLOCK_CACHE.read_range(f.name, fs.st_mtime_ns, first, last)
+            if data is None:
+                data = await self.run_io(BLOCK_CACHE.read_range, f.name, fs.st_mtime_ns, first, last, f)
+            writer.write(data)
+            await writer.drain()
+            return
+        if self.use_sendfile:
+            await writer.drain()
+            try:
+                await asyncio.get_running_loop().sendfile(writer.transport, f, first, count, fallback=False)
+                return
+            except asyncio.SendfileNotAvailableError:
+                pass
+        pos = first
+        while pos <= last:
+            buf = await self.run_io(self.read_at, f, pos, min(self.bufsize, last + 1 - pos))
+            if not buf:
+                break
+            writer.write(buf)
+            await writer.drain()
+            pos += len(buf)
+
+    @staticmethod
+    def read_at(f, offset, size):
+        f.seek(offset)
+        return f.read(size)
+
+    def log_request(self, peer, requestline, code, size):
+        sys.stderr.write('%s - - [%s] "%s" %s %s\n' % (
+            peer[0], time.strftime('%d/%b/%Y %H:%M:%S'), requestline, code, size))
+
 
 if __name__ == "__main__":
     create_cache()
     opts = get_opt()
-    if opts.genomelist is False:
+    if opts.genomelist is None:
         bams = opts.bam
         fasta = opts.ref
         refn = opts.reference
         bed = opts.bed
         gtfs = opts.gtf
         bws = opts.bigwig
-        locus = opts.locus
+        loci = read_loci(opts.locus)
         port = opts.port
         addbam = opts.addbam
         rmbam = opts.rmbam
         roi = opts.ROI
-        igv_web(fasta, bams, bws,  bed, gtfs, locus, refn, roi)
-        add_bam(addbam)
+        RangeRequestHandler.use_sendfile = not opts.no_sendfile
+        RangeRequestHandler.use_compression = not opts.no_compression
+        BLOCK_CACHE.configure(opts.cache_size * 1024 * 1024)
+        READAHEAD.configure(opts.readahead * 1024 * 1024)
+        FILE_POOL.configure(opts.open_files)
+        SCHEDULER.configure(opts.slots, opts.client_concurrency, opts.client_rate * 1024 * 1024)
+        if addbam is not None or rmbam is not None:
+            others = local_only_options(opts)
+            if others and server_running(port):
+                print("{} cannot be applied through the server running on port {}: give them in a separate run "
+                      "without -ab/-rb, or stop the server first".format(", ".join(others), port), file=sys.stderr)
+                sys.exit(2)
+            if control_server(port, addbam, rmbam, opts.index, opts.coverage):
+                sys.exit(0)
+        # without -l the loci saved in the project stay, for the page and for -ex
+        igv_web(fasta, bams, bws,  bed, gtfs, " ".join(loci) or None, refn, roi, opts.coverage, opts.index,
+                opts.twobit)
+        upgrade_page()
+        add_bam(addbam, opts.index)
         remove_bam(rmbam)
-        create_server(port)
+        if opts.export:
+            try:
+                export_bundle(opts.export, loci or get_manifest().settings().get("locus", "").split())
+            except ValueError as e:
+                print("could not export {}: {}".format(opts.export, e), file=sys.stderr)
+                sys.exit(1)
+            sys.exit(0)
+        configure_proxy(opts.proxy)
+        create_server(port, opts.engine, opts.workers, opts.metrics_interval)
     else:
-        print_genomelist()
+        print_genomelist(opts.genomelist, opts.refresh_genomes)
@@ -1,144 +1,1548 @@
-from audioop import ratecv
-from tkinter import N
-from turtle import color
+import sys
+import argparse
+import asyncio
+import functools
+import gzip
+import json
+import multiprocessing
+import re
+import http.server
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent import futures
+
+import numpy as np
+import pyBigWig
+import pysam
 import pytest
 from numpy.random import default_rng
-from itertools import islice
-from math import exp, floor, log
-from random import random, randrange
-from typing import Any, Iterable, Optional
-import numpy as np
-import matplotlib.pyplot as plt
-import time
 
+import igv_bam
+import igv_bgzf
+import igv_bigwig
+import igv_fasta
+import igv_twobit
+import igv_web
+from igv_sample import PrioritySampler, ReservoirL, algorithm_r, sample
 
-EOI = object
 
-def algorithm_r(iterable: Iterable, n: int):
-    iterable = iter(iterable)
-    # Initialise reservoir with first n elements
-    reservoir = list(islice(iterable, n))
+def exponential_population(size, rate=0.1, seed=None):
+    # sorted, so that a sampler biased to any part of the stream shows up in the rate
+    population = default_rng(seed).exponential(1 / rate, size)
+    population.sort()
+    return population
 
-    for t, x in enumerate(iterable, n + 1):
-        m = randrange(t)
-        if m < n:  # Make the next record a candidate, replacing one at random
-            reservoir[m] = x
 
-    return reservoir
+def priority_sample(population, n, seed=None):
+    sampler = PrioritySampler(n, seed)
+    sampler.extend(population)
+    return sampler.sample()
 
-def method_4(iterable: Iterable, n: int):
-    iterable = iter(iterable)
-    # Initialise reservoir with first n elements
-    reservoir = np.array(list(islice(iterable, n)))
-    # Assign random numbers to the first n elements
-    u_array = np.array([random() for _ in range(n)])
 
-    # Track the index of the largest u-value
-    u_max_idx = u_array.argmax()
-    for x in iterable:
-        u = random()
-        if u < u_array[u_max_idx]:
-	    # Replace largest u-value
-            u_array[u_max_idx] = u
-	    # Replace corresponding reservoir element
-            reservoir[u_max_idx] = x
-	    # Update largest u-value
-            u_max_idx = u_array.argmax()
+def reservoir_l_sample(population, n, seed=None):
+    sampler = ReservoirL(n, seed)
+    sampler.extend(population)
+    return sampler.sample()
 
-    return reservoir
 
-def algorithm_l(iterable: Iterable, n: int):
-    iterable = iter(iterable)
-    # Initialise reservoir with first n elements
-    reservoir = list(islice(iterable, n))
+def merged_sample(population, n, seed=None, parts=8):
+    # separate samplers for the partitions, as parallel workers would use
+    samplers = []
+    for i, part in enumerate(np.array_split(population, parts)):
+        samplers.append(PrioritySampler(n, None if seed is None else seed + i))
+        samplers[-1].extend(part)
+    merged = samplers[0]
+    for other in samplers[1:]:
+        merged.merge(other)
+    return merged.sample()
 
-    w = exp(log(random()) / n)
 
-    while True:
-        s = floor(log(random()) / log(1 - w))
-        next_elem = nth(iterable, s + 1, default=EOI)
+SAMPLERS = [algorithm_r, priority_sample, reservoir_l_sample, merged_sample]
 
-        if next_elem is EOI:
-            return reservoir
 
-        reservoir[randrange(0, n)] = next_elem
-        w *= exp(log(random()) / n)
+@pytest.mark.parametrize('sampler', SAMPLERS)
+def test_sample_distribution(sampler):
+    # Test parameters - adjust to affect the statistical significance of the test.
+    n = 2000  # Sample size
+    rate = 0.1  # Exponential distribution rate parameter.
+    tolerance = 0.1  # How close to the real rate the MLE needs to be.
+    population = exponential_population(n * 500, rate, seed=1)
 
-    return reservoir
+    result = sampler(population, n, seed=2)
+    assert len(result) == n
 
+    # Calculate the MLE for the rate parameter of the population distribution
+    rate_mle = len(result) / sum(result)
+    assert pytest.approx(rate_mle, tolerance) == rate
 
-def nth(iterable: Iterable, n: int, default: Optional[Any] = None):
-    """Returns the ``n``th item in ``iterable`` or a default value.
 
-    Credit: https://docs.python.org/3.7/library/itertools.html#itertools-recipes
-    """
-    return next(islice(iterable, n, None), default)
+@pytest.mark.parametrize('sampler', SAMPLERS)
+def test_sample_is_uniform(sampler):
+    # every position is equally likely to be kept: the sampled positions are uniform in [0, size)
+    size, n = 100000, 1000
+    result = np.array(sampler(np.arange(size), n, seed=3))
+    assert len(np.unique(result)) == n
+    counts = np.histogram(result, bins=10, range=(0, size))[0]
+    assert counts.min() > 0.7 * n / 10 and counts.max() < 1.3 * n / 10
 
-def test_sample_distribution():
-    # Test parameters - adjust to affect the statistical significance of the test.
-    n = 1000  # Sample size
-    population_size = n * 1000  # Input size.
-    rate = 0.1  # Exponential distribution rate parameter.
-    tolerance = 0.1  # How close to the real rate the MLE needs to be.
 
-    # Generate exponentially distributed data with known parameters
-    rng = default_rng()
-    population = rng.exponential(
-        1 / rate,  # numpy uses the scale parameter which is the inverse of the rate
-        population_size,
-    )
-    population.sort()
+def test_chunks_and_items_agree():
+    # Algorithm L skips the same items however the stream is cut
+    population = np.arange(50000)
+    whole = ReservoirL(100, seed=4)
+    whole.extend(population)
+    pieces = ReservoirL(100, seed=4)
+    for part in np.array_split(population, 37):
+        pieces.extend(part)
+    items = ReservoirL(100, seed=4)
+    for x in population[:1000].tolist():
+        items.add(x)
+    pieces.extend([])
+    items.extend(population[1000:])
+    assert whole.sample() == pieces.sample() == items.sample()
 
 
-    N = 2000
-    # Run Reservoir Sampling to generate a sample
-    start = time.time()
-    sample = algorithm_r(population, N)
-    end = time.time()
+def test_weighted_sample():
+    # a tenth of the items carry nine tenths of the weight
+    size, n = 100000, 2000
+    weights = np.ones(size)
+    weights[:size // 10] = 81.0
+    result = np.array(sample(np.arange(size), n, weights, seed=5))
+    heavy = (result < size // 10).mean()
+    assert 0.85 < heavy < 0.95
+    # without replacement, and never an item of weight zero
+    weights[size // 2:] = 0
+    result = np.array(sample(np.arange(size), n, weights, seed=6))
+    assert len(np.unique(result)) == n and result.max() < size // 2
+    with pytest.raises(ValueError):
+        sample(np.arange(10), 2, -np.ones(10))
 
-    print(str(end-start))
 
-    # Calculate the MLE for the rate parameter of the population distribution
-    rate_mle = len(sample) / sum(sample)
-    print(rate_mle)
+def test_small_streams():
+    assert sorted(sample(list(range(5)), 10)) == list(range(5))
+    sampler = PrioritySampler(10, seed=7)
+    for x in range(5):
+        sampler.add(x)
+    assert sorted(sampler.sample()) == list(range(5))
+    with pytest.raises(ValueError):
+        ReservoirL(0)
+
+
+def serve_directory(directory):
+    '''Starts a thread engine server on directory; returns its base URL.'''
+    handler = functools.partial(igv_web.RangeRequestHandler, directory=str(directory))
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def serve_asyncio(directory):
+    '''Starts an asyncio engine server on directory; returns its base URL.'''
+    sock = socket.create_server(('127.0.0.1', 0))
+    server = igv_web.AsyncRangeServer(str(directory))
+    threading.Thread(target=asyncio.run, args=(server.serve(None, sock=sock),), daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(sock.getsockname()[1])
+
+
+def raw_request(base, request):
+    # the whole reply to raw request bytes, read until the server closes
+    host, port = base.rsplit('/', 1)[-1].split(':')
+    with socket.create_connection((host, int(port)), timeout=5) as conn:
+        conn.sendall(request)
+        reply = b''
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                return reply
+            reply += data
+
+
+def http_get(url, headers=None):
+    # (status, headers, body), error responses included
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers or {})) as reply:
+            return reply.status, reply.headers, reply.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+
+def test_parse_byte_range():
+    assert igv_web.parse_byte_range('') == []
+    assert igv_web.parse_byte_range('bytes=0-9, -500,789-') == [(0, 9), (None, 500), (789, None)]
+    for header in ('bytes=9-0', 'bytes=-', 'items=0-9', 'bytes=0-9;1-2'):
+        with pytest.raises(ValueError):
+            igv_web.parse_byte_range(header)
+
+
+def test_resolve_byte_ranges():
+    resolve = igv_web.resolve_byte_ranges
+    # suffix ranges longer than the file start at 0, open and overlong ranges end at the last byte
+    assert resolve([(None, 10)], 100) == [(90, 99)]
+    assert resolve([(None, 500)], 100) == [(0, 99)]
+    assert resolve([(50, None)], 100) == [(50, 99)]
+    assert resolve([(50, 1000)], 100) == [(50, 99)]
+    # overlapping and adjacent ranges merge, in file order
+    assert resolve([(40, 49), (0, 9), (5, 19), (20, 29)], 100) == [(0, 29), (40, 49)]
+    # unsatisfiable ranges drop out; none left means 416
+    assert resolve([(100, 200), (None, 0)], 100) == []
+    assert resolve([(100, None), (10, 19)], 100) == [(10, 19)]
+
+
+def test_multipart_byteranges(tmp_path):
+    data = bytes(range(256)) * 40
+    (tmp_path / 'x.bin').write_bytes(data)
+    base = serve_directory(tmp_path)
+    status, headers, body = http_get(base + '/x.bin', {'Range': 'bytes=-10,0-9,5-19,8000-'})
+    assert status == 206
+    ctype, boundary = headers['Content-Type'].split('; boundary=')
+    assert ctype == 'multipart/byteranges' and int(headers['Content-Length']) == len(body)
+    parts = body.split(b'\r\n--' + boundary.encode())
+    assert parts[0] == b'' and parts[-1] == b'--\r\n'
+    ranges = []
+    for part in parts[1:-1]:
+        head, payload = part.split(b'\r\n\r\n', 1)
+        content_range = [line for line in head.split(b'\r\n') if line.lower().startswith(b'content-range')][0]
+        first, last = map(int, content_range.split(b' ')[-1].split(b'/')[0].split(b'-'))
+        assert payload == data[first:last + 1]
+        ranges.append((first, last))
+    assert ranges == [(0, 19), (8000, 10239)]
+    status, headers, body = http_get(base + '/x.bin', {'Range': 'bytes=20-29'})
+    assert status == 206 and body == data[20:30] and headers['Content-Range'] == 'bytes 20-29/10240'
+    status, headers, body = http_get(base + '/x.bin', {'Range': 'bytes=10240-'})
+    assert status == 416 and headers['Content-Range'] == 'bytes */10240'
+
+
+def test_asyncio_content_length(tmp_path):
+    (tmp_path / 'x.txt').write_bytes(b'x' * 10)
+    base = serve_asyncio(tmp_path)
+    for length in (b'zz', b'-5', b'1,2'):
+        reply = raw_request(base, b'POST /api/tracks HTTP/1.1\r\nHost: localhost\r\nContent-Length: ' + length
+                            + b'\r\n\r\n')
+        assert reply.startswith(b'HTTP/1.1 400 ')
+    reply = raw_request(base, b'GET /x.txt HTTP/1.1\r\nHost: localhost\r\nContent-Length: 0\r\n'
+                        b'Connection: close\r\n\r\n')
+    assert reply.startswith(b'HTTP/1.1 200 ') and reply.endswith(b'\r\n\r\n' + b'x' * 10)
+    reply = raw_request(base, b'POST /api/tracks HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n'
+                        % (igv_web.MAX_API_BODY + 1))
+    assert reply.startswith(b'HTTP/1.1 413 ')
+
+
+def random_features(rng, count=3000, zero_based=False):
+    # (chrom, beg, end) of features over three chromosomes, some of them long, in random order
+    chroms = rng.choice(['chr1', 'chr2', 'chrX'], count)
+    begs = rng.integers(0, 2000000, count)
+    ends = begs + np.where(rng.random(count) < 0.05, rng.integers(1, 300000, count), rng.integers(1, 2000, count))
+    return [(chrom, int(beg) + (0 if zero_based else 1), int(end)) for chrom, beg, end in zip(chroms, begs, ends)]
+
+
+@pytest.mark.parametrize('preset', ['gff', 'bed'])
+def test_bgzip_tabix(tmp_path, preset):
+    rng = default_rng(8)
+    features = random_features(rng, zero_based=preset == 'bed')
+    if preset == 'gff':
+        lines = ['##gff-version 2\n'] + ['{}\tsrc\texon\t{}\t{}\t.\t+\t.\tgene_id "g{}";\n'.format(c, b, e, i)
+                                        for i, (c, b, e) in enumerate(features)]
+    else:
+        lines = ['track name=x\n'] + ['{}\t{}\t{}\tf{}\n'.format(c, b, e, i) for i, (c, b, e) in enumerate(features)]
+    (tmp_path / 'in.txt').write_text(''.join(lines))
+    dst = str(tmp_path / 'out.gz')
+    # small runs, so the sort spills and merges
+    igv_bgzf.bgzip_tabix(str(tmp_path / 'in.txt'), dst, preset, run_bytes=20000)
+    tabix = pysam.TabixFile(dst)
+    # the header stays on top: a meta line for pysam, a BED track line as the skipped first line
+    with gzip.open(dst, 'rt') as f:
+        assert f.readline() == lines[0]
+    assert sorted(tabix.contigs) == ['chr1', 'chr2', 'chrX']
+    offset = 1 if preset == 'gff' else 0
+    for chrom, beg in zip(rng.choice(['chr1', 'chr2', 'chrX'], 200), rng.integers(0, 2100000, 200)):
+        end = int(beg) + int(rng.integers(1, 100000))
+        found = sorted(tabix.fetch(chrom, int(beg), end))
+        # 0-based half-open query against the features of the input
+        expected = sorted(line.rstrip('\n') for line, (c, b, e) in zip(lines[1:], features)
+                          if c == chrom and b - offset < end and e > beg)
+        assert found == expected
+    assert sum(1 for chrom in tabix.contigs for _ in tabix.fetch(chrom)) == len(features)
+
+
+def test_index_annotation(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = default_rng(8)
+    lines = ['{}\t{}\t{}\tf{}\n'.format(c, b, e, i) for i, (c, b, e) in enumerate(random_features(rng, 500, True))]
+    (tmp_path / 'data').mkdir()
+    (tmp_path / 'data' / 'x.bed').write_text(''.join(lines))
+    assert igv_web.index_annotation('data/x.bed', 'bed') == 'data/x.sorted.bed.gz'
+    # a malformed line fails the index without leaving partial files behind
+    (tmp_path / 'data' / 'bad.bed').write_text(''.join(lines) + 'chr1\tx\ty\n')
+    with pytest.raises(ValueError):
+        igv_web.index_annotation('data/bad.bed', 'bed')
+    assert sorted(os.listdir('data')) == ['bad.bed', 'x.bed', 'x.sorted.bed.gz', 'x.sorted.bed.gz.tbi']
+    # a read-only directory (which root could still write to, hence os.access) sends the output to the cache
+    readonly = str(tmp_path / 'data')
+    os.chmod(readonly, 0o555)
+    access = os.access
+    monkeypatch.setattr(os, 'access', lambda path, mode: path != readonly and access(path, mode))
+    try:
+        cached = igv_web.index_annotation(str(tmp_path / 'data' / 'x.bed'), 'bed')
+    finally:
+        os.chmod(readonly, 0o755)
+    assert os.path.dirname(cached) == igv_web.ANNOTATION_CACHE and cached.endswith('.x.sorted.bed.gz')
+    with pysam.TabixFile(cached) as tabix:
+        assert sum(1 for chrom in tabix.contigs for _ in tabix.fetch(chrom)) == len(lines)
+    # and is reused from there
+    mtime = os.path.getmtime(cached)
+    assert igv_web.index_annotation(str(tmp_path / 'data' / 'x.bed'), 'bed') == cached
+    assert os.path.getmtime(cached) == mtime
+
+
+BAM_REFERENCES = [('chr1', 300000), ('chr2', 120000), ('chrM', 16569)]
+BAM_CIGARS = ['50M', '20M5D30M', '10M300N40M', '5S45M', '20M2I28M', '25=1X24=']
+# duplicate and secondary reads do not count towards coverage
+BAM_FLAGS = [0, 0, 0, 16, 16, 0x400, 0x100]
+
+
+def write_test_bam(path, reads=20000, seed=9):
+    '''Writes a sorted, indexed BAM of random reads over BAM_REFERENCES, some
+    of them hanging over a reference end, and a few unmapped reads last.
+    Returns the path.
+    '''
+    rng = default_rng(seed)
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': name, 'LN': length} for name, length in BAM_REFERENCES]}
+    placed = []
+    for i in range(reads):
+        ref_id = int(rng.choice(len(BAM_REFERENCES), p=[0.7, 0.28, 0.02]))
+        # a crowd of reads over the first 10 kb, for depth in the thousands
+        pos = int(rng.integers(0, 10000) if rng.random() < 0.2 else rng.integers(0, BAM_REFERENCES[ref_id][1] - 10))
+        placed.append((ref_id, pos, i))
+    with pysam.AlignmentFile(str(path), 'wb', header=header) as out:
+        for ref_id, pos, i in sorted(placed) + [(-1, -1, i) for i in range(reads, reads + 50)]:
+            read = pysam.AlignedSegment(out.header)
+            read.query_name = 'r{}'.format(i)
+            read.query_sequence = 'ACGT' * 12 + 'AC'
+            read.query_qualities = pysam.qualitystring_to_array('I' * 50)
+            if ref_id < 0:
+                read.flag = 4
+            else:
+                read.reference_id, read.reference_start = ref_id, pos
+                read.flag = BAM_FLAGS[i % len(BAM_FLAGS)]
+                read.cigarstring = BAM_CIGARS[i % len(BAM_CIGARS)]
+                read.mapping_quality = 60
+            out.write(read)
+    pysam.index(str(path))
+    return str(path)
+
+
+def read_depth(bam):
+    # per-base depth of every reference, counted the way coverage_bins does
+    depth = {name: np.zeros(length + 1000, np.int64) for name, length in BAM_REFERENCES}
+    with pysam.AlignmentFile(bam) as f:
+        for read in f.fetch(until_eof=True):
+            if read.is_unmapped or read.flag & 0x700:
+                continue
+            pos = read.reference_start
+            for kind, length in read.cigartuples:
+                if kind in (0, 7, 8):
+                    depth[read.reference_name][pos:pos + length] += 1
+                if kind in (0, 2, 3, 7, 8):
+                    pos += length
+    return {name: depth[name][:length] for name, length in BAM_REFERENCES}
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_bam_coverage(tmp_path, parallel):
+    bam = write_test_bam(tmp_path / 'x.bam')
+    bin_size = 25
+    with futures.ProcessPoolExecutor(2) as pool:
+        igv_bam.bam_coverage(bam, str(tmp_path / 'x.bw'), bin_size, pool if parallel else None)
+    with pyBigWig.open(str(tmp_path / 'x.bw')) as bw:
+        assert bw.chroms() == dict(BAM_REFERENCES)
+        for name, depth in read_depth(bam).items():
+            sizes = np.diff(np.append(np.arange(0, len(depth), bin_size), len(depth)))
+            expected = np.add.reduceat(depth, np.arange(0, len(depth), bin_size)) / sizes
+            found = np.zeros(len(expected))
+            for start, end, value in bw.intervals(name) or ():
+                assert start % bin_size == 0 and value > 0
+                found[start // bin_size:(end + bin_size - 1) // bin_size] = value
+            np.testing.assert_allclose(found, expected, rtol=1e-6)
+            # the zoom levels summarise the same depth, over the bases with data
+            assert bw.stats(name, type='max')[0] == pytest.approx(expected.max(), rel=1e-6)
+            mean = depth.sum() / sizes[expected > 0].sum()
+            assert bw.stats(name, type='mean')[0] == pytest.approx(mean, rel=1e-3)
+
+
+def test_coverage_tracks_skip_failures(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(igv_web, 'manifest', None)
+    good = write_test_bam(tmp_path / 'good.bam', reads=2000)
+    empty = write_test_bam(tmp_path / 'empty.bam', reads=0)
+    bad = str(tmp_path / 'bad.bam')
+    with open(good, 'rb') as f:
+        (tmp_path / 'bad.bam').write_bytes(f.read()[:3000])
+    shutil.copy(good + '.bai', bad + '.bai')
+    igv_web.build_coverage_tracks([bad, good, empty], 25)
+    assert 'could not compute the coverage of ' + bad in capsys.readouterr().err
+    # the other bams are still done, and only bigWigs that exist are registered
+    tracks = igv_web.get_manifest().tracks()
+    assert [track_id for track_id, track in tracks] == ['good.coverage', 'empty.coverage']
+    assert all(os.path.isfile(track['url']) for track_id, track in tracks)
+    assert not os.path.exists(str(tmp_path / 'bad.coverage.bw'))
+
+
+def random_sequence(rng, length):
+    # bases with soft-masked stretches and runs of N, as in a real assembly
+    bases = np.frombuffer(b'ACGT', np.uint8)[rng.integers(0, 4, length)]
+    for beg in rng.integers(0, length, length // 5000 + 1):
+        bases[beg:beg + int(rng.integers(1, 3000))] |= 0x20
+    for beg in rng.integers(0, length, length // 20000 + 1):
+        bases[beg:beg + int(rng.integers(1, 5000))] = ord('N')
+    return bases.tobytes().decode()
+
+
+def write_test_fasta(path, seed=10):
+    '''Writes a FASTA of sequences with different line widths, lengths that do
+    and do not fill their last line, and mixed case and N runs; returns
+    {name: sequence}.
+    '''
+    rng = default_rng(seed)
+    sequences = {'chr1': random_sequence(rng, 200000), 'chr2': random_sequence(rng, 60 * 1000),
+                 'chrM': random_sequence(rng, 16569), 'tiny': 'ACGTn'}
+    widths = {'chr1': 60, 'chr2': 60, 'chrM': 70, 'tiny': 60}
+    with open(path, 'w') as f:
+        for name, seq in sequences.items():
+            f.write('>{} description\n'.format(name))
+            f.writelines(seq[i:i + widths[name]] + '\n' for i in range(0, len(seq), widths[name]))
+    return sequences
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_faidx(tmp_path, compressed):
+    sequences = write_test_fasta(tmp_path / 'ref.fa')
+    fasta = str(tmp_path / 'ref.fa')
+    if compressed:
+        pysam.tabix_compress(fasta, fasta + '.gz')
+        fasta += '.gz'
+    (tmp_path / 'pysam').mkdir()
+    reference = str(tmp_path / 'pysam' / os.path.basename(fasta))
+    shutil.copy(fasta, reference)
+    pysam.faidx(reference)
+    # small chunks, so records are cut across chunks and joined
+    with futures.ThreadPoolExecutor(4) as pool:
+        igv_fasta.faidx(fasta, pool, chunk_size=50000)
+    suffixes = ['.fai', '.gzi'] if compressed else ['.fai']
+    for suffix in suffixes:
+        with open(fasta + suffix, 'rb') as ours, open(reference + suffix, 'rb') as theirs:
+            assert ours.read() == theirs.read()
+    entries = igv_fasta.read_fai(fasta + '.fai')
+    blocks = igv_bgzf.bgzf_blocks(fasta) if compressed else None
+    rng = default_rng(11)
+    with pysam.FastaFile(fasta) as f:
+        for name, seq in sequences.items():
+            for beg in rng.integers(0, len(seq), 50):
+                end = int(beg) + int(rng.integers(1, 5000))
+                assert igv_fasta.fetch(fasta, entries[name], int(beg), end, blocks).decode() == \
+                    f.fetch(name, int(beg), end) == seq[beg:end]
+
+
+def fetched_reads(bam, index, regions):
+    # names of the reads pysam returns for each region through the given index
+    with pysam.AlignmentFile(bam, index_filename=index) as f:
+        return [sorted(read.query_name for read in f.fetch(*region)) for region in regions]
+
+
+def test_write_bai(tmp_path):
+    bam = write_test_bam(tmp_path / 'x.bam')
+    with futures.ProcessPoolExecutor(2) as pool:
+        # small chunks, so records straddle the chunks that are indexed apart
+        igv_bam.write_bai(bam, str(tmp_path / 'ours.bai'), pool, chunk_size=100000)
+    igv_bam.write_bai(bam, str(tmp_path / 'inline.bai'))
+    ours, reference = igv_bam.read_bai(str(tmp_path / 'ours.bai')), igv_bam.read_bai(bam + '.bai')
+    assert ours == igv_bam.read_bai(str(tmp_path / 'inline.bai'))
+    # htslib also folds small bins into their parents, so only the linear
+    # index and the pseudo-bin must match as they are
+    assert [ref['linear'] for ref in ours] == [ref['linear'] for ref in reference]
+    assert [ref['meta'] for ref in ours] == [ref['meta'] for ref in reference]
+    with pysam.AlignmentFile(bam, index_filename=str(tmp_path / 'ours.bai')) as f:
+        assert f.mapped == 20000 and f.unmapped == 50
+    rng = default_rng(12)
+    regions = [(name, int(beg), int(beg) + int(rng.integers(1, 50000)))
+               for name, length in BAM_REFERENCES for beg in rng.integers(0, length, 30)]
+    regions += [(name,) for name, length in BAM_REFERENCES]
+    assert fetched_reads(bam, str(tmp_path / 'ours.bai'), regions) == fetched_reads(bam, bam + '.bai', regions)
+
+
+def test_index_bams(tmp_path):
+    bams = [write_test_bam(tmp_path / '{}.bam'.format(i), reads=3000, seed=i) for i in range(3)]
+    for i, bam in enumerate(bams):
+        os.replace(bam + '.bai', str(tmp_path / '{}.pysam.bai'.format(i)))
+    # a missing index and one older than its bam are written, a current one is kept
+    (tmp_path / '1.bam.bai').write_bytes(b'stale')
+    os.utime(bams[1] + '.bai', (0, 0))
+    (tmp_path / '2.bam.bai').write_bytes(b'current')
+    igv_web.index_bams(bams)
+    regions = [(name,) for name, length in BAM_REFERENCES] + [('chr1', 5000, 6000), ('chr2', 100000, 120000)]
+    for i, bam in enumerate(bams[:2]):
+        assert fetched_reads(bam, bam + '.bai', regions) == \
+            fetched_reads(bam, str(tmp_path / '{}.pysam.bai'.format(i)), regions)
+    assert (tmp_path / '2.bam.bai').read_bytes() == b'current'
+
+
+def test_remote_cache(tmp_path, monkeypatch):
+    (tmp_path / 'origin').mkdir()
+    base = serve_directory(tmp_path / 'origin')
+    cache = igv_web.RemoteCache(str(tmp_path / 'remote'), block_size=1000)
+    cache.configure(1000000, [base])
+    old, new = b'a' * 4500, b'b' * 6000
+    (tmp_path / 'origin' / 'x.bin').write_bytes(old)
+    url = base + '/x.bin'
+    assert cache.info(url)[0] == 4500
+    assert b''.join(cache.read_range(url, 0, 1999)) == old[:2000]
+    # a new version on the origin, first seen when a missing block is fetched
+    (tmp_path / 'origin' / 'x.bin').write_bytes(new)
+    os.utime(tmp_path / 'origin' / 'x.bin', (1e9, 1e9))
+    assert b''.join(cache.read_range(url, 3000, 3999)) == new[3000:4000]
+    assert cache.info(url)[0] == 6000
+    # the blocks of the old version are gone, not served next to the new ones
+    assert b''.join(cache.read_range(url, 0, 5999)) == new
+    assert sorted(name for name in os.listdir(tmp_path / 'remote') if not name.endswith('.json')) == \
+        ['{}.{}'.format(cache.key(url), i) for i in range(6)]
+    (tmp_path / 'origin' / 'empty.bin').write_bytes(b'')
+    monkeypatch.setattr(igv_web, 'REMOTE_CACHE', cache)
+    code, headers, body = igv_web.proxy_response('/proxy/http/' + base[7:] + '/empty.bin', {}, lambda path: 'x')
+    assert code == 200 and ('Content-Length', '0') in headers and b''.join(body) == b''
+
+
+class WholeFileHandler(http.server.BaseHTTPRequestHandler):
+    # an origin that ignores Range and sends no Content-Length
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'z' * 2500)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_remote_cache_unknown_size(tmp_path, monkeypatch):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), WholeFileHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    cache = igv_web.RemoteCache(str(tmp_path / 'remote'), block_size=1000)
+    cache.configure(1000000, [base])
+    assert cache.info(base + '/x.bin')[0] is None
+    monkeypatch.setattr(igv_web, 'REMOTE_CACHE', cache)
+    code, message, body = igv_web.proxy_response('/proxy/http/' + base[7:] + '/x.bin', {}, lambda path: 'x')
+    assert code == 502 and body is None
+
+
+def test_remote_cache_block_stored_again(tmp_path, monkeypatch):
+    (tmp_path / 'origin').mkdir()
+    (tmp_path / 'origin' / 'x.bin').write_bytes(bytes(range(256)) * 20)
+    base = serve_directory(tmp_path / 'origin')
+    cache = igv_web.RemoteCache(str(tmp_path / 'remote'), block_size=1000)
+    cache.configure(1000000, [base])
+    url = base + '/x.bin'
+    assert b''.join(cache.read_range(url, 0, 2999)) == (bytes(range(256)) * 20)[:3000]
+    # the block was evicted when load() looked and stored again before fetch_blocks() did
+    load, missed = cache.load, []
+    def evicted_once(url, index):
+        if not missed:
+            missed.append(index)
+            return None
+        return load(url, index)
+    monkeypatch.setattr(cache, 'load', evicted_once)
+    assert b''.join(cache.read_range(url, 1500, 2500)) == (bytes(range(256)) * 20)[1500:2501]
+    assert missed == [1]
+
+
+def test_compressed_etags(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = b''.join(b'var x%d = %d;\n' % (i, i) for i in range(20000))
+    (tmp_path / 'app.js').write_bytes(data)
+    base = serve_directory(tmp_path)
+    status, headers, body = http_get(base + '/app.js', {'Accept-Encoding': 'gzip'})
+    # gzip on the fly: a weak tag, which may not serve If-Range
+    assert status == 200 and headers['Content-Encoding'] == 'gzip' and gzip.decompress(body) == data
+    streamed = headers['ETag']
+    assert streamed.startswith('W/"')
+    assert not igv_web.if_range_matches({'If-Range': streamed}, None, streamed)
+    for _ in range(100):
+        if any(name.endswith('.gz') for name in os.listdir(tmp_path / 'Cache' / 'compressed')):
+            break
+        time.sleep(0.05)
+    status, headers, body = http_get(base + '/app.js', {'Accept-Encoding': 'gzip'})
+    assert status == 200 and gzip.decompress(body) == data and headers['ETag'] == streamed[2:]
+    # the same content either way, so each tag revalidates the other weakly
+    assert http_get(base + '/app.js', {'Accept-Encoding': 'gzip', 'If-None-Match': streamed})[0] == 304
+
+
+def api_post(base, body, host=None, origin=None, length=None):
+    # status line and JSON reply of a raw POST /api/tracks
+    host = host or base.rsplit('/', 1)[-1]
+    head = 'POST /api/tracks HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\n' \
+           'Content-Length: {}\r\nConnection: close\r\n'.format(host, len(body) if length is None else length)
+    if origin:
+        head += 'Origin: {}\r\n'.format(origin)
+    reply = raw_request(base, head.encode() + b'\r\n' + body)
+    status, _, rest = reply.partition(b'\r\n')
+    return int(status.split()[1]), rest.partition(b'\r\n\r\n')[2]
+
+
+@pytest.mark.parametrize('serve', [serve_directory, serve_asyncio])
+def test_api_changes_need_a_local_host(tmp_path, monkeypatch, serve):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(igv_web, 'manifest', None)
+    base = serve(tmp_path)
+    port = base.rsplit(':', 1)[1]
+    version = igv_web.get_manifest().version()
+    assert api_post(base, b'{}') == (200, b'{"added": []}')
+    # registering nothing does not move the version the pages follow
+    assert igv_web.get_manifest().version() == version
+    for host in ('localhost:' + port, '[::1]:' + port):
+        assert api_post(base, b'{}', host=host, origin='http://' + host)[0] == 200
+    # a site rebound to 127.0.0.1 by DNS still names itself
+    assert api_post(base, b'{}', host='evil.example:' + port)[0] == 403
+    assert api_post(base, b'{}', host='localhost:1')[0] == 403
+    assert api_post(base, b'{}', origin='http://evil.example:' + port)[0] == 403
+    for length in ('zz', '-1'):
+        assert api_post(base, b'', length=length)[0] == 400
+
+
+def test_readahead(tmp_path):
+    bam = write_test_bam(tmp_path / 'x.bam', reads=60000)
+    fs = os.stat(bam)
+    data = open(bam, 'rb').read()
+    offsets = igv_bam.block_offsets(igv_bam.read_bai(bam + '.bai'))
+    readahead = igv_web.Readahead(budget=3 * 65536)
+    start = offsets[1]
+    first, last = start, start + 20000
+    assert readahead.read(bam, fs.st_mtime_ns, first, last) is None
+    for _ in range(8):
+        # a client panning right, one chunk at a time
+        readahead.advise('client', bam, fs, first, last)
+        for _ in range(100):
+            if not readahead.queued and not readahead.pending:
+                break
+            time.sleep(0.01)
+        first, last = last + 1, last + 20001
+        found = readahead.read(bam, fs.st_mtime_ns, first, last)
+        assert found is None or found == data[first:last + 1]
+    assert readahead.hits > 0 and readahead.size <= 3 * 65536
+    # the start lists follow the segments through eviction
+    assert sorted(readahead.segments) == sorted((key[0], key[1], start) for key, starts in readahead.starts.items()
+                                                for start in starts)
+    assert readahead.read(bam, fs.st_mtime_ns + 1, first, last) is None
+
+
+SLICE_REGIONS = [('chr1', 5000, 6000), ('chr1', 5500, 9000), ('chr1', 150000, 150001), ('chr2', 0, 3000),
+                 ('chrM', 16000, 17000), ('chrZ', 0, 1000)]
+
+
+def test_slice_bam(tmp_path):
+    bam = write_test_bam(tmp_path / 'x.bam')
+    out = str(tmp_path / 'slice.bam')
+    written = igv_bam.slice_bam(bam, out, SLICE_REGIONS)
+    regions = [region for region in SLICE_REGIONS if region[0] != 'chrZ']
+    with pysam.AlignmentFile(bam) as f:
+        expected = {read.query_name for region in regions for read in f.fetch(*region)}
+        header = str(f.header)
+    with pysam.AlignmentFile(out) as f:
+        assert str(f.header) == header
+        assert sorted(read.query_name for read in f.fetch(until_eof=True)) == sorted(expected)
+    assert written == len(expected)
+    # the slice carries an index of its own
+    assert fetched_reads(out, out + '.bai', regions) == fetched_reads(bam, bam + '.bai', regions)
+
+
+def test_slice_bigwig(tmp_path):
+    rng = default_rng(13)
+    src, dst = str(tmp_path / 'x.bw'), str(tmp_path / 'slice.bw')
+    with pyBigWig.open(src, 'w') as bw:
+        bw.addHeader([(name, length) for name, length in BAM_REFERENCES])
+        for name, length in BAM_REFERENCES:
+            starts = np.arange(0, length - 50, 50)
+            keep = starts[rng.random(len(starts)) < 0.7]
+            bw.addEntries([name] * len(keep), keep.tolist(), ends=(keep + 50).tolist(),
+                          values=rng.random(len(keep)).round(3).tolist())
+    written = igv_bigwig.slice_bigwig(src, dst, SLICE_REGIONS)
+    merged = igv_bgzf.merge_regions([region for region in SLICE_REGIONS if region[0] != 'chrZ'])
+    with pyBigWig.open(src) as source, pyBigWig.open(dst) as sliced:
+        assert sliced.chroms() == {name: length for name, length in BAM_REFERENCES if name in ('chr1', 'chr2', 'chrM')}
+        items = 0
+        for name, beg, end in merged:
+            expected = [(max(start, beg), min(stop, end), value)
+                        for start, stop, value in source.intervals(name, beg, min(end, source.chroms(name)))]
+            assert [(start, stop, pytest.approx(value)) for start, stop, value in sliced.intervals(name)
+                    if start < end and stop > beg] == expected
+            items += len(expected)
+        assert written == items == sum(len(sliced.intervals(name)) for name in sliced.chroms())
+        # the zoom levels are rebuilt from the slice alone
+        assert sliced.stats('chr1', 5000, 9000, type='max', exact=False)[0] == \
+            pytest.approx(source.stats('chr1', 5000, 9000, type='max', exact=True)[0], rel=1e-6)
+
+
+def test_slice_tabix(tmp_path):
+    features = random_features(default_rng(14), zero_based=True)
+    (tmp_path / 'x.bed').write_text('track name=x\n' + ''.join('{}\t{}\t{}\tf{}\n'.format(c, b, e, i)
+                                                              for i, (c, b, e) in enumerate(features)))
+    src, dst = str(tmp_path / 'x.bed.gz'), str(tmp_path / 'slice.bed.gz')
+    igv_bgzf.bgzip_tabix(str(tmp_path / 'x.bed'), src, 'bed')
+    regions = [('chr1', 5000, 6000), ('chr1', 5500, 90000), ('chr2', 1000000, 1000001), ('chrX', 0, 3000),
+               ('chrZ', 0, 1000)]
+    written = igv_bgzf.slice_tabix(src, dst, regions)
+    source, sliced = pysam.TabixFile(src), pysam.TabixFile(dst)
+    expected = set()
+    for name, beg, end in regions[:-1]:
+        # a region without records leaves its sequence out of the slice's index
+        found = sorted(sliced.fetch(name, beg, end)) if name in sliced.contigs else []
+        assert found == sorted(source.fetch(name, beg, end))
+        expected.update(found)
+    assert written == len(expected) == sum(1 for name in sliced.contigs for _ in sliced.fetch(name))
+    with gzip.open(dst, 'rt') as f:
+        assert f.readline() == 'track name=x\n'
+
+
+def test_export_bundle(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(igv_web, 'manifest', None)
+    sequences = write_test_fasta(tmp_path / 'ref.fa')
+    bam = write_test_bam(tmp_path / 'x.bam', reads=5000)
+    features = random_features(default_rng(15), count=500)
+    (tmp_path / 'genes.gtf').write_text(''.join('{}\tsrc\texon\t{}\t{}\t.\t+\t.\tgene_id "g{}";\n'.format(
+        c, b, e, i) for i, (c, b, e) in enumerate(features)))
+    igv_web.igv_web('ref.fa', ['x.bam'], None, None, ['genes.gtf'], 'chr1:5001-6000 chr2:1001-3000', None, None)
+    igv_web.export_bundle('out', igv_web.read_loci(igv_web.get_manifest().settings()['locus'].split()))
+    html = (tmp_path / 'out' / 'index.html').read_text()
+    page = json.loads(re.search(r'var bundled = (.*);\n', html).group(1))
+    assert page['locus'] == 'chr1:5001-6000 chr2:1001-3000'
+    assert page['genome']['fastaURL'] == 'data/ref.fa.gz'
+    # every link of the page resolves inside the bundle
+    links = [page['genome'][key] for key in ('fastaURL', 'indexURL', 'compressedIndexURL')]
+    links += [track['config'][key] for track in page['tracks'] for key in ('url', 'indexURL') if key in track['config']]
+    assert all((tmp_path / 'out' / link).is_file() for link in links)
+    assert sorted(track['config']['format'] for track in page['tracks']) == ['bam', 'gtf']
+    regions = [('chr1', 5000, 6000), ('chr2', 1000, 3000)]
+    bundled = str(tmp_path / 'out' / [track for track in page['tracks']
+                                      if track['config']['format'] == 'bam'][0]['config']['url'])
+    assert fetched_reads(bundled, bundled + '.bai', regions) == fetched_reads(bam, bam + '.bai', regions)
+    # the reference is kept within the loci and masked outside them
+    with pysam.FastaFile(str(tmp_path / 'out' / 'data' / 'ref.fa.gz')) as f:
+        for name, beg, end in regions:
+            assert f.fetch(name, beg, end) == sequences[name][beg:end]
+        assert set(f.fetch('chr1', 0, 5000)) == {'N'} and list(f.references) == ['chr1', 'chr2']
+        assert f.get_reference_length('chr1') == len(sequences['chr1'])
+
+
+def test_control_server_refuses_local_options(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(igv_web, 'manifest', None)
+    write_test_bam(tmp_path / 'x.bam', reads=2000)
+    port = serve_directory(tmp_path).rsplit(':', 1)[1]
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'igv_web.py')
+    def run(*args):
+        return subprocess.run([sys.executable, script, '-p', port] + list(args), cwd=str(tmp_path),
+                              capture_output=True, text=True)
+    # options the running server would not apply are refused, and nothing is changed
+    result = run('-ab', 'x.bam', '-l', 'chr1:1-100', '-w', 'y.bw')
+    assert result.returncode == 2 and '-w, -l cannot be applied through the server' in result.stderr
+    assert igv_web.get_manifest().tracks() == []
+    assert run('-rb', 'x.bam', '-ex', 'out').returncode == 2
+    # -ix and -cov go along with -ab
+    result = run('-ab', 'x.bam', '-cov', '100')
+    assert result.returncode == 0 and 'added x, x.coverage' in result.stderr
+    assert [track_id for track_id, track in igv_web.get_manifest().tracks()] == ['x', 'x.coverage']
+    assert os.path.isfile(str(tmp_path / 'x.coverage.bw'))
+    result = run('-rb', 'x.bam')
+    assert result.returncode == 0 and igv_web.get_manifest().tracks() == []
+
+
+def test_export_uses_saved_loci(tmp_path):
+    write_test_bam(tmp_path / 'x.bam', reads=2000)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'igv_web.py')
+    # -ex without -l falls back to the loci a run before saved in the project
+    for args in (['-m', 'x.bam', '-l', 'chr1:5001-6000', '-ex', 'out1'], ['-m', 'x.bam', '-ex', 'out2'],
+                 ['-ex', 'out3']):
+        subprocess.run([sys.executable, script] + args, cwd=str(tmp_path), check=True, capture_output=True)
+        html = (tmp_path / args[-1] / 'index.html').read_text()
+        assert json.loads(re.search(r'var bundled = (.*);\n', html).group(1))['locus'] == 'chr1:5001-6000'
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+@pytest.mark.parametrize('parallel', [False, True])
+def test_twobit_round_trip(tmp_path, compressed, parallel):
+    sequences = write_test_fasta(tmp_path / 'ref.fa')
+    fasta = str(tmp_path / 'ref.fa')
+    if compressed:
+        pysam.tabix_compress(fasta, fasta + '.gz')
+        fasta += '.gz'
+    igv_fasta.faidx(fasta)
+    twobit = str(tmp_path / 'ref.2bit')
+    if parallel:
+        with futures.ProcessPoolExecutor(2) as pool:
+            igv_twobit.fasta_to_twobit(fasta, twobit, pool)
+    else:
+        igv_twobit.fasta_to_twobit(fasta, twobit)
+    assert igv_twobit.sequence_sizes(twobit) == {name: len(seq) for name, seq in sequences.items()}
+    with open(twobit, 'rb') as f:
+        buf = f.read()
+    order, index = igv_twobit.read_index(buf)
+    assert list(index) == list(sequences)
+    rng = default_rng(12)
+    names = list(sequences)
+    for _ in range(900):
+        name = names[rng.integers(0, len(names))]
+        seq = sequences[name]
+        beg = int(rng.integers(0, len(seq)))
+        end = min(beg + int(rng.integers(1, 20000)), len(seq))
+        assert igv_twobit.decode(buf, order, index[name], beg, end).decode() == seq[beg:end]
+        assert igv_twobit.decode(buf, order, index[name], beg, end, mask=False).decode() == seq[beg:end].upper()
+    # the whole of every sequence, and ends past it clamped
+    for name, seq in sequences.items():
+        assert igv_twobit.decode(buf, order, index[name], 0, len(seq) + 100).decode() == seq
+
+
+@pytest.mark.parametrize('serve', [serve_directory, serve_asyncio])
+def test_sequence_requests(tmp_path, serve):
+    sequences = write_test_fasta(tmp_path / 'ref.fa')
+    igv_fasta.faidx(str(tmp_path / 'ref.fa'))
+    igv_twobit.fasta_to_twobit(str(tmp_path / 'ref.fa'), str(tmp_path / 'ref.2bit'))
+    base = serve(tmp_path) + igv_web.SEQUENCE_PATH
+    status, headers, body = http_get(base + '/ref.2bit?locus=chr1:1,001-3,000')
+    assert status == 200 and body.decode() == sequences['chr1'][1000:3000]
+    assert headers['Content-Type'] == 'text/plain'
+    status, _, body = http_get(base + '/ref.2bit?locus=chrM:16000-17000&mask=0')
+    assert status == 200 and body.decode() == sequences['chrM'][15999:].upper()
+    for query in ('', '?locus=chr1', '?locus=chr1:5-4', '?locus=chr9:1-10', '?locus=chr1:1-%d'
+                  % (igv_web.MAX_SEQUENCE + 1)):
+        assert http_get(base + '/ref.2bit' + query)[0] == 400
+    (tmp_path / 'bad.2bit').write_bytes(b'x' * 64)
+    assert http_get(base + '/bad.2bit?locus=chr1:1-10')[0] == 400
+    assert http_get(base + '/missing.2bit?locus=chr1:1-10')[0] == 404
+
+
+def test_block_cache(tmp_path):
+    data = os.urandom(64 * 1024)
+    (tmp_path / 'x.bai').write_bytes(data)
+    cache = igv_web.BlockCache(capacity=4096, block_size=1024, head_size=2048)
+    path = str(tmp_path / 'x.bai')
+    with open(path, 'rb') as f:
+        assert cache.read_range(path, 1, 10, 2999, f) == data[10:3000]
+        assert (cache.hits, cache.misses) == (0, 3)
+        assert cache.read_range(path, 1, 100, 1100) == data[100:1101]
+        assert (cache.hits, cache.misses) == (2, 3)
+        # without a file a miss returns None and counts nothing
+        assert cache.read_range(path, 1, 5000, 5100) is None
+        # least recently used blocks go first
+        cache.read_range(path, 1, 3072, 4095, f)
+        cache.read_range(path, 1, 4096, 5119, f)
+        assert cache.size == 4096 and cache.read_range(path, 1, 2048, 2100) is None
+        assert cache.read_range(path, 1, 0, 1023) == data[:1024]
+        # a new mtime drops every block of the path
+        assert cache.read_range(path, 2, 0, 10) is None and cache.size == 0
+        assert cache.read_range(path, 2, 0, 10, f) == data[:11]
+    # index files are cached whole, other files only at their head
+    assert cache.accepts('x.bai', 0, 10 ** 9) and cache.accepts('x.bam', 0, 2047)
+    assert not cache.accepts('x.bam', 1024, 4095) and not cache.accepts('x.bam', 10 ** 6, 2 * 10 ** 6)
+    assert not igv_web.BlockCache(capacity=0).accepts('x.bai', 0, 10)
+
+
+@pytest.mark.parametrize('serve', [serve_directory, serve_asyncio])
+def test_block_cache_keeps_indexes(tmp_path, monkeypatch, serve):
+    bam = os.urandom(1024 * 1024)
+    bai = os.urandom(96 * 1024)
+    (tmp_path / 'x.bam').write_bytes(bam)
+    (tmp_path / 'x.bai').write_bytes(bai)
+    monkeypatch.setattr(igv_web, 'BLOCK_CACHE', igv_web.BlockCache(capacity=256 * 1024))
+    base = serve(tmp_path)
+    assert http_get(base + '/x.bai')[2] == bai
+    assert http_get(base + '/x.bam', {'Range': 'bytes=0-99'})[2] == bam[:100]
+    cached = dict(igv_web.BLOCK_CACHE.paths)
+    # streaming chunks of the BAM past its header leaves the cached blocks alone
+    for first in range(65536, len(bam), 200 * 1024):
+        assert http_get(base + '/x.bam', {'Range': 'bytes={}-{}'.format(first, first + 150 * 1024)})[2] == \
+            bam[first:first + 150 * 1024 + 1]
+    assert igv_web.BLOCK_CACHE.paths == cached and len(cached) == 2
+    hits = igv_web.BLOCK_CACHE.hits
+    assert http_get(base + '/x.bai', {'Range': 'bytes=70000-80000'})[2] == bai[70000:80001]
+    assert igv_web.BLOCK_CACHE.hits == hits + 1
+    # -cs 0 turns the cache off and files are still served
+    igv_web.BLOCK_CACHE.configure(0)
+    assert http_get(base + '/x.bai')[2] == bai and igv_web.BLOCK_CACHE.size == 0
+
+
+class SchedulerClient(threading.Thread):
+    # acquires a scheduler slot, records when it is admitted, and holds the slot until finish is set
+    def __init__(self, scheduler, client, priority, order):
+        threading.Thread.__init__(self, daemon=True)
+        self.scheduler, self.client, self.priority, self.order = scheduler, client, priority, order
+        self.started = threading.Event()
+        self.finish = threading.Event()
+
+    def admitted(self):
+        # called by the thread that freed the slot, so the order is that of admission
+        self.order.append(self)
+        self.started.set()
+
+    def run(self):
+        ticket, ready = self.scheduler.acquire(self.client, self.priority, self.admitted)
+        if ready:
+            self.admitted()
+        self.finish.wait()
+        self.scheduler.release(ticket)
+
+
+def start_clients(scheduler, order, *requests):
+    clients = []
+    for client, priority in requests:
+        clients.append(SchedulerClient(scheduler, client, priority, order))
+        clients[-1].start()
+        # let it reach the queue, so that arrival order is fixed
+        clients[-1].started.wait(0.2)
+    return clients
+
+
+def test_scheduler_priorities():
+    scheduler = igv_web.RequestScheduler(slots=4)
+    order = []
+    bulk = start_clients(scheduler, order, *[('a', igv_web.BULK)] * 5)
+    # bulk transfers leave the last quarter of the slots to the others
+    assert order == bulk[:3] and scheduler.snapshot()[:2] == ([0, 0, 3], [0, 0, 2])
+    small = start_clients(scheduler, order, ('b', igv_web.SMALL))[0]
+    assert small.started.is_set()
+    later = start_clients(scheduler, order, ('b', igv_web.SMALL), ('c', igv_web.INDEX))
+    assert not any(client.started.is_set() for client in later)
+    # freed slots go to the index, then the small read, then bulk
+    for client in bulk[:3]:
+        client.finish.set()
+        client.join()
+    for client in [bulk[3]] + later:
+        assert client.started.wait(5)
+    assert order[4:] == [later[1], later[0], bulk[3]] and not bulk[4].started.is_set()
+    small.finish.set()
+    assert bulk[4].started.wait(5)
+    for client in bulk[3:] + [small] + later:
+        client.finish.set()
+        client.join()
+    assert scheduler.snapshot()[:2] == ([0, 0, 0], [0, 0, 0])
+    # every admission was timed
+    assert sum(hist.count for hist in scheduler.snapshot()[2].values()) == 8
+
+
+def test_scheduler_per_client():
+    scheduler = igv_web.RequestScheduler(slots=8, per_client=2)
+    order = []
+    first = start_clients(scheduler, order, *[('a', igv_web.BULK)] * 3)
+    assert order == first[:2]
+    other = start_clients(scheduler, order, ('b', igv_web.BULK))[0]
+    # client a is at its cap, b is not and overtakes it
+    assert other.started.is_set() and not first[2].started.is_set()
+    first[0].finish.set()
+    assert first[2].started.wait(5)
+    for client in first + [other]:
+        client.finish.set()
+        client.join()
+
+
+def test_scheduler_delay():
+    scheduler = igv_web.RequestScheduler(client_rate=1000)
+    # a one second burst goes at once, after that the rate holds
+    assert scheduler.delay('a', 500) == 0.0
+    assert scheduler.delay('a', 1000) == pytest.approx(0.5, abs=0.05)
+    assert scheduler.delay('a', 1000) == pytest.approx(1.5, abs=0.05)
+    # per client, and not at all without a rate
+    assert scheduler.delay('b', 1000) == 0.0
+    assert igv_web.RequestScheduler().delay('a', 10 ** 9) == 0.0
+
+
+@pytest.mark.parametrize('serve', [serve_directory, serve_asyncio])
+def test_scheduler_queue_metrics(tmp_path, monkeypatch, serve):
+    (tmp_path / 'x.bam').write_bytes(os.urandom(1024 * 1024))
+    scheduler = igv_web.RequestScheduler(slots=1)
+    monkeypatch.setattr(igv_web, 'SCHEDULER', scheduler)
+    base = serve(tmp_path)
+    order = []
+    holder = start_clients(scheduler, order, ('test', igv_web.BULK))[0]
+    replies = []
+    reader = threading.Thread(target=lambda: replies.append(http_get(base + '/x.bam')), daemon=True)
+    reader.start()
+    for _ in range(100):
+        text = http_get(base + igv_web.METRICS_PATH)[2].decode()
+        if 'igv_scheduler_queued{class="bulk"} 1\n' in text:
+            break
+        time.sleep(0.05)
+    assert 'igv_scheduler_queued{class="bulk"} 1\n' in text
+    assert 'igv_scheduler_active{class="bulk"} 1\n' in text
+    holder.finish.set()
+    reader.join(5)
+    assert replies[0][0] == 200 and len(replies[0][2]) == 1024 * 1024
+    assert 'igv_scheduler_queued{class="bulk"} 0\n' in http_get(base + igv_web.METRICS_PATH)[2].decode()
+
+
+def test_file_pool_reopens_changed_files(tmp_path):
+    pool = igv_web.FilePool(4)
+    path = str(tmp_path / 'x.bin')
+    (tmp_path / 'x.bin').write_bytes(b'a' * 100)
+    with pool.acquire(path) as f:
+        assert f.read() == b'a' * 100
+    with pool.acquire(path) as f:
+        assert f.read(10) == b'a' * 10
+    assert (pool.opens, pool.hits) == (1, 1)
+    # replaced by a rename: another inode
+    (tmp_path / 'x.new').write_bytes(b'b' * 100)
+    os.replace(str(tmp_path / 'x.new'), path)
+    with pool.acquire(path) as f:
+        assert f.read() == b'b' * 100
+    # rewritten in place with the same size: another mtime
+    with open(path, 'r+b') as f:
+        f.write(b'c' * 100)
+    os.utime(path, ns=(1, 10 ** 18))
+    with pool.acquire(path) as f:
+        assert f.read() == b'c' * 100
+    assert pool.opens == 3
+    os.remove(path)
+    with pytest.raises(FileNotFoundError):
+        pool.acquire(path)
+    assert not pool.files
+
+
+def test_file_pool_keeps_evicted_files_in_use(tmp_path):
+    pool = igv_web.FilePool(1)
+    (tmp_path / 'a.bin').write_bytes(b'a' * 5000)
+    (tmp_path / 'b.bin').write_bytes(b'b' * 5000)
+    f = pool.acquire(str(tmp_path / 'a.bin'))
+    f.seek(1000)
+    with pool.acquire(str(tmp_path / 'b.bin')) as g:
+        assert g.read() == b'b' * 5000
+    # a.bin left the pool, but the response still reading it keeps it open
+    assert list(pool.files) == [str(tmp_path / 'b.bin')] and not f.entry.file.closed
+    assert f.read(2000) == b'a' * 2000 and bytes(f.view(0, 9)) == b'a' * 10
+    f.close()
+    assert f.entry.file.closed
+    f.close()
+    assert f.entry.users == 0
+
+
+def open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason='needs /proc')
+@pytest.mark.parametrize('capacity', [0, 4])
+@pytest.mark.parametrize('serve', [serve_directory, serve_asyncio])
+def test_file_pool_error_paths_close_files(tmp_path, monkeypatch, serve, capacity):
+    (tmp_path / 'x.bin').write_bytes(os.urandom(10000))
+    monkeypatch.setattr(igv_web, 'FILE_POOL', igv_web.FilePool(capacity))
+    base = serve(tmp_path)
+    etag = http_get(base + '/x.bin')[1]['ETag']
+    before = open_fds()
+    for _ in range(20):
+        assert http_get(base + '/x.bin', {'Range': 'bytes=20000-'})[0] == 416
+        assert http_get(base + '/x.bin', {'Range': 'bytes=20000-30000, 40000-'})[0] == 416
+        assert http_get(base + '/x.bin', {'If-None-Match': etag})[0] == 304
+        assert http_get(base + '/x.bin', {'Range': 'bytes=0-9', 'If-Range': '"stale"'})[0] == 200
+        assert http_get(base + '/missing.bin')[0] == 404
+    # the server closes each connection just after the reply
+    for _ in range(50):
+        if open_fds() <= before:
+            break
+        time.sleep(0.05)
+    assert open_fds() <= before
+    # and every pooled file was handed back
+    assert all(entry.users == 0 for entry in igv_web.FILE_POOL.files.values())
+
+
+def test_downsample_bam(tmp_path):
+    bam = write_test_bam(tmp_path / 'x.bam')
+    depth, window, beg, end = 5, 100, 2050, 30000
+    data = b''.join(igv_bam.downsample_bam(bam, 'chr1', beg, end, depth, window, seed=3))
+    (tmp_path / 'down.bam').write_bytes(data)
+    assert data.endswith(igv_bgzf.BGZF_EOF) and igv_bgzf.is_bgzf(str(tmp_path / 'down.bam'))
+    with pysam.AlignmentFile(bam) as f:
+        overlapping = {read.query_name: read for read in f.fetch('chr1', beg, end)}
+    with pysam.AlignmentFile(str(tmp_path / 'down.bam')) as f:
+        assert 'downsampled to 5 alignments per 100 bp' in str(f.header)
+        reads = list(f)
+    # coordinate-sorted, a subset of the overlapping reads, at most depth per window
+    starts = [read.reference_start for read in reads]
+    assert starts == sorted(starts) and len(set(read.query_name for read in reads)) == len(reads)
+    assert all(read.query_name in overlapping and read.reference_name == 'chr1' for read in reads)
+    windows = {}
+    for read in overlapping.values():
+        windows.setdefault(max(read.reference_start, beg) // window, []).append(read.query_name)
+    kept = {}
+    for read in reads:
+        kept.setdefault(max(read.reference_start, beg) // window, []).append(read.query_name)
+    assert set(kept) == set(windows)
+    for key, names in windows.items():
+        assert len(kept[key]) == min(depth, len(names))
+    # the crowd over the first 10 kb is cut down, the rest is kept whole
+    assert max(len(names) for names in windows.values()) > depth
+    # the same seed gives the same bytes, another seed other reads
+    assert b''.join(igv_bam.downsample_bam(bam, 'chr1', beg, end, depth, window, seed=3)) == data
+    assert b''.join(igv_bam.downsample_bam(bam, 'chr1', beg, end, depth, window, seed=4)) != data
+    for args in (('chr9',), ('chr1', 10, 10), ('chr1', 0, 100, 0), ('chr1', 0, 100, 5, 0)):
+        with pytest.raises(ValueError):
+            igv_bam.downsample_bam(bam, *args)
+
+
+@pytest.mark.parametrize('serve', [serve_directory, serve_asyncio])
+def test_downsample_requests(tmp_path, serve):
+    bam = write_test_bam(tmp_path / 'x.bam', reads=5000)
+    base = serve(tmp_path) + igv_web.DOWNSAMPLE_PATH
+    status, headers, body = http_get(base + '/x.bam?locus=chr1:2,001-30,000&depth=5&window=100&seed=3')
+    assert status == 200 and body == b''.join(igv_bam.downsample_bam(bam, 'chr1', 2000, 30000, 5, 100, 3))
+    # a whole reference, with the default depth, window and seed
+    status, headers, body = http_get(base + '/x.bam?locus=chrM')
+    assert status == 200 and body == b''.join(igv_bam.downsample_bam(bam, 'chrM'))
+    for query in ('', '?locus=chr9:1-100', '?locus=chr1:100-50', '?locus=chr1:1-100&depth=0',
+                  '?locus=chr1:1-100&depth=x', '?locus=chr1:1-100&window=-1'):
+        assert http_get(base + '/x.bam' + query)[0] == 400
+    assert http_get(base + '/missing.bam?locus=chr1:1-100')[0] == 404
+
+
+def test_track_manifest(tmp_path):
+    manifest = igv_web.TrackManifest(str(tmp_path / 'tracks.db'))
+    assert manifest.version() == 0 and manifest.tracks() == []
+    manifest.put_many([('b', {'url': 'b.bam'}), ('a', {'url': 'a.bam'}), ('c', {'url': 'c.bw'})])
+    assert [track_id for track_id, track in manifest.tracks()] == ['b', 'a', 'c']
+    assert manifest.version() == 1
+    # a changed config keeps its place and bumps the version, an unchanged one does neither
+    manifest.put_many([('a', {'url': 'a2.bam'}), ('d', {'url': 'd.bed'})])
+    assert manifest.tracks() == [('b', {'url': 'b.bam'}), ('a', {'url': 'a2.bam'}), ('c', {'url': 'c.bw'}),
+                                 ('d', {'url': 'd.bed'})]
+    assert manifest.version() == 2
+    manifest.put('a', {'url': 'a2.bam'})
+    assert manifest.version() == 2
+    assert manifest.remove('c') and not manifest.remove('c')
+    assert manifest.get('c') is None and manifest.get('d') == {'url': 'd.bed'}
+    assert manifest.version() == 3
+    # settings round-trip; only the page settings bump the version
+    manifest.set_settings(reference='ref.fa', locus='chr1:1-100', roi=None)
+    assert manifest.settings()['reference'] == 'ref.fa' and manifest.settings()['locus'] == 'chr1:1-100'
+    assert 'roi' not in manifest.settings() and manifest.version() == 4
+    manifest.set_settings(reference='other.fa')
+    assert manifest.version() == 4
+    # everything is in the file, for the next run
+    again = igv_web.TrackManifest(str(tmp_path / 'tracks.db'))
+    assert again.tracks() == manifest.tracks() and again.settings() == manifest.settings()
+
+
+def test_track_manifest_imports_json(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(igv_web, 'manifest', None)
+    (tmp_path / 'Cache').mkdir()
+    # older versions saved each track as a JSON string in Cache/<id>.json
+    for track_id in ('x', 'y'):
+        with open(str(tmp_path / 'Cache' / (track_id + '.json')), 'w') as f:
+            json.dump(json.dumps({'url': track_id + '.bam'}), f)
+    manifest = igv_web.get_manifest()
+    assert manifest.tracks() == [('x', {'url': 'x.bam'}), ('y', {'url': 'y.bam'})]
+    assert not [name for name in os.listdir(str(tmp_path / 'Cache')) if name.endswith('.json')]
+    manifest.remove('x')
+    monkeypatch.setattr(igv_web, 'manifest', None)
+    assert igv_web.get_manifest().tracks() == [('y', {'url': 'y.bam'})]
+    assert igv_web.get_manifest() is igv_web.get_manifest()
+
+
+def manifest_in_child(queue):
+    manifest = igv_web.get_manifest()
+    manifest.put('child', {'url': 'child.bam'})
+    queue.put((manifest.pid == os.getpid(), [track_id for track_id, track in manifest.tracks()]))
+
+
+def test_manifest_per_process(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(igv_web, 'manifest', None)
+    parent = igv_web.get_manifest()
+    parent.put('parent', {'url': 'parent.bam'})
+    # a forked worker opens its own connection instead of using the parent's
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    child = context.Process(target=manifest_in_child, args=(queue,))
+    child.start()
+    assert queue.get(timeout=30) == (True, ['parent', 'child'])
+    child.join()
+    assert igv_web.get_manifest() is parent and parent.get('child') == {'url': 'child.bam'}
+
+
+def child_pids(pid):
+    # the processes whose parent is pid, from /proc
+    children = set()
+    for name in os.listdir('/proc'):
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                fields = f.read().rpartition(')')[2].split()
+        except (OSError, ValueError):
+            continue
+        if int(fields[1]) == pid and fields[0] != 'Z':
+            children.add(int(name))
+    return children
+
+
+def wait_for(condition, timeout=10):
+    end = time.time() + timeout
+    while time.time() < end:
+        value = condition()
+        if value:
+            return value
+        time.sleep(0.05)
+    return condition()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork') or not os.path.isdir('/proc'), reason='needs fork and /proc')
+@pytest.mark.parametrize('engine', ['thread', 'asyncio'])
+def test_workers(tmp_path, engine):
+    data = os.urandom(3 * 1024 * 1024)
+    (tmp_path / 'x.bam').write_bytes(data)
+    # at 1 MB/s after a one second burst, a 3 MB range takes two more seconds
+    script = ('import sys, igv_web\n'
+              'igv_web.SCHEDULER.configure(16, 0, 1024 * 1024)\n'
+              'igv_web.serve_workers(0, sys.argv[1], 2)\n')
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    master = subprocess.Popen([sys.executable, '-c', script, engine], cwd=str(tmp_path), env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        port = re.search(r' port (\d+) ', master.stdout.readline()).group(1)
+        base = 'http://127.0.0.1:' + port
+        workers = wait_for(lambda: len(child_pids(master.pid)) == 2 and child_pids(master.pid))
+        assert workers
+        # a worker that dies is replaced
+        killed = min(workers)
+        os.kill(killed, signal.SIGKILL)
+        replaced = wait_for(lambda: len(child_pids(master.pid) - {killed}) == 2 and child_pids(master.pid))
+        assert replaced and killed not in replaced
+        assert http_get(base + '/x.bam', {'Range': 'bytes=0-99'})[2] == data[:100]
+        # SIGTERM lets a slow response finish before the workers exit
+        replies = []
+        reader = threading.Thread(target=lambda: replies.append(
+            http_get(base + '/x.bam', {'Range': 'bytes=0-{}'.format(len(data) - 1)})))
+        reader.start()
+        time.sleep(0.5)
+        master.send_signal(signal.SIGTERM)
+        reader.join(30)
+        assert replies and replies[0][0] == 206 and replies[0][2] == data
+        assert master.wait(30) == 0
+        assert 'All workers stopped' in master.stdout.read()
+    finally:
+        if master.poll() is None:
+            master.kill()
+        master.wait()
+        master.stdout.close()
+
+
+PROMETHEUS_SAMPLE = re.compile(r'([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+PROMETHEUS_LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\\n]|\\[\\"n])*)"(,|$)')
+
+
+def parse_prometheus(text):
+    '''Parses Prometheus text into {(name, ((label, value), ...)): value},
+    failing on lines that are not in the format or samples of undeclared
+    families.
+    '''
+    kinds, samples = {}, {}
+    for line in text.splitlines():
+        if line.startswith('# TYPE '):
+            name, kind = line[7:].split(' ')
+            assert kind in ('counter', 'gauge', 'histogram') and name not in kinds
+            kinds[name] = kind
+            continue
+        if line.startswith('# HELP '):
+            continue
+        name, labels, value = PROMETHEUS_SAMPLE.match(line).groups()
+        family = re.sub('_(bucket|sum|count)$', '', name) if name not in kinds else name
+        assert family in kinds, line
+        pairs, pos = [], 0
+        while labels and pos < len(labels):
+            match = PROMETHEUS_LABEL.match(labels, pos)
+            unescaped = re.sub(r'\\(.)', lambda m: {'n': '\n'}.get(m.group(1), m.group(1)), match.group(2))
+            pairs.append((match.group(1), unescaped))
+            pos = match.end()
+        samples[(name, tuple(pairs))] = float(value)
+    return samples
+
+
+@pytest.mark.parametrize('serve', [serve_directory, serve_asyncio])
+def test_metrics(tmp_path, monkeypatch, serve):
+    odd = 'we"ird\\name.bin'
+    (tmp_path / 'x.bin').write_bytes(os.urandom(100000))
+    (tmp_path / odd).write_bytes(b'odd')
+    monkeypatch.setattr(igv_web, 'METRICS', igv_web.Metrics())
+    base = serve(tmp_path)
+    assert http_get(base + '/x.bin')[0] == 200
+    assert http_get(base + '/x.bin', {'Range': 'bytes=0-9999'})[0] == 206
+    assert http_get(base + '/x.bin', {'Range': 'bytes=50000-50099'})[0] == 206
+    assert http_get(base + '/missing.bin')[0] == 404
+    assert http_get(base + '/' + urllib.parse.quote(odd))[0] == 200
+    # responses are counted once they are sent, which may be just after the client has them
+    assert wait_for(lambda: sum(igv_web.METRICS.requests.values()) == 5)
+    status, headers, body = http_get(base + igv_web.METRICS_PATH)
+    assert status == 200 and headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    samples = parse_prometheus(body.decode())
+    track = ('track', '/x.bin')
+    assert samples[('igv_requests_total', (track, ('code', '200')))] == 1
+    assert samples[('igv_requests_total', (track, ('code', '206')))] == 2
+    assert samples[('igv_requests_total', (('track', '-'), ('code', '404')))] == 1
+    assert samples[('igv_requests_total', (('track', '/' + odd), ('code', '200')))] == 1
+    assert samples[('igv_sent_bytes_total', (track,))] == 100000 + 10000 + 100
+    assert samples[('igv_client_requests_total', (('client', '127.0.0.1'),))] == 5
+    assert samples[('igv_client_sent_bytes_total', (('client', '127.0.0.1'),))] >= 110103
+    # one range of 10000 bytes and one of 100, in cumulative buckets
+    assert samples[('igv_range_bytes_bucket', (track, ('le', '1024')))] == 1
+    assert samples[('igv_range_bytes_bucket', (track, ('le', '16384')))] == 2
+    assert samples[('igv_range_bytes_bucket', (track, ('le', '+Inf')))] == 2
+    assert samples[('igv_range_bytes_sum', (track,))] == 10100
+    assert samples[('igv_range_bytes_count', (track,))] == 2
+    buckets = [value for (name, labels), value in samples.items()
+               if name == 'igv_request_duration_seconds_bucket' and labels[0] == track]
+    assert len(buckets) == len(igv_web.LATENCY_BUCKETS) + 1 and buckets == sorted(buckets) and buckets[-1] == 3
+    assert samples[('igv_request_duration_seconds_count', (track,))] == 3
+    for name in ('active', 'queued'):
+        assert [samples[('igv_scheduler_' + name, (('class', kind),))] for kind in igv_web.PRIORITY_CLASSES]
+
+
+def test_metrics_label_escaping():
+    metrics = igv_web.Metrics()
+    metrics.observe('/a"b\\c\nd', 200, '::1', 0.01, 5, [(0, 4)])
+    text = metrics.render()
+    assert 'igv_requests_total{track="/a\\"b\\\\c\\nd",code="200"} 1\n' in text
+    samples = parse_prometheus(text)
+    assert samples[('igv_requests_total', (('track', '/a"b\\c\nd'), ('code', '200')))] == 1
+    assert samples[('igv_client_requests_total', (('client', '::1'),))] == 1
+
+
+def test_expand_inputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for path in ('data/b.bam', 'data/a.bam', 'data/sub/c.bam', 'data/sub/c.bam.bai', 'data/notes.txt',
+                 'other/d.bam', 'other/e.bw'):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+    # directories are searched recursively and in order, globs are sorted
+    paths, names = igv_web.expand_inputs(['data', 'other/*.bam'], igv_web.BAM_SUFFIXES)
+    assert paths == ['data/a.bam', 'data/b.bam', 'data/sub/c.bam', 'other/d.bam'] and names == {}
+    assert igv_web.expand_inputs(['**/*.bw'], igv_web.BIGWIG_SUFFIXES)[0] == ['other/e.bw']
+    # sample sheets name their tracks; relative paths are relative to the sheet, repeats are dropped
+    with open('other/samples.csv', 'w') as f:
+        f.write('path,name\n# a comment\n\nd.bam, tumour \n../data/a.bam\n')
+    with open('samples.tsv', 'w') as f:
+        f.write('file\tname\ndata/b.bam\tnormal\nother/d.bam\n')
+    paths, names = igv_web.expand_inputs(['other/samples.csv', 'samples.tsv', 'data/a.bam', 'missing.bam'],
+                                         igv_web.BAM_SUFFIXES)
+    assert paths == ['other/d.bam', 'other/../data/a.bam', 'data/b.bam', 'data/a.bam', 'missing.bam']
+    assert names == {'other/d.bam': 'tumour', 'data/b.bam': 'normal'}
+
+
+def test_validate_inputs(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(igv_web, 'manifest', None)
+    good = write_test_bam(tmp_path / 'good.bam', reads=2000)
+    with open(good, 'rb') as f:
+        data = f.read()
+    broken = {'short.bam': data[:-100], 'head.bam': data[:20], 'text.bam': b'not a bam at all',
+              'stale.bam': data}
+    for name, content in broken.items():
+        (tmp_path / name).write_bytes(content)
+        shutil.copy(good + '.bai', str(tmp_path / (name + '.bai')))
+    os.utime(str(tmp_path / 'stale.bam.bai'), (1e9, 1e9))
+    (tmp_path / 'noindex.bam').write_bytes(data)
+    bams = [good] + [str(tmp_path / name) for name in broken] + [str(tmp_path / 'noindex.bam'),
+                                                                  str(tmp_path / 'missing.bam')]
+    assert igv_web.validate_inputs(bams, igv_web.check_bam) == [good]
+    err = capsys.readouterr().err
+    assert '6 of 7 inputs failed validation' in err and 'Traceback' not in err
+    for message in ('short.bam: truncated BAM file', 'text.bam: not a BAM file', 'stale.bam: ',
+                    'use -ix to rebuild', 'noindex.bam.bai is not existed', 'missing.bam: No such file'):
+        assert message in err
+    # a valid bam is only stat()ed next time
+    assert igv_web.get_manifest().files() == {good: (os.path.getsize(good), os.path.getmtime(good))}
+    with pyBigWig.open(str(tmp_path / 'x.bw'), 'w') as bw:
+        bw.addHeader([('chr1', 1000)])
+        bw.addEntries(['chr1'], [0], ends=[100], values=[1.0])
+    (tmp_path / 'x.wig').write_text('fixedStep chrom=chr1 start=1 step=1\n1\n')
+    bigwigs = [str(tmp_path / 'x.bw'), str(tmp_path / 'x.wig')]
+    assert igv_web.validate_inputs(bigwigs, igv_web.check_bigwig) == bigwigs[:1]
+    assert 'x.wig: not a bigWig file' in capsys.readouterr().err
+
+
+def write_genomes(path, ids):
+    with open(str(path), 'w') as f:
+        json.dump([{'id': genome_id, 'name': genome_id.upper(), 'fastaURL': genome_id + '.fa'} for genome_id in ids], f)
+
+
+def test_genome_catalog(tmp_path, monkeypatch, capsys):
+    pytest.importorskip('wget')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(igv_web, 'manifest', None)
+    monkeypatch.setattr(igv_web, 'GENOMES_URL', (tmp_path / 'remote.json').as_uri())
+    write_genomes(tmp_path / 'genomes.json', ['hg19', 'hg38', 'mm10'])
+    write_genomes(tmp_path / 'remote.json', ['hg19', 'hg38', 'mm10', 'mm39'])
+    ids = lambda catalog: catalog.genome_ids()
+    # the first load takes a genomes.json of older versions, without downloading
+    assert ids(igv_web.genome_catalog()) == ['hg19', 'hg38', 'mm10']
+    assert os.path.isfile(str(tmp_path / 'genomes.json'))
+    # the cached copy is used until it is older than max_age or a refresh is asked for
+    assert ids(igv_web.genome_catalog(max_age=igv_web.GENOMES_TTL)) == ['hg19', 'hg38', 'mm10']
+    assert ids(igv_web.genome_catalog(refresh=True)) == ['hg19', 'hg38', 'mm10', 'mm39']
+    write_genomes(tmp_path / 'remote.json', ['hg38', 'dm6'])
+    assert ids(igv_web.genome_catalog(max_age=igv_web.GENOMES_TTL)) == ['hg19', 'hg38', 'mm10', 'mm39']
+    igv_web.get_manifest().set_settings(genomes_fetched=str(time.time() - igv_web.GENOMES_TTL - 1))
+    catalog = igv_web.genome_catalog(max_age=igv_web.GENOMES_TTL)
+    assert ids(catalog) == ['dm6', 'hg38'] and catalog.genome('dm6')['fastaURL'] == 'dm6.fa'
+    # an origin that fails leaves the cached list in place
+    os.remove(str(tmp_path / 'remote.json'))
+    assert ids(igv_web.genome_catalog(refresh=True)) == ['dm6', 'hg38']
+    assert 'using the cached one' in capsys.readouterr().err
+    assert not [name for name in os.listdir(str(tmp_path / 'Cache')) if name.startswith('genomes.json')]
+
+
+def test_search_genomes(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(igv_web, 'manifest', None)
+    write_genomes(tmp_path / 'genomes.json', ['hg19', 'hg38', 'mm10', 'mm39', 'GRCh38'])
+    catalog = igv_web.genome_catalog()
+    assert igv_web.search_genomes(catalog, 'hg38') == ['hg38']
+    assert igv_web.search_genomes(catalog, 'mm') == ['mm10', 'mm39']
+    assert igv_web.search_genomes(catalog, 'hg83')[0] == 'hg38'
+    assert igv_web.search_genomes(catalog, 'grch38')[0] == 'GRCh38'
+    assert igv_web.search_genomes(catalog, 'zebrafish') == []
+    igv_web.check_reference('mm39')
+    with pytest.raises(SystemExit) as e:
+        igv_web.check_reference('mm93')
+    assert e.value.code == 1
+    assert 'mm93 is not a supported reference genome. Did you mean: mm39' in capsys.readouterr().err
+    with pytest.raises(SystemExit):
+        igv_web.check_reference('zebrafish')
+    assert 'Did you mean' not in capsys.readouterr().err
+
+
+def test_check_reference_without_catalog(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(igv_web, 'manifest', None)
+    monkeypatch.setattr(igv_web, 'GENOMES_URL', (tmp_path / 'missing.json').as_uri())
+    # no list at all: the id is let through with a warning
+    igv_web.check_reference('hg38')
+    assert 'could not load the genome list' in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('serve', [serve_directory, serve_asyncio])
+def test_sendfile(tmp_path, monkeypatch, serve):
+    data = os.urandom(1024 * 1024 + 7)
+    (tmp_path / 'x.bam').write_bytes(data)
+    calls = []
+    sendfile = os.sendfile
+    def counted(*args):
+        calls.append(args)
+        return sendfile(*args)
+    monkeypatch.setattr(os, 'sendfile', counted)
+    ranges = {'bytes=100000-199999': data[100000:200000], 'bytes=1000000-': data[1000000:],
+              'bytes=-5000': data[-5000:], 'bytes=900000-2000000': data[900000:]}
+    bodies = {}
+    for use_sendfile in (True, False):
+        # -ns turns the zero-copy path off on both engines
+        monkeypatch.setattr(igv_web.RangeRequestHandler, 'use_sendfile', use_sendfile)
+        monkeypatch.setattr(igv_web.AsyncRangeServer, 'use_sendfile', use_sendfile)
+        base = serve(tmp_path)
+        for header, expected in ranges.items():
+            del calls[:]
+            status, headers, body = http_get(base + '/x.bam', {'Range': header})
+            assert status == 206 and body == expected
+            assert headers['Content-Range'].endswith('/{}'.format(len(data)))
+            # every body goes through os.sendfile, or none does
+            assert bool(calls) == use_sendfile
+            bodies[(use_sendfile, header)] = body
+        del calls[:]
+        status, headers, body = http_get(base + '/x.bam')
+        assert status == 200 and body == data and bool(calls) == use_sendfile
+    assert all(bodies[(True, header)] == bodies[(False, header)] for header in ranges)
+
+
+def test_conditional_checks(tmp_path):
+    (tmp_path / 'x.bin').write_bytes(b'x')
+    os.utime(str(tmp_path / 'x.bin'), (1e9, 1e9))
+    fs = os.stat(str(tmp_path / 'x.bin'))
+    etag, date = '"abc"', 'Sun, 09 Sep 2001 01:46:40 GMT'
+    assert igv_web.is_not_modified({'If-None-Match': '"abc"'}, fs, etag)
+    assert igv_web.is_not_modified({'If-None-Match': '"x", W/"abc"'}, fs, etag)
+    assert igv_web.is_not_modified({'If-None-Match': '*'}, fs, etag)
+    # If-None-Match wins over If-Modified-Since
+    assert not igv_web.is_not_modified({'If-None-Match': '"x"', 'If-Modified-Since': date}, fs, etag)
+    assert igv_web.is_not_modified({'If-Modified-Since': date}, fs, etag)
+    assert not igv_web.is_not_modified({'If-Modified-Since': 'Sun, 09 Sep 2001 01:46:39 GMT'}, fs, etag)
+    assert not igv_web.is_not_modified({'If-Modified-Since': 'yesterday'}, fs, etag)
+    assert not igv_web.is_not_modified({}, fs, etag)
+    assert igv_web.if_range_matches({}, fs, etag)
+    assert igv_web.if_range_matches({'If-Range': '"abc"'}, fs, etag)
+    assert not igv_web.if_range_matches({'If-Range': '"old"'}, fs, etag)
+    # weak tags never match for ranges
+    assert not igv_web.if_range_matches({'If-Range': 'W/"abc"'}, fs, etag)
+    assert not igv_web.if_range_matches({'If-Range': 'W/"abc"'}, fs, 'W/"abc"')
+    assert igv_web.if_range_matches({'If-Range': date}, fs, etag)
+    assert not igv_web.if_range_matches({'If-Range': 'Sun, 09 Sep 2001 01:46:41 GMT'}, fs, etag)
+
+
+@pytest.mark.parametrize('serve', [serve_directory, serve_asyncio])
+def test_conditional_requests(tmp_path, serve):
+    data = os.urandom(200000)
+    (tmp_path / 'x.bam').write_bytes(data)
+    base = serve(tmp_path)
+    status, headers, body = http_get(base + '/x.bam')
+    etag, modified = headers['ETag'], headers['Last-Modified']
+    assert status == 200 and etag.startswith('"') and modified
+    for conditions in ({'If-None-Match': etag}, {'If-None-Match': '"other", ' + etag},
+                       {'If-Modified-Since': modified}):
+        status, headers, body = http_get(base + '/x.bam', conditions)
+        assert status == 304 and body == b'' and headers['ETag'] == etag
+    for conditions in ({'If-None-Match': '"other"'}, {'If-None-Match': '"other"', 'If-Modified-Since': modified},
+                       {'If-Modified-Since': 'Thu, 01 Jan 1998 00:00:00 GMT'}):
+        assert http_get(base + '/x.bam', conditions)[:3:2] == (200, data)
+    # a range under a current If-Range is partial, under a stale one the whole new file
+    for if_range in (etag, modified):
+        status, headers, body = http_get(base + '/x.bam', {'Range': 'bytes=100-199', 'If-Range': if_range})
+        assert status == 206 and body == data[100:200]
+    for if_range in ('"stale"', 'W/' + etag, 'Thu, 01 Jan 1998 00:00:00 GMT'):
+        status, headers, body = http_get(base + '/x.bam', {'Range': 'bytes=100-199', 'If-Range': if_range})
+        assert status == 200 and body == data and 'Content-Range' not in headers
+    # a rewritten file has another ETag, so the old one neither matches nor resumes
+    (tmp_path / 'x.bam').write_bytes(data[::-1])
+    os.utime(str(tmp_path / 'x.bam'), (2e9, 2e9))
+    assert http_get(base + '/x.bam', {'If-None-Match': etag})[0] == 200
+    status, headers, body = http_get(base + '/x.bam', {'Range': 'bytes=0-9', 'If-Range': etag})
+    assert status == 200 and body == data[::-1]
+
+
+def benchmark(sizes, n, slow_limit):
+    '''Times every sampler on exponential populations of the given sizes;
+    the element-at-a-time algorithm_r only up to slow_limit elements.
+    '''
+    names = ['algorithm_r', 'priority', 'priority merge', 'algorithm_l']
+    functions = [algorithm_r, priority_sample, merged_sample, reservoir_l_sample]
+    print('{:>12} '.format('size') + ' '.join('{:>15}'.format(name) for name in names))
+    for size in sizes:
+        population = exponential_population(size)
+        row = []
+        for function in functions:
+            if function is algorithm_r and size > slow_limit:
+                row.append('-')
+                continue
+            start = time.perf_counter()
+            function(population, n)
+            row.append('{:.4f}s'.format(time.perf_counter() - start))
+        print('{:>12} '.format(size) + ' '.join('{:>15}'.format(cell) for cell in row))
+        sys.stdout.flush()
 
-    assert pytest.approx(rate_mle, tolerance) == rate
 
-def test_sample():
-
-    n = 1000  # Sample size
-    population_size = n * 1000  # Input size.
-    rate = 0.1  
-    N = 2000
-
-    time_1 = []
-    time_2 = []
-    time_3 = []
-    population_size = [100000,500000,1000000,2000000,5000000,7000000,10000000,30000000,70000000,100000000]
-    for i in population_size:
-        rng = default_rng()
-        population = rng.exponential(
-            1 / rate,  
-            i,
-        )
-        population.sort()
-        start_1 = time.time()
-        algorithm_r(population, N)
-        end_1 = time.time()
-        start_2 = time.time()
-        method_4(population,N)
-        end_2 = time.time()
-        start_3 = time.time()
-        algorithm_l(population,N)
-        end_3 = time.time()
-        time_1.append(end_1-start_1)
-        time_2.append(end_2-start_2)
-        time_3.append(end_3-start_3)
-    
-    plt.plot(population_size,time_1)
-    plt.plot(population_size,time_2,color='yellow')
-    plt.plot(population_size,time_3,color='green')
-    plt.legend(['Reservoir','method_4','algorithm_l'])
-    plt.show()
-
-test_sample()
\ No newline at end of file
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser(description='Time the reservoir samplers of igv_sample.py')
+    arguments.add_argument('-n', '--sample-size', default=2000, type=int, help='sample size [default: 2000]')
+    arguments.add_argument('-s', '--sizes', default='100000,1000000,10000000,100000000', help='comma separated \
+        population sizes [default: 1e5 to 1e8]')
+    arguments.add_argument('-r', '--slow-limit', default=10000000, type=int, help='largest population for \
+        algorithm_r [default: 10000000]')
+    opts = arguments.parse_args()
+    benchmark([int(size) for size in opts.sizes.split(',')], opts.sample_size, opts.slow_limit)